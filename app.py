@@ -1,14 +1,28 @@
 import os
+import io
+import re
+import gzip
 import json
+import mimetypes
+import tempfile
+import hashlib
+import hmac
+import unicodedata
+import base64
+import binascii
 import random
+import socket
 import string
 from datetime import datetime, timedelta, timezone
-from functools import wraps
+from functools import wraps, lru_cache
 import requests
 import threading
+import queue
+import time
+from bisect import bisect_left
 import redis  # 导入 redis
 import psutil  # [新增] 用于监控服务器状态
-from collections import Counter
+from collections import Counter, OrderedDict
 from flask_session import Session  # 导入 Session 扩展
 from zhdate import ZhDate
 # 引入 ProxyFix 修复云端/Nginx反代环境下的 Scheme 问题
@@ -16,7 +30,9 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 # 引入 Flask 相关组件
 from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
 # 需要导入 Response 和 stream_with_context (Flask原生支持流式)
-from flask import Response, stream_with_context
+from flask import Response, stream_with_context, g, has_request_context, before_render_template, template_rendered
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup, escape
 # 引入 CSRF 保护
 from flask_wtf.csrf import CSRFProtect, generate_csrf
 # Supabase 客户端
@@ -28,25 +44,616 @@ from werkzeug.utils import secure_filename
 # [修改] 多导入一个 generate_csrf
 from flask_wtf.csrf import CSRFProtect, generate_csrf
 from cryptography.fernet import Fernet
+# 统一的时间解析/格式化 (带缓存)
+from time_utils import parse_iso, format_bj, format_time_friendly, format_rows
+
+# 可选依赖：识图前压缩图片用，没装时识图照常可用，只是不做压缩
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+# 可选依赖：红黑榜拼音搜索用，没装时只按中文名搜
+try:
+    from pypinyin import lazy_pinyin
+except ImportError:
+    lazy_pinyin = None
+# 可选依赖：静态资源预压缩 brotli，没装时只提供 gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 LAB_CODE = "testuser8888"
 # 加载 .env 文件
 load_dotenv()
+# 大模型网关 (连接池/超时/按模型限流)，放在 load_dotenv 之后以便读到 LLM_* 配置
+import llm_gateway  # noqa: E402
+import job_queue  # noqa: E402
 
 app = Flask(__name__)
 
 
+# ================= 静态资源指纹 + 预压缩 =================
+# 启动时给 static/ 下每个文件算内容哈希，url_for('static', ...) 自动带上 ?v=哈希
+# 带着正确哈希的请求可以放心让浏览器缓存一年 (immutable)，文件一改哈希就变，URL 也跟着变
+# 文本类文件 (svg/js/css/json) 同时预压缩好 gzip / brotli，请求时按 Accept-Encoding 直接返回
+# sw.js 和 manifest.json 必须每次回源确认，不参与指纹和长缓存
+STATIC_NO_CACHE = {'sw.js', 'manifest.json'}
+STATIC_COMPRESS_EXT = {'.svg', '.js', '.css', '.json', '.txt', '.html', '.xml'}
+STATIC_COMPRESS_MIN = 512  # 太小的文件压缩不划算
+STATIC_IMMUTABLE = 'public, max-age=31536000, immutable'
+STATIC_BROTLI_QUALITY = 9  # 11 压得更小但启动时慢很多
+
+
+def build_static_assets(folder):
+    """扫描静态目录：文件名 -> {'hash', 'mtime', 'gzip', 'br'}"""
+    assets = {}
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, folder).replace(os.sep, '/')
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            asset = {'hash': hashlib.sha1(data).hexdigest()[:12], 'mtime': mtime}
+            if os.path.splitext(name)[1].lower() in STATIC_COMPRESS_EXT and len(data) >= STATIC_COMPRESS_MIN:
+                gz = gzip.compress(data, compresslevel=9, mtime=0)
+                if len(gz) < len(data): asset['gzip'] = gz
+                if brotli is not None:
+                    br = brotli.compress(data, quality=STATIC_BROTLI_QUALITY)
+                    if len(br) < len(data): asset['br'] = br
+            assets[rel] = asset
+    return assets
+
+
+_static_assets = build_static_assets(app.static_folder)
+
+
+def _static_asset(filename):
+    asset = _static_assets.get(filename)
+    # 本地开发时文件会被改，发现 mtime 变了就整体重建一次
+    if asset and app.debug:
+        try:
+            if os.path.getmtime(os.path.join(app.static_folder, filename)) != asset['mtime']:
+                _static_assets.clear()
+                _static_assets.update(build_static_assets(app.static_folder))
+                asset = _static_assets.get(filename)
+        except OSError:
+            pass
+    return asset
+
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    """url_for('static', filename=...) 自动追加 ?v=内容哈希"""
+    if endpoint != 'static' or 'v' in values: return
+    filename = values.get('filename')
+    if filename in STATIC_NO_CACHE: return
+    asset = _static_asset(filename)
+    if asset: values['v'] = asset['hash']
+
+
+def serve_static(filename):
+    """替换 Flask 默认的静态文件处理：预压缩 + 按指纹决定缓存策略"""
+    asset = _static_asset(filename)
+    if filename in STATIC_NO_CACHE or not asset:
+        resp = app.send_static_file(filename)
+        resp.cache_control.no_cache = True
+        return resp
+
+    encoding = None
+    for enc in ('br', 'gzip'):
+        if asset.get(enc) and request.accept_encodings[enc]:
+            encoding = enc
+            break
+
+    if encoding:
+        resp = Response(asset[encoding], mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        resp.headers['Content-Encoding'] = encoding
+        resp.set_etag(f"{asset['hash']}-{encoding}")
+        resp = resp.make_conditional(request)
+    else:
+        resp = app.send_static_file(filename)
+    resp.vary.add('Accept-Encoding')
+
+    if request.args.get('v') == asset['hash']:
+        resp.headers['Cache-Control'] = STATIC_IMMUTABLE
+    else:
+        # 没带指纹 (模板里写死的路径、旧页面)：可以缓存，但每次要用 ETag 确认
+        resp.headers['Cache-Control'] = 'public, no-cache'
+    return resp
+
+
+app.view_functions['static'] = serve_static
+
+
+# ================= 响应压缩 (gzip / brotli) =================
+# 首页 HTML 两百多 KB、各种 JSON 接口都是原样发出去的，手机网络下很吃亏
+# 在 after_request 里按 Accept-Encoding 压缩；流式响应 (AI 问诊、提醒推送) 一律不碰，否则会被攒到结束才发
+COMPRESS_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/xml', 'application/json',
+    'application/javascript', 'text/javascript', 'image/svg+xml', 'application/xml'
+}
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))  # 小于这个字节数不压
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))  # gzip 等级 1-9，越大越小也越费 CPU
+COMPRESS_BR_QUALITY = int(os.getenv('COMPRESS_BR_QUALITY', 4))  # brotli 0-11，动态内容 4 左右性价比最高
+COMPRESS_EXEMPT_PATHS = {'/api/ask_vet', '/api/reminders/stream'}
+
+
+@app.after_request
+def compress_response(response):
+    if (request.path in COMPRESS_EXEMPT_PATHS
+            or response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if brotli is not None and request.accept_encodings['br']:
+        encoding = 'br'
+    elif request.accept_encodings['gzip']:
+        encoding = 'gzip'
+    else:
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE: return response
+
+    if encoding == 'br':
+        body = brotli.compress(data, quality=COMPRESS_BR_QUALITY)
+    else:
+        body = gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    # 压缩后字节变了：强 ETag 降为弱 ETag，浏览器带着它回来时仍能命中 304
+    etag, weak = response.get_etag()
+    if etag and not weak: response.set_etag(etag, weak=True)
+    return response
+
+
+# ================= 模板渲染 (字节码缓存 / 片段缓存 / 耗时统计) =================
+# home.html 拆成了 templates/home/ 下的几个片段；编译结果落盘，worker 重启后不用重新编译大模板
+# 不依赖任何变量的片段 (如整段 CSS) 渲染一次后按版本号缓存
+# 每个模板的渲染耗时记在进程内，/api/server_stats 里可以看到
+JINJA_CACHE_DIR = os.getenv('JINJA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'family_jinja_cache'))
+try:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+except OSError as e:
+    print(f"Jinja Cache Error: {e}")
+
+_fragment_cache = {}
+_template_stats = {}  # 模板名 -> {'count', 'total_ms', 'max_ms', 'last_ms'}
+_template_stats_lock = threading.Lock()
+
+
+def static_fragment(name):
+    """模板用：渲染不依赖变量的片段，结果按版本号缓存 (调试模式下每次重新渲染)"""
+    key = (name, CURRENT_APP_VERSION)
+    html = None if app.debug else _fragment_cache.get(key)
+    if html is None:
+        html = Markup(app.jinja_env.get_template(name).render())
+        _fragment_cache[key] = html
+    return html
+
+
+app.jinja_env.globals.update(static_fragment=static_fragment)
+
+
+@before_render_template.connect_via(app)
+def _template_render_start(sender, template, context, **extra):
+    g.setdefault('_template_starts', []).append(time.perf_counter())
+
+
+@template_rendered.connect_via(app)
+def _template_render_end(sender, template, context, **extra):
+    starts = g.get('_template_starts')
+    if not starts: return
+    cost = (time.perf_counter() - starts.pop()) * 1000
+    name = template.name or '<string>'
+    g.setdefault('template_timings', []).append((name, cost))
+    with _template_stats_lock:
+        st = _template_stats.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'last_ms': 0.0})
+        st['count'] += 1
+        st['total_ms'] += cost
+        st['max_ms'] = max(st['max_ms'], cost)
+        st['last_ms'] = cost
+
+
+def get_template_stats():
+    """各模板渲染耗时 (本进程)，按总耗时倒序"""
+    with _template_stats_lock:
+        rows = [dict(st, name=name) for name, st in _template_stats.items()]
+    for r in rows:
+        r['avg_ms'] = round(r['total_ms'] / r['count'], 2) if r['count'] else 0
+        for k in ('total_ms', 'max_ms', 'last_ms'):
+            r[k] = round(r[k], 2)
+    return sorted(rows, key=lambda r: r['total_ms'], reverse=True)
+
+
+# ================= 数据库调用追踪 (Supabase / PostgREST) =================
+# 一个页面到底查了几次库、每次多久，以前只能读代码数；这里在 postgrest 的 execute 上套一层计时，
+# get_db() 临时建的客户端和 admin_supabase 都走同一批类，所以一处打补丁全部覆盖。
+# 每次请求的调用明细记在 g.db_calls，响应头带 Server-Timing (浏览器开发者工具 Timing 面板能看到)，
+# 慢请求 / 查询次数过多的请求把完整明细打到日志里，方便揪出 N+1
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 1000))  # 总耗时超过这个毫秒数记慢日志
+SLOW_REQUEST_DB_CALLS = int(os.getenv('SLOW_REQUEST_DB_CALLS', 30))  # 单次请求查库超过这么多次也记
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING', '1') != '0'
+
+_DB_OPS = {'GET': 'select', 'HEAD': 'count', 'POST': 'insert', 'PATCH': 'update', 'DELETE': 'delete'}
+
+
+def _describe_db_request(req):
+    """从 postgrest 的请求配置里取出 (表名/RPC 名, 操作)"""
+    path = str(getattr(req, 'path', '')).split('?', 1)[0]
+    target = path.split('/rest/v1/', 1)[-1].strip('/') or '?'
+    method = (getattr(req, 'http_method', '') or '').upper()
+    if target.startswith('rpc/'):
+        return target[4:], 'rpc'
+    op = _DB_OPS.get(method, method.lower())
+    if method == 'POST' and 'resolution=' in (req.headers.get('Prefer') or ''):
+        op = 'upsert'
+    return target, op
+
+
+def _count_db_rows(res):
+    data = getattr(res, 'data', None)
+    if isinstance(data, list): return len(data)
+    if data is None or data == '': return 0
+    return 1
+
+
+def record_db_call(table, op, cost, rows=0, error=None):
+    """记一次查库到当前请求 (请求之外的后台线程调用直接忽略)"""
+    if not has_request_context(): return
+    g.setdefault('db_calls', []).append({
+        'table': table, 'op': op, 'ms': round(cost, 2), 'rows': rows, 'error': error
+    })
+
+
+def _traced_execute(execute):
+    @wraps(execute)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            res = execute(self, *args, **kwargs)
+        except Exception as e:
+            table, op = _describe_db_request(self.request)
+            record_db_call(table, op, (time.perf_counter() - start) * 1000, error=type(e).__name__)
+            raise
+        table, op = _describe_db_request(self.request)
+        record_db_call(table, op, (time.perf_counter() - start) * 1000, rows=_count_db_rows(res))
+        return res
+    wrapper._db_traced = True
+    return wrapper
+
+
+def install_db_tracer():
+    """给所有同步 request builder 的 execute 打补丁 (重复调用无副作用)"""
+    try:
+        from postgrest._sync import request_builder as rb
+    except ImportError as e:
+        print(f"DB Tracer Error: {e}")
+        return
+    for name in ('SyncQueryRequestBuilder', 'SyncSingleRequestBuilder',
+                 'SyncMaybeSingleRequestBuilder', 'SyncExplainRequestBuilder'):
+        cls = getattr(rb, name, None)
+        execute = cls.__dict__.get('execute') if cls else None
+        if execute and not getattr(execute, '_db_traced', False):
+            cls.execute = _traced_execute(execute)
+
+
+install_db_tracer()
+
+
+def summarize_db_calls(calls):
+    """请求内的查库汇总：总次数/总耗时，以及按 (表, 操作) 分组的次数和耗时"""
+    groups = {}
+    for c in calls:
+        key = f"{c['table']}.{c['op']}"
+        grp = groups.setdefault(key, {'count': 0, 'ms': 0.0, 'rows': 0})
+        grp['count'] += 1
+        grp['ms'] += c['ms']
+        grp['rows'] += c['rows']
+    return {
+        'count': len(calls),
+        'ms': round(sum(c['ms'] for c in calls), 2),
+        'errors': sum(1 for c in calls if c['error']),
+        'by_table': sorted(groups.items(), key=lambda kv: kv[1]['ms'], reverse=True),
+    }
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def add_server_timing(response):
+    start = g.get('request_start')
+    if start is None: return response
+    total = (time.perf_counter() - start) * 1000
+    calls = g.get('db_calls') or []
+    summary = g.db_summary = summarize_db_calls(calls)
+    tpl_ms = sum(cost for _, cost in g.get('template_timings') or [])
+
+    if SERVER_TIMING_ENABLED:
+        parts = [f'db;dur={summary["ms"]:.1f};desc="{summary["count"]} queries"']
+        if tpl_ms: parts.append(f'tpl;dur={tpl_ms:.1f};desc="render"')
+        parts.append(f'app;dur={total:.1f}')
+        response.headers.add('Server-Timing', ', '.join(parts))
+
+    if total >= SLOW_REQUEST_MS or summary['count'] >= SLOW_REQUEST_DB_CALLS:
+        lines = [f"🐢 慢请求 {request.method} {request.path} -> {response.status_code} "
+                 f"总 {total:.0f}ms | 查库 {summary['count']} 次 {summary['ms']:.0f}ms | 模板 {tpl_ms:.0f}ms"]
+        for key, grp in summary['by_table']:
+            lines.append(f"    {key}: {grp['count']} 次 {grp['ms']:.0f}ms {grp['rows']} 行")
+        for i, c in enumerate(calls, 1):
+            err = f" !{c['error']}" if c['error'] else ''
+            lines.append(f"    #{i} {c['table']}.{c['op']} {c['ms']:.1f}ms {c['rows']} 行{err}")
+        print('\n'.join(lines))
+    return response
+
+
+# ================= 接口耗时统计 (按路由的直方图) =================
+# 每个 endpoint 记请求数、5xx 数、耗时直方图和正在处理的请求数，p50/p95/p99 由直方图估算
+# 请求结束时只改进程内的增量，每隔 METRICS_FLUSH_SECONDS 用一次 pipeline 累加到 Redis，多个 worker 的数据合在一起看；
+# 本地无 Redis 时就是本进程的数据。统计按版本号分开，发新版后从零开始，方便对比
+# 流式响应 (AI 问诊、提醒推送) 的耗时是首包时间，但它们在推送期间一直算作"处理中"
+ROUTE_BUCKETS_MS = (5, 10, 25, 50, 75, 100, 150, 250, 400, 600, 1000, 1500, 2500, 5000, 10000)  # 最后还有一个 +Inf 桶
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', 5))
+METRICS_TTL = 7 * 86400  # 旧版本的统计 7 天后自动清掉
+METRICS_INFLIGHT_STALE = 60  # worker 超过这么多秒没上报就不再计入"处理中"
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # Prometheus 抓取 /metrics 用的 Bearer token
+
+_route_pending = {}  # endpoint -> 尚未写入 Redis 的增量 (无 Redis 时就是全部数据)
+_route_inflight = Counter()
+_route_metrics_lock = threading.Lock()
+_route_last_flush = 0.0
+
+
+def _new_route_stats():
+    return {'count': 0, 'errors': 0, 'sum_ms': 0.0, 'buckets': [0] * (len(ROUTE_BUCKETS_MS) + 1)}
+
+
+def _merge_route_stats(dst, src):
+    for endpoint, st in src.items():
+        cur = dst.setdefault(endpoint, _new_route_stats())
+        cur['count'] += st['count']
+        cur['errors'] += st['errors']
+        cur['sum_ms'] += st['sum_ms']
+        cur['buckets'] = [a + b for a, b in zip(cur['buckets'], st['buckets'])]
+
+
+def _route_metrics_key(endpoint=''):
+    return f"metrics:{CURRENT_APP_VERSION}:route:{endpoint}"
+
+
+def _metrics_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def record_route_metric(endpoint, cost, status):
+    with _route_metrics_lock:
+        st = _route_pending.get(endpoint)
+        if st is None:
+            st = _route_pending[endpoint] = _new_route_stats()
+        st['count'] += 1
+        st['sum_ms'] += cost
+        st['buckets'][bisect_left(ROUTE_BUCKETS_MS, cost)] += 1
+        if status >= 500: st['errors'] += 1
+
+
+def flush_route_metrics(force=False):
+    """把本进程的增量累加到 Redis (没到间隔就跳过)；写失败时增量放回去下次再写"""
+    global _route_pending, _route_last_flush
+    if not redis_client: return
+    now = time.time()
+    with _route_metrics_lock:
+        if not force and now - _route_last_flush < METRICS_FLUSH_SECONDS: return
+        pending, _route_pending = _route_pending, {}
+        inflight = {k: v for k, v in _route_inflight.items() if v > 0}
+        _route_last_flush = now
+
+    endpoints_key = _route_metrics_key('__endpoints__')
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for endpoint, st in pending.items():
+            key = _route_metrics_key(endpoint)
+            pipe.sadd(endpoints_key, endpoint)
+            pipe.hincrby(key, 'count', st['count'])
+            if st['errors']: pipe.hincrby(key, 'errors', st['errors'])
+            pipe.hincrbyfloat(key, 'sum_ms', round(st['sum_ms'], 3))
+            for i, n in enumerate(st['buckets']):
+                if n: pipe.hincrby(key, f"b{i}", n)
+            pipe.expire(key, METRICS_TTL)
+        if pending: pipe.expire(endpoints_key, METRICS_TTL)
+        pipe.hset('metrics:inflight', _metrics_worker_id(), json.dumps({'ts': now, 'routes': inflight}))
+        pipe.execute()
+    except Exception as e:
+        print(f"Metrics Flush Error: {e}")
+        with _route_metrics_lock:
+            _merge_route_stats(_route_pending, pending)
+
+
+def _load_route_metrics():
+    """汇总后的原始数据: ({endpoint: stats}, {endpoint: 处理中数量})"""
+    if not redis_client:
+        with _route_metrics_lock:
+            stats = {}
+            _merge_route_stats(stats, _route_pending)
+            return stats, {k: v for k, v in _route_inflight.items() if v > 0}
+
+    flush_route_metrics(force=True)
+    stats, inflight = {}, Counter()
+    try:
+        endpoints = sorted(m.decode() if isinstance(m, bytes) else m
+                           for m in redis_client.smembers(_route_metrics_key('__endpoints__')))
+        pipe = redis_client.pipeline(transaction=False)
+        for endpoint in endpoints:
+            pipe.hgetall(_route_metrics_key(endpoint))
+        for endpoint, raw in zip(endpoints, pipe.execute()):
+            raw = {(k.decode() if isinstance(k, bytes) else k): v for k, v in raw.items()}
+            st = _new_route_stats()
+            st['count'] = int(raw.get('count', 0))
+            st['errors'] = int(raw.get('errors', 0))
+            st['sum_ms'] = float(raw.get('sum_ms', 0))
+            st['buckets'] = [int(raw.get(f"b{i}", 0)) for i in range(len(st['buckets']))]
+            stats[endpoint] = st
+
+        now = time.time()
+        for worker, payload in redis_client.hgetall('metrics:inflight').items():
+            try:
+                data = json.loads(payload)
+            except ValueError:
+                data = {}
+            if now - data.get('ts', 0) > METRICS_INFLIGHT_STALE:
+                redis_client.hdel('metrics:inflight', worker)  # 已经退出的 worker
+                continue
+            inflight.update(data.get('routes') or {})
+    except Exception as e:
+        print(f"Metrics Load Error: {e}")
+    return stats, {k: v for k, v in inflight.items() if v > 0}
+
+
+def _bucket_quantile(buckets, count, q):
+    """直方图估算分位数：落在哪个桶里就在桶的上下界之间线性插值 (毫秒)"""
+    if not count: return 0.0
+    rank = q * count
+    seen = 0
+    for i, n in enumerate(buckets):
+        if n and seen + n >= rank:
+            lower = ROUTE_BUCKETS_MS[i - 1] if i > 0 else 0
+            if i >= len(ROUTE_BUCKETS_MS): return float(lower)  # 超过最大的桶，只能说"至少这么久"
+            return lower + (ROUTE_BUCKETS_MS[i] - lower) * (rank - seen) / n
+        seen += n
+    return float(ROUTE_BUCKETS_MS[-1])
+
+
+def get_route_metrics():
+    """各路由的耗时统计，按总耗时倒序 (最值得优化的排在前面)"""
+    stats, inflight = _load_route_metrics()
+    rows = []
+    for endpoint in set(stats) | set(inflight):
+        st = stats.get(endpoint) or _new_route_stats()
+        count = st['count']
+        rows.append({
+            'endpoint': endpoint,
+            'count': count,
+            'errors': st['errors'],
+            'error_rate': round(st['errors'] * 100.0 / count, 2) if count else 0,
+            'avg_ms': round(st['sum_ms'] / count, 1) if count else 0,
+            'total_ms': round(st['sum_ms'], 1),
+            'p50': round(_bucket_quantile(st['buckets'], count, 0.50), 1),
+            'p95': round(_bucket_quantile(st['buckets'], count, 0.95), 1),
+            'p99': round(_bucket_quantile(st['buckets'], count, 0.99), 1),
+            'inflight': inflight.get(endpoint, 0),
+        })
+    return sorted(rows, key=lambda r: (r['total_ms'], r['inflight']), reverse=True)
+
+
+def render_prometheus_metrics():
+    """Prometheus 文本格式 (0.0.4)"""
+    stats, inflight = _load_route_metrics()
+
+    def label(endpoint):
+        return endpoint.replace('\\', '\\\\').replace('"', '\\"')
+
+    lines = [
+        '# HELP http_request_duration_seconds Request latency by endpoint.',
+        '# TYPE http_request_duration_seconds histogram',
+    ]
+    for endpoint in sorted(stats):
+        st = stats[endpoint]
+        cumulative = 0
+        for i, n in enumerate(st['buckets']):
+            cumulative += n
+            le = f"{ROUTE_BUCKETS_MS[i] / 1000:g}" if i < len(ROUTE_BUCKETS_MS) else '+Inf'
+            lines.append(f'http_request_duration_seconds_bucket{{endpoint="{label(endpoint)}",le="{le}"}} {cumulative}')
+        lines.append(f'http_request_duration_seconds_sum{{endpoint="{label(endpoint)}"}} {st["sum_ms"] / 1000:.6f}')
+        lines.append(f'http_request_duration_seconds_count{{endpoint="{label(endpoint)}"}} {st["count"]}')
+
+    lines += ['# HELP http_request_errors_total Responses with status >= 500 by endpoint.',
+              '# TYPE http_request_errors_total counter']
+    for endpoint in sorted(stats):
+        lines.append(f'http_request_errors_total{{endpoint="{label(endpoint)}"}} {stats[endpoint]["errors"]}')
+
+    lines += ['# HELP http_requests_in_flight Requests currently being served by endpoint.',
+              '# TYPE http_requests_in_flight gauge']
+    for endpoint in sorted(inflight):
+        lines.append(f'http_requests_in_flight{{endpoint="{label(endpoint)}"}} {inflight[endpoint]}')
+    return '\n'.join(lines) + '\n'
+
+
+@app.before_request
+def track_inflight():
+    g.metrics_endpoint = request.endpoint or '<unmatched>'
+    with _route_metrics_lock:
+        _route_inflight[g.metrics_endpoint] += 1
+
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get('request_start')
+    if start is not None:
+        record_route_metric(g.get('metrics_endpoint') or request.endpoint or '<unmatched>',
+                            (time.perf_counter() - start) * 1000, response.status_code)
+    return response
+
+
+@app.teardown_request
+def release_inflight(exc=None):
+    endpoint = g.pop('metrics_endpoint', None)
+    if endpoint is None: return
+    with _route_metrics_lock:
+        _route_inflight[endpoint] -= 1
+        if _route_inflight[endpoint] <= 0: del _route_inflight[endpoint]
+    flush_route_metrics()
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """给 Prometheus 抓取：带 Authorization: Bearer <METRICS_TOKEN>，或者管理员登录状态下直接打开"""
+    auth = request.headers.get('Authorization', '')
+    # 按字节比较：compare_digest 遇到非 ASCII 的 str 会抛 TypeError；WSGI 头是按 latin-1 解出来的，还原成原始字节
+    token_ok = METRICS_TOKEN and hmac.compare_digest(auth.encode('latin-1', 'replace'), f"Bearer {METRICS_TOKEN}".encode())
+    if not token_ok and session.get('role') != 'admin':
+        return Response('forbidden\n', status=403, mimetype='text/plain')
+    resp = Response(render_prometheus_metrics(), mimetype='text/plain')
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+
 @app.route('/sw.js')
 def service_worker():
-    return app.send_static_file('sw.js')
+    # [修改] 把版本号写进 SW 脚本：发新版时脚本内容变了，浏览器才会装新 SW 并清掉旧缓存
+    with open(os.path.join(app.static_folder, 'sw.js'), encoding='utf-8') as f:
+        script = f.read().replace('__APP_VERSION__', CURRENT_APP_VERSION)
+    resp = Response(script, mimetype='application/javascript')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['Service-Worker-Allowed'] = '/'
+    return resp
+
+
+@app.route('/offline')
+def offline_page():
+    """离线兜底页 (由 Service Worker 预缓存)"""
+    return render_template('offline.html')
 
 
 @app.before_request
 def gatekeeper():
     # 1. 白名单：静态资源、门禁页接口、PWA相关文件
     # [关键] 加上 sw.js 和 manifest.json，确保 PWA 安装不受影响
-    if request.endpoint in ['static', 'lab_entry', 'verify_lab_entry'] or request.path in ['/sw.js',
-                                                                                           '/static/manifest.json']:
+    # [新增] /metrics 给 Prometheus 抓取，没有门禁 cookie，由接口自己校验 token
+    if request.endpoint in ['static', 'lab_entry', 'verify_lab_entry', 'offline_page',
+                            'prometheus_metrics'] or request.path in [
+            '/sw.js', '/static/manifest.json']:
         return
 
     # 2. 检查通行证 (Cookie)
@@ -135,7 +742,9 @@ if is_production:
     app.config['SESSION_USE_SIGNER'] = True
     app.config['SESSION_KEY_PREFIX'] = 'family:'
     # 服务器上 Redis 就在本地，直接连
-    app.config['SESSION_REDIS'] = redis.from_url('redis://127.0.0.1:6379')
+    # [新增] 同一个连接池也给 实时推送/缓存 等模块共用
+    redis_client = redis.from_url(os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379'))
+    app.config['SESSION_REDIS'] = redis_client
 
 else:
     print("💻 本地开发环境: 使用文件系统存储 & HTTP")
@@ -149,6 +758,8 @@ else:
     app.config['SESSION_TYPE'] = 'filesystem'
     app.config['SESSION_FILE_DIR'] = './flask_session_data'  # 在当前目录下生成文件夹存 Session
     app.config['SESSION_PERMANENT'] = True
+    # 3. 本地默认不连 Redis，相关模块自动退回进程内实现 (如需联调可设置 REDIS_URL)
+    redis_client = redis.from_url(os.environ['REDIS_URL']) if os.environ.get('REDIS_URL') else None
 # ---------------------------------------------------------
 
 # 初始化 Session (必须在配置之后)
@@ -172,6 +783,13 @@ supabase: Client = create_client(url, key)
 # 2. 管理员客户端 (Service Key，拥有上帝权限，用于后台管理和代登录)
 admin_supabase: Client = create_client(url, service_key) if service_key else None
 
+# ================= 后台任务队列 =================
+# 天气刷新、每周荣誉归档、微信推送、删图片这些慢活丢给任务队列，请求马上返回 (见 job_queue.py)
+# 生产环境任务存在 Redis 里：每个 gunicorn worker 里默认带 JOB_EMBEDDED_WORKERS 个后台线程干活，
+# 也可以设为 0，另起 python worker.py 专门跑；本地没有 Redis 时每个任务在后台线程里直接跑
+jobs = job_queue.JobQueue(redis_client)
+JOB_EMBEDDED_WORKERS = int(os.environ.get('JOB_EMBEDDED_WORKERS', 1))
+
 
 # ================= 辅助函数 =================
 
@@ -181,39 +799,6 @@ def get_beijing_time():
     return utc_dt.astimezone(timezone(timedelta(hours=8)))
 
 
-def format_time_friendly(iso_str):
-    """
-    将 ISO 时间字符串格式化为友好的显示格式
-    例如：刚刚、5分钟前、10-24 12:00
-    """
-    if not iso_str: return ""
-    try:
-        # 处理 Supabase 可能返回的 Z 结尾
-        if iso_str.endswith('Z'):
-            dt = datetime.fromisoformat(iso_str.replace('Z', '+00:00'))
-        else:
-            dt = datetime.fromisoformat(iso_str)
-
-        now = datetime.now(timezone.utc)
-        diff = now - dt
-        local_dt = dt.astimezone(timezone(timedelta(hours=8)))
-
-        # 如果大于24小时，显示日期
-        if diff.days > 0:
-            return local_dt.strftime('%m-%d %H:%M')
-        # 如果小于1小时
-        elif diff.seconds < 3600:
-            mins = diff.seconds // 60
-            if mins == 0:
-                return "刚刚"
-            return f"{mins}分钟前"
-        # 如果小于24小时
-        else:
-            return f"{diff.seconds // 3600}小时前"
-    except:
-        return iso_str[:10]
-
-
 def resolve_account(input_str):
     """智能识别账号格式，自动补全邮箱后缀"""
     if not input_str: return ""
@@ -231,6 +816,23 @@ def generate_invite_code():
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
 
 
+@jobs.task()
+def delete_storage_files(paths):
+    """后台任务：删除 family_photos 里的文件"""
+    client = admin_supabase if admin_supabase else supabase
+    client.storage.from_("family_photos").remove(paths)
+
+
+def remove_photos(db, *paths):
+    """[新增] 删图片：有管理员客户端就交给后台任务，否则用当前用户的客户端当场删"""
+    paths = [p for p in paths if p]
+    if not paths: return
+    if admin_supabase:
+        jobs.enqueue('delete_storage_files', paths)
+    else:
+        db.storage.from_("family_photos").remove(paths)
+
+
 # ================= 天气服务核心逻辑 =================
 
 def search_city_qweather(keyword):
@@ -259,6 +861,64 @@ def search_city_qweather(keyword):
     return None, None, None, None
 
 
+# ================= 天气图标 (内联 SVG symbol) =================
+# static/weather 下有 500 多个图标，原来首页每张天气卡都单独请求一个 .svg
+# 启动时把它们读进内存转成 <symbol>，首页只内联当前家庭用到的那几个，图标不再额外发请求
+WEATHER_ICON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'weather')
+_SVG_BODY_RE = re.compile(r'<svg\b([^>]*)>(.*)</svg>', re.S)
+_SVG_VIEWBOX_RE = re.compile(r'viewBox="([^"]+)"')
+
+
+def load_weather_symbols(folder=WEATHER_ICON_DIR):
+    """图标代码 -> <symbol> 片段"""
+    symbols = {}
+    try:
+        names = os.listdir(folder)
+    except OSError as e:
+        print(f"Weather Icon Error: {e}")
+        return symbols
+    for name in names:
+        if not name.endswith('.svg'): continue
+        code = name[:-4]
+        try:
+            with open(os.path.join(folder, name), encoding='utf-8') as f:
+                m = _SVG_BODY_RE.search(f.read())
+        except OSError:
+            continue
+        if not m: continue
+        vb = _SVG_VIEWBOX_RE.search(m.group(1))
+        symbols[code] = (f'<symbol id="qi-{code}" viewBox="{vb.group(1) if vb else "0 0 16 16"}">'
+                         f'{m.group(2).strip()}</symbol>')
+    return symbols
+
+
+WEATHER_SYMBOLS = load_weather_symbols()
+
+
+def weather_icon(code, css_class='weather-icon'):
+    """模板用：有 symbol 就引用内联图标，没有 (新图标代码) 时退回原来的图片"""
+    code = str(code or '')
+    if code in WEATHER_SYMBOLS:
+        return Markup(f'<svg class="{css_class}" role="img"><use href="#qi-{code}"></use></svg>')
+    # 走 url_for：带上静态文件指纹，也跟着 static_url_path / 挂载前缀走
+    src = url_for('static', filename=f'weather/{code}.svg')
+    return Markup(f'<img src="{escape(src)}" class="{css_class}">')
+
+
+def weather_sprite(families):
+    """模板用：只输出这些家庭天气里用到的图标"""
+    codes = set()
+    for f in families or []:
+        for w in (f.get('weather_home'), f.get('weather_away')):
+            if w and w.get('now'): codes.add(str(w['now'].get('icon')))
+    parts = [WEATHER_SYMBOLS[c] for c in sorted(codes) if c in WEATHER_SYMBOLS]
+    if not parts: return Markup('')
+    return Markup('<svg xmlns="http://www.w3.org/2000/svg" style="display:none">' + ''.join(parts) + '</svg>')
+
+
+app.jinja_env.globals.update(weather_icon=weather_icon, weather_sprite=weather_sprite)
+
+
 def get_weather_full(city_id, lat=None, lon=None):
     """
     [全能天气查询 - 最终修正版]
@@ -326,6 +986,26 @@ def get_weather_full(city_id, lat=None, lon=None):
     return weather_data
 
 
+@jobs.task()
+def refresh_family_weather(family_id):
+    """[新增] 后台任务：刷新一个家庭的天气缓存 (首页有旧数据时先显示旧的，由这里更新)"""
+    client = admin_supabase if admin_supabase else supabase
+    res = client.table('families').select('location_home_id, location_home_lat, location_home_lon, '
+                                          'location_away_id, location_away_lat, location_away_lon') \
+        .eq('id', family_id).maybe_single().execute()
+    if not res or not res.data: return
+    f = res.data
+
+    nh = get_weather_full(f.get('location_home_id'), f.get('location_home_lat'), f.get('location_home_lon'))
+    na = get_weather_full(f.get('location_away_id'), f.get('location_away_lat'), f.get('location_away_lon'))
+    if not nh and not na: return
+
+    payload = {'last_weather_update': datetime.now(timezone.utc).isoformat()}
+    if nh: payload['weather_data_home'] = nh
+    if na: payload['weather_data_away'] = na
+    client.table('families').update(payload).eq('id', family_id).execute()
+
+
 def calculate_age(birthday):
     """根据生日计算 'X岁Y个月'"""
     if not birthday: return "年龄未知"
@@ -355,13 +1035,61 @@ def calculate_age(birthday):
         return "年龄未知"
 
 
-# [新增] 计算事件详情
+# ================= 农历/纪念日计算 =================
+# 农历 -> 公历 换算表：每个公历年份只用 ZhDate 算一次，之后都是查字典
+# 纪念日结果再按 (事件, 今天) 缓存，首页渲染时倒计时就只剩一次字典查找
+
+@lru_cache(maxsize=64)
+def get_lunar_year_table(year):
+    """返回 {(农历月, 农历日): 公历date}，该农历年不存在的日子 (如小月三十) 不在表里"""
+    table = {}
+    for month in range(1, 13):
+        for day in range(1, 31):
+            try:
+                table[(month, day)] = ZhDate(year, month, day).to_datetime().date()
+            except:
+                pass  # 小月没有三十，跳过
+    return table
+
+
+def lunar_to_solar(year, month, day):
+    """查表换算农历日期，换算不了返回 None"""
+    return get_lunar_year_table(year).get((month, day))
+
+
+_event_cache = {}
+_event_cache_day = None
+_event_cache_lock = threading.Lock()
+
+
 def calculate_event_details(event):
     """
+    带缓存的事件详情 (同一事件当天只算一次)
     返回: {days: 剩余天数, total: 累计天数, date_str: 下次日期, is_repeat: bool}
     """
+    global _event_cache_day
+    today = datetime.now(timezone(timedelta(hours=8))).date()
+    cache_key = (event.get('id'), event.get('event_date'), event.get('event_type'), bool(event.get('is_repeat')))
+
+    with _event_cache_lock:
+        # 跨天了，昨天的结果全部作废
+        if _event_cache_day != today:
+            _event_cache.clear()
+            _event_cache_day = today
+        if cache_key in _event_cache:
+            cached = _event_cache[cache_key]
+            return dict(cached) if cached else None
+
+    result = _calculate_event_details(event, today)
+    with _event_cache_lock:
+        if _event_cache_day == today:
+            _event_cache[cache_key] = result
+    return dict(result) if result else None
+
+
+def _calculate_event_details(event, today):
+    """实际计算逻辑 (不带缓存)"""
     try:
-        today = datetime.now(timezone(timedelta(hours=8))).date()
         start_date = datetime.strptime(event['event_date'], '%Y-%m-%d').date()
 
         # 1. 计算累计天数 (如果开始时间在过去)
@@ -378,16 +1106,14 @@ def calculate_event_details(event):
         else:
             # B. 重复事件 (农历/公历)
             if event['event_type'] == 'lunar':
-                try:
-                    # 尝试今年的农历
-                    lunar_next = ZhDate(today.year, start_date.month, start_date.day)
-                    solar_next = lunar_next.to_datetime().date()
-                    if solar_next < today:
-                        # 今年过了算明年
-                        lunar_next = ZhDate(today.year + 1, start_date.month, start_date.day)
-                        solar_next = lunar_next.to_datetime().date()
+                # 尝试今年的农历
+                solar_next = lunar_to_solar(today.year, start_date.month, start_date.day)
+                if solar_next and solar_next < today:
+                    # 今年过了算明年
+                    solar_next = lunar_to_solar(today.year + 1, start_date.month, start_date.day)
+                if solar_next:
                     next_date = solar_next
-                except:
+                else:
                     # 简单回退到公历防止报错
                     next_date = start_date.replace(year=today.year)
             else:
@@ -516,49 +1242,11 @@ def send_wechat_push(family_id, summary, content):
     """
     [平台版] 微信推送
     family_id: 目标家庭 ID
+    [优化] 交给后台任务队列，WxPusher 慢或失败 (会自动重试) 都不影响当前请求
     """
     if not wx_app_token or not family_id: return
+    jobs.enqueue('push_family_wechat', family_id, summary, content)
 
-    def _do_push():
-        try:
-            # 1. 既然是给家庭发，先找出这个家庭里的所有成员
-            # 这里需要管理员权限(admin_supabase)或者确保 RLS 允许读取成员的 profile
-            # 为了稳妥，我们用 get_db()，依赖 "同家庭可见" 的 RLS 策略
-            # 注意：这需要确保当前操作者属于该家庭，或者是系统自动触发
-
-            client = admin_supabase if admin_supabase else supabase
-
-            # A. 查出家庭成员 ID
-            mems = client.table('family_members').select('user_id').eq('family_id', family_id).execute()
-            user_ids = [m['user_id'] for m in mems.data] if mems.data else []
-
-            if not user_ids: return
-
-            # B. 查出这些成员的 wx_uid
-            # 过滤掉没有填 UID 的人
-            profiles = client.table('profiles').select('wx_uid').in_('id', user_ids).neq('wx_uid', 'null').execute()
-            uids = [p['wx_uid'] for p in profiles.data if p.get('wx_uid')]
-
-            if not uids:
-                print("该家庭无人绑定微信 UID，跳过推送")
-                return
-
-            # 2. 发送请求 (uids 列表)
-            url = "https://wxpusher.zjiecode.com/api/send/message"
-            payload = {
-                "appToken": wx_app_token,
-                "content": content,
-                "summary": summary,
-                "contentType": 1,
-                "uids": uids  # [修改] 这里变成了 uids 数组
-            }
-            requests.post(url, json=payload, timeout=5)
-            print(f"✅ 推送成功，接收人数: {len(uids)}")
-
-        except Exception as e:
-            print(f"Push Error: {e}")
-
-    threading.Thread(target=_do_push).start()
 
 def send_private_wechat_push(target_user_id, summary, content):
     """
@@ -566,35 +1254,266 @@ def send_private_wechat_push(target_user_id, summary, content):
     只发给指定用户，不打扰全家
     """
     if not wx_app_token or not target_user_id: return
+    jobs.enqueue('push_private_wechat', target_user_id, summary, content)
+
+
+def _post_wxpusher(uids, summary, content):
+    """调 WxPusher 发消息，对方确认收到才返回 True"""
+    url = "https://wxpusher.zjiecode.com/api/send/message"
+    payload = {
+        "appToken": wx_app_token,
+        "content": content,
+        "summary": summary,
+        "contentType": 1,
+        "uids": uids
+    }
+    # 只有确定对方没收到 (连不上) 或服务端 5xx 才抛出去让任务队列重试；
+    # 读超时时消息可能已经发出去了，WxPusher 没有去重，重试会让家人收到两遍，所以只记日志
+    try:
+        resp = requests.post(url, json=payload, timeout=5)
+    except requests.exceptions.ReadTimeout:
+        print(f"⚠️ 微信推送读超时，不确定是否已送达，不再重试: {summary}")
+        return False
+    if resp.status_code >= 500: resp.raise_for_status()
+    try:
+        result = resp.json()
+    except ValueError:
+        result = {}
+    # WxPusher 的业务错误 (appToken 失效、uid 不存在等) 也是 HTTP 200，要看 JSON 里的 code
+    if resp.status_code != 200 or result.get('code') != 1000:
+        print(f"❌ 微信推送失败: HTTP {resp.status_code} {result.get('code')} {result.get('msg')}")
+        return False
+    return True
+
+
+@jobs.task(queue='push')
+def push_family_wechat(family_id, summary, content):
+    """后台任务：推送给家庭里所有绑定了微信 UID 的人"""
+    # 这里需要管理员权限(admin_supabase)或者确保 RLS 允许读取成员的 profile
+    client = admin_supabase if admin_supabase else supabase
+
+    # A. 查出家庭成员 ID
+    mems = client.table('family_members').select('user_id').eq('family_id', family_id).execute()
+    user_ids = [m['user_id'] for m in mems.data] if mems.data else []
+
+    if not user_ids: return
+
+    # B. 查出这些成员的 wx_uid
+    # 过滤掉没有填 UID 的人
+    profiles = client.table('profiles').select('wx_uid').in_('id', user_ids).neq('wx_uid', 'null').execute()
+    uids = [p['wx_uid'] for p in profiles.data if p.get('wx_uid')]
+
+    if not uids:
+        print("该家庭无人绑定微信 UID，跳过推送")
+        return
 
-    def _do_push():
+    if _post_wxpusher(uids, summary, content):
+        print(f"✅ 推送成功，接收人数: {len(uids)}")
+
+
+@jobs.task(queue='push')
+def push_private_wechat(target_user_id, summary, content):
+    """后台任务：只推送给一个人"""
+    # 这里用 admin 权限查，确保能查到
+    client = admin_supabase if admin_supabase else supabase
+    res = client.table('profiles').select('wx_uid').eq('id', target_user_id).maybe_single().execute()
+
+    if res and res.data and res.data.get('wx_uid'):
+        uids = [res.data['wx_uid']]
+        if _post_wxpusher(uids, summary, content):
+            print(f"✅ 私密推送成功: {uids}")
+    else:
+        print("❌ 目标用户未绑定微信 UID")
+
+# ================= 实时提醒推送 (SSE) =================
+# 写入 family_reminders 后通过 Redis 频道广播，在线的家人通过 /api/reminders/stream 实时收到
+# 生产环境多个 gunicorn worker 共享 Redis pub/sub；本地无 Redis 时退回进程内队列
+REMINDER_CHANNEL_PREFIX = 'family:reminders:'
+REMINDER_HEARTBEAT_SECONDS = 25  # 心跳间隔，防止 Nginx/手机网络掐断空闲连接
+REMINDER_STREAM_MAX_SECONDS = 300  # 单条连接最长保持时间，到点后浏览器会自动重连
+
+_local_reminder_subscribers = []  # [(channels, Queue), ...]
+_local_reminder_lock = threading.Lock()
+
+
+def publish_family_reminder(row):
+    """把一条刚写入的提醒广播到该家庭的频道"""
+    if not row or not row.get('family_id'): return
+    channel = f"{REMINDER_CHANNEL_PREFIX}{row['family_id']}"
+    payload = json.dumps(row, ensure_ascii=False, default=str)
+
+    if redis_client:
         try:
-            # 1. 查这个人的 Wx UID
-            # 这里用 admin 权限查，确保能查到
-            client = admin_supabase if admin_supabase else supabase
-            res = client.table('profiles').select('wx_uid').eq('id', target_user_id).single().execute()
-
-            if res.data and res.data.get('wx_uid'):
-                uids = [res.data['wx_uid']]
-
-                # 2. 发送
-                url = "https://wxpusher.zjiecode.com/api/send/message"
-                payload = {
-                    "appToken": wx_app_token,
-                    "content": content,
-                    "summary": summary,
-                    "contentType": 1,
-                    "uids": uids  # 只发给他一个人
-                }
-                requests.post(url, json=payload, timeout=5)
-                print(f"✅ 私密推送成功: {uids}")
-            else:
-                print("❌ 目标用户未绑定微信 UID")
+            redis_client.publish(channel, payload)
+        except Exception as e:
+            print(f"Reminder Publish Error: {e}")
+        return
+
+    with _local_reminder_lock:
+        for channels, q in _local_reminder_subscribers:
+            if channel in channels: q.put(payload)
+
+
+def insert_family_reminder(client, data):
+    """写入家庭提醒 (留言板/拍一拍/兑换券通知) 并实时推送给在线家人"""
+    res = client.table('family_reminders').insert(data).execute()
+    for row in (res.data or []):
+        publish_family_reminder(row)
+    return res
+
+
+def listen_family_reminders(family_ids):
+    """
+    订阅若干家庭的提醒频道
+    生成器：收到消息时 yield JSON 字符串，空闲满一个心跳周期时 yield None
+    """
+    channels = {f"{REMINDER_CHANNEL_PREFIX}{fid}" for fid in family_ids}
+    deadline = time.monotonic() + REMINDER_STREAM_MAX_SECONDS
+
+    if redis_client:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*channels)
+        try:
+            last_beat = time.monotonic()
+            while time.monotonic() < deadline:
+                msg = pubsub.get_message(timeout=REMINDER_HEARTBEAT_SECONDS)
+                if msg and msg.get('type') == 'message':
+                    data = msg['data']
+                    yield data.decode('utf-8') if isinstance(data, bytes) else data
+                    last_beat = time.monotonic()
+                elif time.monotonic() - last_beat >= REMINDER_HEARTBEAT_SECONDS:
+                    yield None
+                    last_beat = time.monotonic()
+        finally:
+            pubsub.close()
+        return
+
+    q = queue.Queue()
+    entry = (channels, q)
+    with _local_reminder_lock:
+        _local_reminder_subscribers.append(entry)
+    try:
+        while time.monotonic() < deadline:
+            try:
+                yield q.get(timeout=REMINDER_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield None
+    finally:
+        with _local_reminder_lock:
+            _local_reminder_subscribers.remove(entry)
+
+
+# ================= 频率限制 (Rate Limit) =================
+# 基于共享 Redis 的原子 "检查 + 计数"，一次 Redis 调用完成，不再查库解析时间
+# 本地无 Redis 时退回进程内计数 (只在单进程开发服务器里准确)
+# Redis 故障时放行 (fail-open)，不因为限流挂掉主流程
+
+# 各功能的默认额度: (次数, 窗口秒数, 是否滑动窗口)
+RATE_LIMITS = {
+    'nudge': (5, 60, True),  # 拍一拍：每人每分钟最多 5 下
+    'coupon': (10, 3600, True),  # 发券：每人每小时最多 10 批
+    'ask_vet': (20, 3600, True),  # AI 兽医：每人每小时最多 20 问
+}
+
+# 固定窗口：没到上限才 +1，首次计数时设置过期
+_FIXED_WINDOW_LUA = """
+local c = tonumber(redis.call('GET', KEYS[1]) or '0')
+if c >= tonumber(ARGV[1]) then return 0 end
+c = redis.call('INCR', KEYS[1])
+if c == 1 then redis.call('EXPIRE', KEYS[1], ARGV[2]) end
+return 1
+"""
+
+# 滑动窗口：有序集合记录每次命中的毫秒时间戳，先清掉窗口外的再数
+_SLIDING_WINDOW_LUA = """
+local now = tonumber(ARGV[3])
+local window_ms = tonumber(ARGV[2]) * 1000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - window_ms)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then return 0 end
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('PEXPIRE', KEYS[1], window_ms)
+return 1
+"""
+
+_rate_limit_scripts = {}
+_local_rate_limits = {}  # key -> 计数 (固定窗口) 或 时间戳列表 (滑动窗口)
+_local_rate_limit_lock = threading.Lock()
+
 
+def _rate_limit_key(name, ident, window, sliding, bucket, now):
+    if sliding: return f"ratelimit:{name}:{ident}"
+    return f"ratelimit:{name}:{ident}:{bucket if bucket is not None else int(now // window)}"
+
+
+def rate_limit_hit(name, ident, limit, window, sliding=False, bucket=None):
+    """
+    原子地检查并记一次：没超限返回 True (已计数)，超限返回 False
+    name: 功能名，ident: 限流对象 (如 "家庭ID:用户ID")
+    bucket: 固定窗口的自定义分桶 (如北京时间日期，实现 "每天" 而不是 "24小时")
+    """
+    now = time.time()
+    key = _rate_limit_key(name, ident, window, sliding, bucket, now)
+
+    if redis_client:
+        try:
+            kind = 'sliding' if sliding else 'fixed'
+            script = _rate_limit_scripts.get(kind)
+            if script is None:
+                script = redis_client.register_script(_SLIDING_WINDOW_LUA if sliding else _FIXED_WINDOW_LUA)
+                _rate_limit_scripts[kind] = script
+            if sliding:
+                now_ms = int(now * 1000)
+                member = f"{now_ms}-{random.getrandbits(32)}"
+                return bool(script(keys=[key], args=[limit, window, now_ms, member]))
+            return bool(script(keys=[key], args=[limit, window]))
+        except Exception as e:
+            print(f"Rate Limit Error: {e}")
+            return True
+
+    with _local_rate_limit_lock:
+        if sliding:
+            hits = [t for t in _local_rate_limits.get(key, []) if t > now - window]
+            if len(hits) >= limit:
+                _local_rate_limits[key] = hits
+                return False
+            hits.append(now)
+            _local_rate_limits[key] = hits
+            return True
+
+        # 顺手清理已经过期的固定窗口 (key 数量本来就很少)
+        if len(_local_rate_limits) > 10000: _local_rate_limits.clear()
+        count = _local_rate_limits.get(key, 0)
+        if count >= limit: return False
+        _local_rate_limits[key] = count + 1
+        return True
+
+
+def rate_limit_release(name, ident, window, bucket=None):
+    """
+    [新增] 退回 rate_limit_hit 记的一次 (只支持固定窗口)
+    先原子占名额防并发，后面的操作失败了再还回去，不让用户白白被锁一整个窗口
+    """
+    key = _rate_limit_key(name, ident, window, False, bucket, time.time())
+    if redis_client:
+        try:
+            if redis_client.decr(key) <= 0: redis_client.delete(key)
         except Exception as e:
-            print(f"Private Push Error: {e}")
+            print(f"Rate Limit Release Error: {e}")
+        return
+
+    with _local_rate_limit_lock:
+        count = _local_rate_limits.get(key, 0)
+        if count > 1:
+            _local_rate_limits[key] = count - 1
+        else:
+            _local_rate_limits.pop(key, None)
+
+
+def check_rate_limit(name, ident):
+    """按 RATE_LIMITS 里的默认额度限流"""
+    limit, window, sliding = RATE_LIMITS[name]
+    return rate_limit_hit(name, ident, limit, window, sliding=sliding)
 
-    threading.Thread(target=_do_push).start()
 
 # ================= [核心] 数据库连接获取 =================
 # ================= [核心修复] 数据库连接获取 (带自动续命功能) =================
@@ -808,6 +1727,55 @@ def logout():
     return redirect(url_for('login'))
 
 
+# ================= 首页数据组装 =================
+
+def summarize_pets(pets, logs, families, user_map, pet_owners_map, current_user_id, is_impersonator=False):
+    """
+    给宠物卡片补上 今日喂食/遛狗/照片 状态 (原地修改 pets)
+    logs 需按 created_at 倒序：先把日志按 pet_id 分桶，再逐只宠物取最新一条，
+    总耗时 O(宠物数 + 日志数)，时间也只给真正显示的那一条格式化
+    """
+    fam_name_map = {f['id']: f['name'] for f in families}
+    logs_by_pet = {}
+    for log in logs:
+        logs_by_pet.setdefault(log['pet_id'], []).append(log)
+
+    now = datetime.now(timezone.utc)
+
+    def who(log):
+        return user_map.get(log['user_id'], {}).get('name', '家人')
+
+    for pet in pets:
+        pet['today_feed'] = False
+        pet['today_walk'] = False
+        pet['feed_info'] = ""
+        pet['walk_info'] = ""
+        pet['latest_photo'] = None
+        pet['photo_uploader'] = ""
+        pet['photo_count'] = 0
+
+        pet['owner_ids'] = pet_owners_map.get(pet['id'], [])
+        pet['is_owner'] = (current_user_id in pet['owner_ids']) or is_impersonator
+        pet['family_name'] = fam_name_map.get(pet['family_id'], "")
+
+        for log in logs_by_pet.get(pet['id'], ()):
+            action = log['action']
+            if action == 'feed':
+                pet['today_feed'] = True
+                if not pet['feed_info']:
+                    pet['feed_info'] = f"{who(log)} ({format_time_friendly(log['created_at'], now)})"
+            elif action == 'walk':
+                pet['today_walk'] = True
+                if not pet['walk_info']:
+                    pet['walk_info'] = f"{who(log)} ({format_time_friendly(log['created_at'], now)})"
+            elif action == 'photo':
+                pet['photo_count'] += 1
+                if not pet['latest_photo'] and log.get('image_path'):
+                    pet['latest_photo'] = f"{url}/storage/v1/object/public/family_photos/{log['image_path']}"
+                    pet['photo_uploader'] = who(log)
+    return pets
+
+
 # ================= 核心业务路由 (Home/Action) =================
 
 # --- 修改后的 home 函数 ---
@@ -931,13 +1899,14 @@ def home():
         if not f.get('last_weather_update'):
             need_update = True
         else:
-            try:
-                last_t = datetime.fromisoformat(f.get('last_weather_update').replace('Z', '+00:00'))
-                if (utc_now - last_t) > timedelta(minutes=30): need_update = True
-            except:
-                need_update = True
-
-        if need_update:
+            last_t = parse_iso(f.get('last_weather_update'))
+            if not last_t or (utc_now - last_t) > timedelta(minutes=30): need_update = True
+
+        if need_update and admin_supabase and (f['weather_home'] or f['weather_away']):
+            # [优化] 已有缓存：这次先显示旧天气，后台任务去和风天气拉新的 (同一家庭 5 分钟内只排一次)
+            jobs.enqueue_once(f"weather:{f['id']}", 300, 'refresh_family_weather', f['id'])
+        elif need_update:
+            # 第一次还没有任何天气数据，只能当场拉
             nh = get_weather_full(f.get('location_home_id'), f.get('location_home_lat'), f.get('location_home_lon'))
             na = get_weather_full(f.get('location_away_id'), f.get('location_away_lat'), f.get('location_away_lon'))
             if nh: f['weather_home'] = nh
@@ -997,11 +1966,7 @@ def home():
                     continue
 
                 # 时间格式化
-                try:
-                    dt_utc = datetime.fromisoformat(r['created_at'].replace('Z', '+00:00'))
-                    r['time_display'] = dt_utc.astimezone(timezone(timedelta(hours=8))).strftime('%H:%M')
-                except:
-                    r['time_display'] = ""
+                r['time_display'] = format_bj(r.get('created_at'), '%H:%M')
 
                 valid_rems.append(r)
 
@@ -1101,64 +2066,42 @@ def home():
 
     # ================= 5. 数据二次组装 (前端渲染用) =================
 
-    # A. 宠物
-    for pet in pets:
-        pet['today_feed'] = False;
-        pet['today_walk'] = False
-        pet['feed_info'] = "";
-        pet['walk_info'] = ""
-        pet['latest_photo'] = None;
-        pet['photo_uploader'] = "";
-        pet['photo_count'] = 0
-
-        pet['owner_ids'] = pet_owners_map.get(pet['id'], [])
-        pet['is_owner'] = (current_user_id in pet['owner_ids']) or session.get('is_impersonator')
-
-        fam_obj = next((f for f in my_families if f['id'] == pet['family_id']), None)
-        pet['family_name'] = fam_obj['name'] if fam_obj else ""
-
-        for log in logs:
-            if log['pet_id'] == pet['id']:
-                who = user_map.get(log['user_id'], {}).get('name', '家人')
-                time_s = format_time_friendly(log['created_at'])
-                if log['action'] == 'feed':
-                    pet['today_feed'] = True
-                    if not pet['feed_info']: pet['feed_info'] = f"{who} ({time_s})"
-                elif log['action'] == 'walk':
-                    pet['today_walk'] = True
-                    if not pet['walk_info']: pet['walk_info'] = f"{who} ({time_s})"
-                elif log['action'] == 'photo':
-                    pet['photo_count'] += 1
-                    if not pet['latest_photo'] and log.get('image_path'):
-                        pet['latest_photo'] = f"{url}/storage/v1/object/public/family_photos/{log['image_path']}"
-                        pet['photo_uploader'] = who
+    # A. 宠物 (日志按 pet_id 分桶，一次遍历完成)
+    summarize_pets(pets, logs, my_families, user_map, pet_owners_map,
+                   current_user_id, session.get('is_impersonator'))
 
     # B. 动态 (加点赞人)
     moments = []
+    format_rows(moments_data)  # 批量生成 time_str
     for m in moments_data:
         # 基本信息
         u_info = user_map.get(m['user_id'], {})
         m['user_name'] = u_info.get('name', '家人')
         m['user_avatar'] = u_info.get('avatar')
-        m['time_str'] = format_time_friendly(m['created_at'])
         if m.get('image_path'):
             m['image_url'] = f"{url}/storage/v1/object/public/family_photos/{m['image_path']}"
 
-        # 点赞信息
+        # 点赞信息 (下面一次性批量查出)
+        m['likers'] = []
+        m['is_liked'] = False
+        moments.append(m)
+
+    # [优化] 点赞人一次查完；like_count 为 0 的动态直接跳过，不用再逐条查 moment_likes
+    liked_ids = [m['id'] for m in moments if m.get('like_count', 1) > 0]
+    if liked_ids:
         try:
-            likes_res = db.table('moment_likes').select('user_id').eq('moment_id', m['id']).execute()
-            likes_data = likes_res.data or []
-            m['likers'] = []
-            m['is_liked'] = False
-            for l in likes_data:
+            moment_by_id = {m['id']: m for m in moments}
+            likes_res = db.table('moment_likes').select('moment_id, user_id').in_('moment_id', liked_ids).execute()
+            for l in (likes_res.data or []):
+                m = moment_by_id.get(l['moment_id'])
+                if not m: continue
                 uid = l['user_id']
                 if uid == current_user_id: m['is_liked'] = True
                 if uid in user_map: m['likers'].append(user_map[uid])
-            m['like_count'] = len(m['likers'])
-        except:
-            pass
-
-        moments.append(m)
+        except Exception as e:
+            print(f"Likes Error: {e}")
+    for m in moments:
+        if 'like_count' not in m: m['like_count'] = len(m['likers'])
 
     # 6. 获取更新日志
     latest_update = None
@@ -1212,23 +2155,13 @@ def pet_detail(pet_id):
 
             photos = logs_res.data or []
 
-            # 补全图片URL + [新增] 转换显示时间
+            # 补全图片URL
             for p in photos:
                 if p.get('image_path'):
                     p['url'] = f"{url}/storage/v1/object/public/family_photos/{p['image_path']}"
-                # [新增] UTC -> 北京时间
-                try:
-                    # 解析数据库时间
-                    dt_utc = datetime.fromisoformat(p['created_at'].replace('Z', '+00:00'))
-                    # 转北京时间
-                    dt_bj = dt_utc.astimezone(timezone(timedelta(hours=8)))
-                    # 存一个新的字段用于显示 (格式: 2025-12-16 10:30)
-                    p['display_time'] = dt_bj.strftime('%Y-%m-%d %H:%M')
-                    # 也可以只存日期用于拍立得底部
-                    p['display_date'] = dt_bj.strftime('%Y-%m-%d')
-                except:
-                    p['display_time'] = "时间未知"
-                    p['display_date'] = "Unknown"
+            # [新增] UTC -> 北京时间 (格式: 2025-12-16 10:30，拍立得底部只显示日期)
+            format_rows(photos, target='display_time', fmt='%Y-%m-%d %H:%M', default="时间未知")
+            format_rows(photos, target='display_date', fmt='%Y-%m-%d', default="Unknown")
 
             # 智能决定封面：有设定用设定，没设定用最新照片
             if cover_path:
@@ -1237,7 +2170,7 @@ def pet_detail(pet_id):
                 pet['cover_url'] = photos[0]['url']
             else:
                 # 默认封面 (可以是网图或者本地图)
-                pet['cover_url'] = "/static/default_cover.png"  # 暂时用个占位，或者前端CSS处理
+                pet['cover_url'] = url_for('static', filename='default_cover.png')  # 暂时用个占位，或者前端CSS处理
 
             pet['photos'] = photos
 
@@ -1428,7 +2361,7 @@ def delete_log(log_id):
         if res.data:
             rec = res.data[0]
             if rec['user_id'] == session['user']:
-                if rec.get('image_path'): db.storage.from_("family_photos").remove(rec['image_path'])
+                remove_photos(db, rec.get('image_path'))
                 db.table('logs').delete().eq('id', log_id).execute()
     except:
         pass
@@ -1444,7 +2377,7 @@ def delete_moment(mid):
         if res.data:
             rec = res.data[0]
             if rec['user_id'] == session['user']:
-                if rec.get('image_path'): db.storage.from_("family_photos").remove(rec['image_path'])
+                remove_photos(db, rec.get('image_path'))
                 db.table('moments').delete().eq('id', mid).execute()
     except:
         pass
@@ -1533,58 +2466,29 @@ def send_family_reminder():
     try:
         current_user_id = session['user']
 
-        # [修改] 频率限制逻辑：只查“我自己”在这个家庭发的最新一条
-        last_rem = db.table('family_reminders') \
-            .select('created_at, content') \
-            .eq('family_id', family_id) \
-            .eq('created_by', current_user_id) \
-            .order('created_at', desc=True) \
-            .limit(5) \
-            .execute()
-
-        if last_rem.data:
-            for rem in last_rem.data:
-                # [核心修复] 如果这条记录是"拍一拍"或者是"兑换券"通知，跳过，不计入冷却
-                if "拍了拍" in rem['content'] or "给你发了" in rem['content'] or "作废" in rem['content']:
-                    continue
-            # [核心修复] 手动解析时间，防止毫秒位数不对导致报错
-                try:
-                    raw_time = last_rem.data[0]['created_at']
-                    # 1. 简单粗暴：只截取前19位 (YYYY-MM-DDTHH:MM:SS)
-                    # 这样就丢掉了 ".63411+00:00" 这种可能导致报错的尾巴
-                    clean_time = raw_time[:19]
-                    # 2. 解析为时间对象
-                    dt_obj = datetime.strptime(clean_time, '%Y-%m-%dT%H:%M:%S')
-
-                    # 3. 补上 UTC 时区 (因为数据库存的是 UTC)
-                    dt_utc = dt_obj.replace(tzinfo=timezone.utc)
-
-                    # 4. 转为北京时间
-                    last_date = dt_utc.astimezone(timezone(timedelta(hours=8))).date()
-
-                    # 5. 获取今天日期
-                    today_date = datetime.now(timezone(timedelta(hours=8))).date()
-
-                # 6. 比对
-                    if last_date == today_date:
-                        flash("你今天在这个家已经发过提醒啦 (每人每天限1条)", "info")
-                        return redirect(url_for('home'))
-                    break
-
-                except Exception as e:
-                    print(f"Time Parse Error: {e}")
-                    pass
+        # [修改] 频率限制：每人每个家庭每天 (北京时间) 1 条，一次 Redis 原子操作搞定
+        # 拍一拍/兑换券通知走各自的路由，本来就不计入这里的冷却
+        today_str = get_beijing_time().strftime('%Y-%m-%d')
+        limit_ident = f"{family_id}:{current_user_id}"
+        if not rate_limit_hit('reminder', limit_ident, 1, 86400, bucket=today_str):
+            flash("你今天在这个家已经发过提醒啦 (每人每天限1条)", "info")
+            return redirect(url_for('home'))
 
         # ... (插入逻辑) ...
         sender_name = session.get('display_name', '家人')
 
         # [修改] 插入时带上 created_by
-        db.table('family_reminders').insert({
-            'family_id': family_id,
-            'content': content,
-            'sender_name': sender_name,
-            'created_by': current_user_id  # <--- 关键：记录是谁发的
-        }).execute()
+        try:
+            insert_family_reminder(db, {
+                'family_id': family_id,
+                'content': content,
+                'sender_name': sender_name,
+                'created_by': current_user_id  # <--- 关键：记录是谁发的
+            })
+        except Exception:
+            # 没写进去就把今天的名额还回去，不然要被锁到明天
+            rate_limit_release('reminder', limit_ident, 86400, bucket=today_str)
+            raise
 
         # 微信推送
         send_wechat_push(
@@ -1599,6 +2503,54 @@ def send_family_reminder():
     return redirect(url_for('home'))
 
 
+@app.route('/api/reminders/stream')
+@login_required
+def reminder_stream():
+    """
+    [SSE] 实时提醒通道
+    推送 "发给我的" 或 "公开的" 新提醒，前端用 EventSource 接收，不用再刷新整页
+    """
+    db = get_db()
+    if db is None: return Response(status=401)
+    current_user_id = session['user']
+
+    family_ids = []
+    try:
+        mems = db.table('family_members').select('family_id').eq('user_id', current_user_id).execute()
+        family_ids = [m['family_id'] for m in (mems.data or [])]
+    except Exception as e:
+        print(f"Reminder Stream Error: {e}")
+
+    def generate():
+        if not family_ids:
+            # 还没加入家庭，告诉浏览器过一分钟再来
+            yield "retry: 60000\n\n"
+            return
+
+        yield "retry: 5000\n\n"
+        for payload in listen_family_reminders(family_ids):
+            if payload is None:
+                yield ": ping\n\n"
+                continue
+            try:
+                r = json.loads(payload)
+            except ValueError:
+                continue
+
+            # 与首页同样的过滤规则：有目标人且不是我 -> 跳过
+            target = r.get('target_user_id')
+            if target and target != current_user_id: continue
+
+            r['time_display'] = format_bj(r.get('created_at'), '%H:%M')
+
+            yield f"event: reminder\ndata: {json.dumps(r, ensure_ascii=False)}\n\n"
+
+    resp = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'  # 关闭 Nginx 缓冲，否则消息会被攒着不发
+    return resp
+
+
 @app.route('/create_family', methods=['POST'])
 @login_required
 def create_family():
@@ -1727,7 +2679,7 @@ def update_profile():
             old_prof = db.table('profiles').select('avatar_url').eq('id', session['user']).single().execute()
             if old_prof.data and old_prof.data.get('avatar_url'):
                 try:
-                    db.storage.from_("family_photos").remove(old_prof.data['avatar_url'])
+                    remove_photos(db, old_prof.data['avatar_url'])
                 except:
                     pass  # 删失败也不影响新头像
 
@@ -1741,6 +2693,7 @@ def update_profile():
 
     try:
         db.table('profiles').update(update_data).eq('id', session['user']).execute()
+        invalidate_snake_profile(session['user'])  # [新增] 排行榜上的名字/头像跟着更新
         flash("设置已更新", "success")
     except Exception as e:
         flash(f"更新失败: {e}", "danger")
@@ -1922,24 +2875,9 @@ def admin_dashboard():
                 else:
                     storage_breakdown['other'] += size
 
-                raw_time = f.get('created_at', '')
-                fmt_time = raw_time
-                try:
-                    if raw_time:
-                        # 1. 解析字符串为时间对象 (处理结尾的 Z)
-                        if raw_time.endswith('Z'):
-                            dt_utc = datetime.fromisoformat(raw_time.replace('Z', '+00:00'))
-                        else:
-                            dt_utc = datetime.fromisoformat(raw_time)
-
-                        # 2. 转为北京时间 (UTC+8)
-                        dt_bj = dt_utc.astimezone(timezone(timedelta(hours=8)))
-
-                        # 3. 格式化为字符串
-                        fmt_time = dt_bj.strftime('%Y-%m-%d %H:%M:%S')
-                except Exception as e:
-                    # 如果解析失败，回退到简单截取
-                    fmt_time = raw_time[:19].replace('T', ' ')
+                # 转为北京时间，解析失败回退到简单截取
+                raw_time = f.get('created_at') or ''
+                fmt_time = format_bj(raw_time, '%Y-%m-%d %H:%M:%S', raw_time[:19].replace('T', ' '))
 
                 uploader = file_owner.get(name)
                 uploader_str = f"✅ {uploader}" if uploader else '⚠️ 无记录'
@@ -1987,6 +2925,16 @@ def admin_dashboard():
     except:
         pass
 
+    # [新增] 近 7 天 AI 用量
+    ai_usage = summarize_ai_usage([])
+    try:
+        # 在库里按 (日期, 模型) 聚合好再取 (见 sql/003_ai_usage.sql)，不受 PostgREST 返回行数上限影响
+        since = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
+        usage_rows = client.rpc('ai_usage_summary', {'p_since': since}).execute().data or []
+        ai_usage = summarize_ai_usage(usage_rows)
+    except Exception as e:
+        print(f"AI Usage Summary Error: {e}")
+
     return render_template('admin.html',
                            users=users,  # 用户列表
                            pets=pets,  # 宠物列表 (含主人信息)
@@ -1999,7 +2947,9 @@ def admin_dashboard():
                            user_name=session.get('display_name'),
                            food_list=food_list,
                            ai_models=ai_models,
-                           ai_config=ai_config)
+                           ai_config=ai_config,
+                           ai_cache_stats=get_ai_answer_stats(),
+                           ai_usage=ai_usage)
 
 # 3. 新增 API: 获取服务器实时状态
 @app.route('/api/server_stats')
@@ -2013,7 +2963,10 @@ def api_server_stats():
             'cpu': cpu,
             'memory': memory.percent,
             'memory_used': round(memory.used / 1024 / 1024, 1), # MB
-            'memory_total': round(memory.total / 1024 / 1024, 1) # MB
+            'memory_total': round(memory.total / 1024 / 1024, 1), # MB
+            'templates': get_template_stats(),  # [新增] 模板渲染耗时 (本进程)
+            'routes': get_route_metrics(),  # [新增] 各接口耗时/错误率/处理中 (所有 worker)
+            'jobs': jobs.stats()  # [新增] 后台任务队列积压/失败/死信
         })
     except:
         return jsonify({'cpu': 0, 'memory': 0})
@@ -2081,6 +3034,7 @@ def admin_delete_user(uid):
         admin_supabase.table('moments').delete().eq('user_id', uid).execute()
         admin_supabase.table('logs').delete().eq('user_id', uid).execute()
         admin_supabase.table('profiles').delete().eq('id', uid).execute()
+        invalidate_snake_profile(uid, deleted=True)  # [新增] 从贪吃蛇排行榜上移除
         admin_supabase.auth.admin.delete_user(uid)
         flash("用户及其数据已清除", "success")
     except Exception as e:
@@ -2509,19 +3463,23 @@ def nudge_member():
 
     if not target_uid or not family_id: return redirect(url_for('home'))
 
+    if not check_rate_limit('nudge', session['user']):
+        flash("手下留情，拍得太频繁啦，歇一会儿再拍~", "info")
+        return redirect(url_for('home'))
+
     try:
         my_name = session.get('display_name', '我')
         msg = f"👋 {my_name} 拍了拍 {target_name}"
 
         # 1. 写入家庭留言板 (App内显示)
         # [修改] 增加 target_user_id，用于生成亲密引力场
-        db.table('family_reminders').insert({
+        insert_family_reminder(db, {
             'family_id': family_id,
             'content': msg,
             'sender_name': '系统',
             'created_by': session['user'],
             'target_user_id': target_uid  # <--- 关键新增
-        }).execute()
+        })
 
         # 2. 发送微信推送 (保持不变)
         send_wechat_push(
@@ -2573,8 +3531,63 @@ def delete_family_event():
     return redirect(url_for('home'))
 
 
-@app.errorhandler(404)
-def page_not_found(e):
+@app.route('/api/upcoming_events')
+@login_required
+def get_upcoming_events():
+    """
+    [新增] 我所有家庭里即将到来的纪念日/倒计时 (批量，一次查完)
+    参数 days: 只返回多少天以内的，默认 30
+    """
+    db = get_db()
+    if db is None: return jsonify([])
+
+    try:
+        within_days = max(0, min(int(request.args.get('days', 30)), 366))
+    except ValueError:
+        within_days = 30
+
+    try:
+        mems = db.table('family_members').select('family_id').eq('user_id', session['user']).execute()
+        family_ids = [m['family_id'] for m in (mems.data or [])]
+        if not family_ids: return jsonify([])
+
+        fams = db.table('families').select('id, name, reunion_name, reunion_date').in_('id', family_ids).execute()
+        fam_map = {f['id']: f for f in (fams.data or [])}
+        events = db.table('family_events').select('*').in_('family_id', family_ids).execute().data or []
+
+        bj_today = datetime.now(timezone(timedelta(hours=8))).date()
+        result = []
+
+        # 1. 归家倒计时
+        for f in fam_map.values():
+            if not f.get('reunion_date'): continue
+            try:
+                days = (datetime.strptime(f['reunion_date'], '%Y-%m-%d').date() - bj_today).days
+            except ValueError:
+                continue
+            if 0 <= days <= within_days:
+                result.append({'family_id': f['id'], 'family_name': f['name'],
+                               'title': f.get('reunion_name') or '团圆', 'type': 'reunion', 'is_lunar': False,
+                               'days': days, 'date_str': f['reunion_date']})
+
+        # 2. 家庭大事记 (走缓存)
+        for e in events:
+            calc = calculate_event_details(e)
+            if not calc or not (0 <= calc['days'] <= within_days): continue
+            fam = fam_map.get(e['family_id'], {})
+            result.append({'id': e['id'], 'family_id': e['family_id'], 'family_name': fam.get('name', ''),
+                           'title': e['title'], 'type': 'event', 'is_lunar': e['event_type'] == 'lunar',
+                           'days': calc['days'], 'date_str': calc['date_str']})
+
+        result.sort(key=lambda x: x['days'])
+        return jsonify(result)
+    except Exception as e:
+        print(f"Upcoming Events Error: {e}")
+        return jsonify([])
+
+
+@app.errorhandler(404)
+def page_not_found(e):
     return render_template('404.html'), 404
 
 
@@ -2584,16 +3597,138 @@ def internal_server_error(e):
 
 
 # ================= 🐍 贪吃蛇排行榜接口 =================
+# 排行榜放在 Redis 有序集合里：ZADD GT 原子地只保留最高分，读榜只要一次 Redis 调用
+# 新纪录先记进 dirty 集合，由后台任务队列定期批量写回 profiles.snake_high_score 做持久化
+# 没有 Redis 时退回直接读写 profiles 表
+SNAKE_BOARD_KEY = 'snake:leaderboard'  # ZSET user_id -> 最高分
+SNAKE_PROFILE_KEY = 'snake:profiles'  # HASH user_id -> {"display_name", "avatar_url"}
+SNAKE_DIRTY_KEY = 'snake:dirty'  # SET 待写回数据库的 user_id
+SNAKE_SEEDED_KEY = 'snake:seeded'  # 标记：已从 profiles 导入过历史分数
+SNAKE_FLUSH_INTERVAL = 300  # 写回间隔 (秒)
+SNAKE_TOP_N = 20
+
+# 一次调用取前 N 名 + 名字头像；还没导入历史数据时返回 nil
+_SNAKE_TOP_LUA = """
+if redis.call('EXISTS', KEYS[3]) == 0 then return false end
+local top = redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1, 'WITHSCORES')
+local out = {}
+for i = 1, #top, 2 do
+    table.insert(out, top[i])
+    table.insert(out, top[i + 1])
+    table.insert(out, redis.call('HGET', KEYS[2], top[i]) or '')
+end
+return out
+"""
+_snake_top_script = None
+
+
+def _snake_profile_json(p):
+    return json.dumps({'display_name': p.get('display_name'), 'avatar_url': p.get('avatar_url')},
+                      ensure_ascii=False)
+
+
+def invalidate_snake_profile(user_id, deleted=False):
+    """改名/换头像后清掉缓存的名字头像 (下次读榜补查)；删号时连同分数一起从榜上去掉"""
+    if not redis_client: return
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hdel(SNAKE_PROFILE_KEY, user_id)
+        if deleted:
+            pipe.zrem(SNAKE_BOARD_KEY, user_id)
+            pipe.srem(SNAKE_DIRTY_KEY, user_id)
+        pipe.execute()
+    except Exception as e:
+        print(f"Snake Cache Invalidate Error: {e}")
+
+
+def ensure_snake_board(force=False):
+    """首次使用 (或 Redis 清空后) 从 profiles 导入历史最高分"""
+    if not force and redis_client.exists(SNAKE_SEEDED_KEY): return
+    # 多个 worker 同时发现为空时，只让一个去导
+    if not redis_client.set('snake:seed_lock', 1, nx=True, ex=30): return
+
+    client = admin_supabase if admin_supabase else supabase
+    rows = client.table('profiles') \
+        .select('id, display_name, avatar_url, snake_high_score') \
+        .gt('snake_high_score', 0) \
+        .execute().data or []
+
+    pipe = redis_client.pipeline()
+    if rows:
+        pipe.zadd(SNAKE_BOARD_KEY, {r['id']: r['snake_high_score'] for r in rows}, gt=True)
+        pipe.hset(SNAKE_PROFILE_KEY, mapping={r['id']: _snake_profile_json(r) for r in rows})
+    pipe.set(SNAKE_SEEDED_KEY, 1)
+    pipe.execute()
+    print(f"🐍 排行榜已从数据库导入 {len(rows)} 条记录")
+
+
+@jobs.task()
+def flush_snake_scores():
+    """把 Redis 里的新纪录写回 profiles (持久化)"""
+    if not redis_client: return 0
+    client = admin_supabase if admin_supabase else supabase
+    uids = redis_client.spop(SNAKE_DIRTY_KEY, 500) or []
+    done = 0
+    for raw_uid in uids:
+        uid = raw_uid.decode() if isinstance(raw_uid, bytes) else raw_uid
+        try:
+            score = redis_client.zscore(SNAKE_BOARD_KEY, uid)
+            if score is None: continue
+            # 只升不降，防止旧数据覆盖
+            client.table('profiles').update({'snake_high_score': int(score)}) \
+                .eq('id', uid).or_(f"snake_high_score.is.null,snake_high_score.lt.{int(score)}").execute()
+            done += 1
+        except Exception as e:
+            print(f"Snake Flush Error: {e}")
+            redis_client.sadd(SNAKE_DIRTY_KEY, uid)  # 放回去，下次再写
+    return done
+
+
+# [修改] 原来由提交分数的请求抢锁后起线程写回，现在交给 worker 的周期任务
+jobs.every(SNAKE_FLUSH_INTERVAL, 'flush_snake_scores')
+
+
+def _avatar_link(path):
+    return f"{url}/storage/v1/object/public/family_photos/{path}" if path else None
+
 
 @app.route('/api/snake/update', methods=['POST'])
 @login_required
 def update_snake_score():
     """更新最高分"""
-    db = get_db()
     try:
         new_score = int(request.json.get('score', 0))
         user_id = session['user']
+    except Exception as e:
+        print(f"Score Update Error: {e}")
+        return jsonify({'success': False})
+
+    if new_score <= 0: return jsonify({'success': True, 'new_record': False})
+
+    # A. Redis 排行榜：ZADD GT 原子比较，并发提交也不会把高分覆盖掉
+    if redis_client:
+        try:
+            ensure_snake_board()
+            pipe = redis_client.pipeline()
+            pipe.zadd(SNAKE_BOARD_KEY, {user_id: new_score}, gt=True, ch=True)
+            pipe.zrevrank(SNAKE_BOARD_KEY, user_id)
+            changed, rank = pipe.execute()
+
+            if changed:
+                redis_client.sadd(SNAKE_DIRTY_KEY, user_id)
+                if not redis_client.hexists(SNAKE_PROFILE_KEY, user_id):
+                    p = get_db().table('profiles').select('display_name, avatar_url') \
+                        .eq('id', user_id).maybe_single().execute()
+                    if p and p.data: redis_client.hset(SNAKE_PROFILE_KEY, user_id, _snake_profile_json(p.data))
+
+            return jsonify({'success': True, 'new_record': bool(changed),
+                            'rank': rank + 1 if rank is not None else None})
+        except Exception as e:
+            print(f"Score Update Error (Redis): {e}")
 
+    # B. 兜底：直接读写数据库
+    db = get_db()
+    try:
         # 1. 先查旧分数
         # 使用 maybe_single 防止报错
         res = db.table('profiles').select('snake_high_score').eq('id', user_id).maybe_single().execute()
@@ -2614,9 +3749,53 @@ def update_snake_score():
         return jsonify({'success': False})
 
 
+def _snake_leaderboard_from_redis():
+    """从 Redis 读前 N 名，返回 None 表示需要走数据库"""
+    global _snake_top_script
+    if _snake_top_script is None:
+        _snake_top_script = redis_client.register_script(_SNAKE_TOP_LUA)
+
+    keys = [SNAKE_BOARD_KEY, SNAKE_PROFILE_KEY, SNAKE_SEEDED_KEY]
+    raw = _snake_top_script(keys=keys, args=[SNAKE_TOP_N])
+    if raw is None:
+        ensure_snake_board(force=True)
+        raw = _snake_top_script(keys=keys, args=[SNAKE_TOP_N])
+        if raw is None: return None
+
+    rows = []
+    missing = []
+    for i in range(0, len(raw), 3):
+        uid = raw[i].decode() if isinstance(raw[i], bytes) else raw[i]
+        info = json.loads(raw[i + 2]) if raw[i + 2] else None
+        if info is None: missing.append(uid)
+        rows.append({'id': uid, 'score': int(float(raw[i + 1])), 'info': info or {}})
+
+    # 名字/头像缓存缺失 (改资料时 invalidate_snake_profile 会清掉) 时补查一次
+    if missing:
+        client = admin_supabase if admin_supabase else supabase
+        profs = client.table('profiles').select('id, display_name, avatar_url').in_('id', missing).execute().data or []
+        if profs: redis_client.hset(SNAKE_PROFILE_KEY, mapping={p['id']: _snake_profile_json(p) for p in profs})
+        prof_map = {p['id']: p for p in profs}
+        for r in rows:
+            if r['id'] in prof_map: r['info'] = prof_map[r['id']]
+
+    return [{
+        'display_name': r['info'].get('display_name'),
+        'avatar_url': _avatar_link(r['info'].get('avatar_url')),
+        'snake_high_score': r['score']
+    } for r in rows]
+
+
 @app.route('/api/snake/leaderboard')
 def get_snake_leaderboard():
     """获取全局排行榜 (前20名)"""
+    if redis_client:
+        try:
+            data = _snake_leaderboard_from_redis()
+            if data is not None: return jsonify(data)
+        except Exception as e:
+            print(f"Leaderboard Error (Redis): {e}")
+
     # ⚠️ 关键点：使用 admin_supabase (上帝权限)
     # 因为 RLS 限制了普通用户只能看家人的资料，但排行榜我们想看全员的
     # 我们只取头像、名字、分数，不泄露隐私
@@ -2627,16 +3806,13 @@ def get_snake_leaderboard():
             .select('display_name, avatar_url, snake_high_score') \
             .gt('snake_high_score', 0) \
             .order('snake_high_score', desc=True) \
-            .limit(20) \
+            .limit(SNAKE_TOP_N) \
             .execute()
 
-        # 处理头像链接
+        # 处理头像链接 (没有头像时为 None，前端处理默认图)
         data = res.data or []
         for p in data:
-            if p.get('avatar_url'):
-                p['avatar_url'] = f"{url}/storage/v1/object/public/family_photos/{p['avatar_url']}"
-            else:
-                p['avatar_url'] = None  # 前端处理默认图
+            p['avatar_url'] = _avatar_link(p.get('avatar_url'))
 
         return jsonify(data)
     except Exception as e:
@@ -2644,6 +3820,35 @@ def get_snake_leaderboard():
         return jsonify([])
 
 
+@app.route('/api/snake/rank')
+@login_required
+def get_snake_rank():
+    """我的排名和最高分"""
+    user_id = session['user']
+    if redis_client:
+        try:
+            ensure_snake_board()
+            pipe = redis_client.pipeline()
+            pipe.zrevrank(SNAKE_BOARD_KEY, user_id)
+            pipe.zscore(SNAKE_BOARD_KEY, user_id)
+            rank, score = pipe.execute()
+            return jsonify({'rank': rank + 1 if rank is not None else None, 'score': int(score or 0)})
+        except Exception as e:
+            print(f"Rank Error (Redis): {e}")
+
+    # 兜底：数据库里数比我高的人
+    client = admin_supabase if admin_supabase else get_db()
+    try:
+        me = client.table('profiles').select('snake_high_score').eq('id', user_id).maybe_single().execute()
+        score = ((me.data if me else None) or {}).get('snake_high_score') or 0
+        if score <= 0: return jsonify({'rank': None, 'score': 0})
+        higher = client.table('profiles').select('id', count='exact').gt('snake_high_score', score).execute()
+        return jsonify({'rank': (higher.count or 0) + 1, 'score': score})
+    except Exception as e:
+        print(f"Rank Error: {e}")
+        return jsonify({'rank': None, 'score': 0})
+
+
 @app.route('/delete_pet_photo', methods=['POST'])
 @login_required
 def delete_pet_photo():
@@ -2662,8 +3867,7 @@ def delete_pet_photo():
             # 校验：只有上传者本人可以删
             if record['user_id'] == session['user']:
                 # A. 删文件
-                if record.get('image_path'):
-                    db.storage.from_("family_photos").remove(record['image_path'])
+                remove_photos(db, record.get('image_path'))
 
                 # B. 删记录
                 db.table('logs').delete().eq('id', log_id).execute()
@@ -2687,42 +3891,29 @@ def toggle_like():
     try:
         data = request.json
         moment_id = data.get('moment_id')
-        user_id = session['user']
-
-        # 1. 检查并切换状态
-        check = db.table('moment_likes').select('*').eq('user_id', user_id).eq('moment_id', moment_id).execute()
-
-        if check.data:
-            db.table('moment_likes').delete().eq('user_id', user_id).eq('moment_id', moment_id).execute()
-            is_liked = False
-        else:
-            db.table('moment_likes').insert({'user_id': user_id, 'moment_id': moment_id}).execute()
-            is_liked = True
-
-        # 2. [核心] 获取最新的点赞人列表 (为了前端渲染)
-        # 这里需要重新构建一下简单的 user_map 或者直接查 profiles
-        # 为了简单，我们只返回 user_id 列表，前端根据页面已有的 user_map 渲染?
-        # 不行，前端 user_map 是 Jinja2 渲染的，JS 拿不到完整版。
-        # 所以后端直接查好返回给前端最稳妥。
 
-        likers_res = db.table('moment_likes').select('user_id').eq('moment_id', moment_id).execute()
-        uids = [x['user_id'] for x in (likers_res.data or [])]
+        # 1. [修改] 原子切换：数据库函数里一次完成 删/插 + 计数 + 点赞人列表
+        # (见 sql/001_moment_like_count.sql，连点也不会插出重复的赞)
+        # p_user_id 只在上帝模式 (管理员客户端，auth.uid() 为空) 时生效，见 sql/001
+        res = db.rpc('toggle_moment_like', {'p_moment_id': int(moment_id), 'p_user_id': session['user']}).execute()
+        result = res.data or {}
+        is_liked = bool(result.get('is_liked'))
 
+        # 2. 补全头像链接 (前端 user_map 是 Jinja2 渲染的，JS 拿不到，所以后端直接返回)
         likers_info = []
-        if uids:
-            profiles = db.table('profiles').select('id, display_name, avatar_url').in_('id', uids).execute()
-            for p in (profiles.data or []):
-                avatar = None
-                if p.get('avatar_url'):
-                    avatar = f"{url}/storage/v1/object/public/family_photos/{p['avatar_url']}"
+        for p in (result.get('likers') or []):
+            avatar = None
+            if p.get('avatar_url'):
+                avatar = f"{url}/storage/v1/object/public/family_photos/{p['avatar_url']}"
 
-                likers_info.append({
-                    'id': p['id'],
-                    'name': p['display_name'],
-                    'avatar': avatar
-                })
+            likers_info.append({
+                'id': p['id'],
+                'name': p['display_name'],
+                'avatar': avatar
+            })
 
-        return jsonify({'success': True, 'is_liked': is_liked, 'likers': likers_info})
+        return jsonify({'success': True, 'is_liked': is_liked, 'likers': likers_info,
+                        'like_count': result.get('like_count', len(likers_info))})
 
     except Exception as e:
         print(f"Like Error: {e}")
@@ -2744,13 +3935,13 @@ def send_game_result():
         sender_name = "🎡 命运之轮"
 
         # 1. 直接插入提醒表 (不查今日是否发过)
-        db.table('family_reminders').insert({
+        insert_family_reminder(db, {
             'family_id': family_id,
             'content': content,
             'sender_name': sender_name,
             # created_by 依然记你，但我们不查这个字段做限制
             'created_by': session['user']
-        }).execute()
+        })
 
         # 2. 微信推送
         # 先查推送ID
@@ -2815,6 +4006,43 @@ def delete_footprint():
 
 # ================= 家庭角色卡数据接口 =================
 
+def get_last_week_range():
+    """上周的 (week_str, 上周一 00:00 UTC, 本周一 00:00 UTC)，按北京时间和 ISO 周计算"""
+    now = datetime.now(timezone(timedelta(hours=8)))
+    # 获取上周的年份和周数 (ISO标准)
+    year, week, _ = (now - timedelta(days=7)).isocalendar()
+    # 上周一 00:00 ~ 本周一 00:00
+    this_monday = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+    last_monday = this_monday - timedelta(days=7)
+    return (f"{year}-W{week}", last_monday.astimezone(timezone.utc).isoformat(),
+            this_monday.astimezone(timezone.utc).isoformat())
+
+
+@jobs.task()
+def archive_weekly_honor(family_id, week_str, t_start, t_end, client=None):
+    """结算某个家庭上周的冠军并存入荣誉表 (已结算过就跳过)"""
+    if client is None: client = admin_supabase if admin_supabase else supabase
+
+    # 查库：上周结算过吗？
+    check = client.table('family_weekly_honors').select('id').eq('family_id', family_id) \
+        .eq('week_str', week_str).execute()
+    if check.data: return
+
+    # 没结算 -> 开始补算上周数据
+    winner = calculate_champion(client, family_id, t_start, t_end)
+    if winner:
+        # 存入荣誉表
+        client.table('family_weekly_honors').insert({
+            'family_id': family_id,
+            'week_str': week_str,
+            'winner_id': winner['uid'],
+            'title': winner['title'],
+            'score_data': {'total': winner['score']}
+        }).execute()
+        print(f"✅ 已自动归档上周 ({week_str}) 冠军")
+    # 上周没人互动就不写记录
+
+
 @app.route('/api/family_stats', methods=['POST'])
 @login_required
 def get_family_stats():
@@ -2824,42 +4052,14 @@ def get_family_stats():
     family_id = request.json.get('family_id')
     if not family_id: return jsonify([])
     # [新增] === 懒加载归档：检查上周是否已结算 ===
+    # [优化] 有管理员客户端时交给后台任务 (同一家庭同一周 6 小时内只排一次)，角色卡不用等补算
     try:
-        now = datetime.now(timezone(timedelta(hours=8)))
-        # 获取上周的年份和周数 (ISO标准)
-        last_week_date = now - timedelta(days=7)
-        year, week, _ = last_week_date.isocalendar()
-        week_str = f"{year}-W{week}"
-
-        # 查库：上周结算过吗？
-        check = client.table('family_weekly_honors').select('id').eq('family_id', family_id).eq('week_str',
-                                                                                                week_str).execute()
-
-        if not check.data:
-            # 没结算 -> 开始补算上周数据
-            # 上周一 00:00 ~ 本周一 00:00
-            this_monday = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
-            last_monday = this_monday - timedelta(days=7)
-
-            t_start = last_monday.astimezone(timezone.utc).isoformat()
-            t_end = this_monday.astimezone(timezone.utc).isoformat()
-
-            # 调用刚才写的计算函数
-            winner = calculate_champion(client, family_id, t_start, t_end)
-
-            if winner:
-                # 存入荣誉表
-                client.table('family_weekly_honors').insert({
-                    'family_id': family_id,
-                    'week_str': week_str,
-                    'winner_id': winner['uid'],
-                    'title': winner['title'],
-                    'score_data': {'total': winner['score']}
-                }).execute()
-                print(f"✅ 已自动归档上周 ({week_str}) 冠军")
-            else:
-                # 上周没人互动，插个空记录防止重复计算
-                pass
+        week_str, t_start, t_end = get_last_week_range()
+        if admin_supabase:
+            jobs.enqueue_once(f"honor:{family_id}:{week_str}", 6 * 3600,
+                              'archive_weekly_honor', family_id, week_str, t_start, t_end)
+        else:
+            archive_weekly_honor(family_id, week_str, t_start, t_end, client=client)
     except Exception as e:
         print(f"Archive Error: {e}")
 
@@ -3095,7 +4295,7 @@ def get_family_graph():
         user_map = {}
 
         for p in (profiles.data or []):
-            avatar = "/static/icon.png"
+            avatar = url_for('static', filename='icon.png')
             if p.get('avatar_url'):
                 avatar = f"{url}/storage/v1/object/public/family_photos/{p['avatar_url']}"
             user_map[p['id']] = p['display_name']
@@ -3115,8 +4315,10 @@ def get_family_graph():
         interaction_counts = defaultdict(int)
 
         # --- A. 统计点赞 (Likes) [+1] ---
+        # [优化] 借助冗余的 like_count，只扫描真正有赞的动态
         moms = client.table('moments').select('id, user_id') \
             .or_(f"target_family_id.is.null,target_family_id.eq.{family_id}") \
+            .gt('like_count', 0) \
             .execute()
         mom_list = moms.data or []
         mom_author_map = {m['id']: m['user_id'] for m in mom_list}
@@ -3157,7 +4359,7 @@ def get_family_graph():
         # --- C. 统计兑换券 (Coupons) [分级计分] ---
         # [修改] 必须查 status
         coupons = client.table('family_coupons') \
-            .select('creator_id, target_user_id, status') \
+            .select('creator_id, target_user_id, status, quantity, remaining') \
             .eq('family_id', family_id) \
             .execute()
 
@@ -3165,17 +4367,22 @@ def get_family_graph():
             sender = c.get('creator_id')
             target = c.get('target_user_id')
             status = c.get('status')
+            # [修改] 一行可能是一批券：按张数计分 (老数据没有这两列，按 1 张处理)
+            quantity = c.get('quantity') or 1
+            remaining = c.get('remaining')
+            if remaining is None: remaining = 1 if status == 'active' else 0
+            used = max(quantity - remaining, 0)
 
             if sender and target and sender != target and sender in user_map and target in user_map:
                 key = f"{sender}|{target}"
 
                 # [核心修复] 根据状态加减分
                 if status == 'active':
-                    interaction_counts[key] += 3  # 发了券还没用
+                    interaction_counts[key] += 3 * remaining + 5 * used  # 没用完的 + 已兑现的
                 elif status == 'used':
-                    interaction_counts[key] += 5  # 完美兑现 (分最高)
+                    interaction_counts[key] += 5 * quantity  # 完美兑现 (分最高)
                 elif status == 'void':
-                    interaction_counts[key] -= 2  # 作废了 (扣分!)
+                    interaction_counts[key] += 5 * used - 2 * remaining  # 作废了没用的 (扣分!)
 
         # === 3. 生成连线数据 ===
         links = []
@@ -3301,8 +4508,8 @@ def delete_inventory():
         # 1. 先查图片路径
         res = db.table('family_inventory').select('image_path').eq('id', inv_id).single().execute()
         if res.data and res.data.get('image_path'):
-            # 2. 删图片
-            db.storage.from_("family_photos").remove(res.data['image_path'])
+            # 2. 删图片 (后台任务)
+            remove_photos(db, res.data['image_path'])
 
         # 3. 删记录
         db.table('family_inventory').delete().eq('id', inv_id).execute()
@@ -3369,6 +4576,9 @@ def delete_shopping():
     return redirect(url_for('home'))
 
 
+MAX_COUPON_BATCH = 99  # 单次发券上限
+
+
 @app.route('/send_coupon', methods=['POST'])
 @login_required
 def send_coupon():
@@ -3376,33 +4586,42 @@ def send_coupon():
     family_id = request.form.get('family_id')
     target_uid = request.form.get('target_uid')
     title = request.form.get('title')
-    count = int(request.form.get('count', 1))
+    try:
+        count = int(request.form.get('count', 1))
+    except ValueError:
+        count = 1
 
     if not title or not target_uid: return redirect(url_for('home'))
+    if not 1 <= count <= MAX_COUPON_BATCH:
+        flash(f"一次最多发 {MAX_COUPON_BATCH} 张", "warning")
+        return redirect(url_for('home'))
+
+    if not check_rate_limit('coupon', session['user']):
+        flash("发券太频繁了，稍后再试", "warning")
+        return redirect(url_for('home'))
 
     try:
-        # 1. 发券
-        coupons = []
-        for _ in range(count):
-            coupons.append({
-                'family_id': family_id,
-                'title': title,
-                'creator_id': session['user'],
-                'target_user_id': target_uid,
-                'status': 'active'
-            })
-        db.table('family_coupons').insert(coupons).execute()
+        # 1. 发券：一批只写一行，用 quantity/remaining 记张数 (见 sql/002_coupon_batches.sql)
+        db.table('family_coupons').insert({
+            'family_id': family_id,
+            'title': title,
+            'creator_id': session['user'],
+            'target_user_id': target_uid,
+            'status': 'active',
+            'quantity': count,
+            'remaining': count
+        }).execute()
 
         # 2. [修改] App 内系统通知 (私密)
         # 写入 reminders 表，但指定 target_user_id
         me = session.get('display_name', '家人')
-        db.table('family_reminders').insert({
+        insert_family_reminder(db, {
             'family_id': family_id,
             'content': f"🎟️ {me} 给你发了 {count} 张【{title}】！",
             'sender_name': '系统',
             'created_by': session['user'],
             'target_user_id': target_uid  # <--- 关键：只显示给他看
-        }).execute()
+        })
 
         # 3. [修改] 微信私密推送
         send_private_wechat_push(
@@ -3427,43 +4646,38 @@ def void_coupon():
     coupon_id = request.form.get('coupon_id')
 
     try:
-        # 1. 先查详情 (为了拿 title 和 target_user_id)
-        check = db.table('family_coupons').select('title, target_user_id, family_id').eq('id',
-                                                                                         coupon_id).single().execute()
-
-        if check.data:
-            data = check.data
-            # 2. 执行作废
-            # 只能作废 active 的
-            res = db.table('family_coupons').update({'status': 'void'}).eq('id', coupon_id).eq('status',
-                                                                                               'active').execute()
+        # 1. 一条条件更新完成作废：只能作废还是 active 的券
+        # 更新成功时直接返回整行 (title / target_user_id)，不用先查一遍
+        res = db.table('family_coupons').update({'status': 'void'}) \
+            .eq('id', coupon_id).eq('status', 'active').execute()
 
-            # 如果更新成功 (res.data不为空)，则发送通知
-            if res.data:
-                target_uid = data['target_user_id']
-                family_id = data['family_id']
-                title = data['title']
-                me = session.get('display_name', '家人')
-
-                # A. App 提醒 (给持有者)
-                db.table('family_reminders').insert({
-                    'family_id': family_id,
-                    'content': f"🚫 {me} 作废了给你的【{title}】",
-                    'sender_name': '系统',
-                    'created_by': session['user'],
-                    'target_user_id': target_uid
-                }).execute()
+        # 如果更新成功 (res.data不为空)，则发送通知
+        if res.data:
+            data = res.data[0]
+            target_uid = data['target_user_id']
+            family_id = data['family_id']
+            title = data['title']
+            me = session.get('display_name', '家人')
+
+            # A. App 提醒 (给持有者)
+            insert_family_reminder(db, {
+                'family_id': family_id,
+                'content': f"🚫 {me} 作废了给你的【{title}】",
+                'sender_name': '系统',
+                'created_by': session['user'],
+                'target_user_id': target_uid
+            })
 
-                # B. 微信推送 (给持有者)
-                send_private_wechat_push(
-                    target_user_id=target_uid,
-                    summary=f"🚫 兑换券已作废",
-                    content=f"很遗憾，{me} 收回了之前的承诺。\n券名：{title}\n状态：已失效"
-                )
+            # B. 微信推送 (给持有者)
+            send_private_wechat_push(
+                target_user_id=target_uid,
+                summary=f"🚫 兑换券已作废",
+                content=f"很遗憾，{me} 收回了之前的承诺。\n券名：{title}\n状态：已失效"
+            )
 
-                flash("该券已作废，并通知了对方。", "info")
-            else:
-                flash("操作无效（该券可能已被使用或已作废）", "warning")
+            flash("该券已作废，并通知了对方。", "info")
+        else:
+            flash("操作无效（该券可能已被使用或已作废）", "warning")
 
     except Exception as e:
         print(f"Void Error: {e}")
@@ -3480,36 +4694,31 @@ def use_coupon():
     family_id = request.form.get('family_id')
 
     try:
-        # 1. [核心修复] 先查状态！防止"作废了还能用"
-        # 必须同时确认 ID 和 status='active'
-        check = db.table('family_coupons').select('status, title, creator_id').eq('id', coupon_id).single().execute()
-
-        if not check.data:
-            flash("找不到这张券", "danger")
-            return redirect(url_for('home'))
-
-        coupon_data = check.data
-        if coupon_data['status'] != 'active':
-            flash(f"操作失败：这张券当前状态是【{coupon_data['status']}】，无法使用。", "warning")
+        # 1. [核心修复] 一条条件更新完成核销：只有 active 且还有剩余的券才会被扣减
+        # 查状态和核销合成一次往返，连点也不会重复核销 (见 sql/002_coupon_batches.sql)
+        res = db.rpc('redeem_coupon', {'p_coupon_id': int(coupon_id)}).execute()
+        if not res.data:
+            flash("操作失败：这张券已用完或已作废。", "warning")
             return redirect(url_for('home'))
 
-        # 2. 状态正常，执行核销
-        now = datetime.now(timezone.utc).isoformat()
-        db.table('family_coupons').update({'status': 'used', 'used_at': now}).eq('id', coupon_id).execute()
+        coupon_data = res.data[0]
 
-        # 3. 通知发行人 (私密)
+        # 2. 通知发行人 (私密)
         creator_id = coupon_data['creator_id']
         title = coupon_data['title']
+        family_id = coupon_data.get('family_id') or family_id
+        remaining = coupon_data.get('remaining', 0)
         user_name = session.get('display_name', '家人')
+        left_str = f"(还剩 {remaining} 张)" if remaining else ""
 
         # A. 写入 App 内提醒 (指定 target_user_id 为发行人)
-        db.table('family_reminders').insert({
+        insert_family_reminder(db, {
             'family_id': family_id,
-            'content': f"🎫 {user_name} 使用了【{title}】，请兑现！",
+            'content': f"🎫 {user_name} 使用了【{title}】{left_str}，请兑现！",
             'sender_name': '系统',
             'created_by': session['user'],
             'target_user_id': creator_id  # 只有发行人能看到
-        }).execute()
+        })
 
         # B. 微信推送 (给发行人)
         send_private_wechat_push(
@@ -3535,13 +4744,18 @@ def admin_add_model():
     if not admin_supabase: return redirect(url_for('admin_dashboard'))
 
     try:
-        admin_supabase.table('ai_models').insert({
+        row = {
             'name': request.form.get('name'),
             'api_url': request.form.get('api_url'),
             'api_key': request.form.get('api_key'),
             'model_code': request.form.get('model_code'),
             'is_vision': request.form.get('is_vision') == 'on'
-        }).execute()
+        }
+        # [新增] 可选的历史消息预算，留空用默认值
+        if request.form.get('history_budget'):
+            row['history_budget'] = int(request.form.get('history_budget'))
+        admin_supabase.table('ai_models').insert(row).execute()
+        invalidate_ai_settings()
         flash("模型添加成功", "success")
     except Exception as e:
         flash(f"添加失败: {e}", "danger")
@@ -3564,6 +4778,7 @@ def admin_toggle_model_active():
         admin_supabase.table('ai_models').update({col_name: False}).neq('id', -1).execute()
         # 2. 把选中的设为 True
         admin_supabase.table('ai_models').update({col_name: True}).eq('id', mid).execute()
+        invalidate_ai_settings()
 
         flash(f"已切换默认 {mtype} 模型", "success")
     except Exception as e:
@@ -3576,21 +4791,88 @@ def admin_toggle_model_active():
 def admin_delete_model(mid):
     try:
         admin_supabase.table('ai_models').delete().eq('id', mid).execute()
+        invalidate_ai_settings()
         flash("模型已删除", "info")
     except:
         pass
     return redirect(url_for('admin_dashboard'))
-def get_sys_config(key_name):
-    """获取系统配置"""
+
+
+# ================= AI 配置缓存 =================
+# ask_vet 每次都要读 app_config 和 ai_models，这两张表只有管理员会改：
+# 进程内缓存一小段时间，管理员改动时主动作废；多进程部署时通过 Redis 里的版本号通知其它进程
+AI_SETTINGS_TTL = 60  # 秒
+AI_SETTINGS_RETRY = 5  # 查库失败后隔几秒再试
+AI_SETTINGS_VERSION_KEY = 'ai:settings:version'
+
+_ai_settings = {'expires': 0, 'version': None, 'gen': 0, 'config': {}, 'models': {}}
+_ai_settings_lock = threading.Lock()
+
+
+def _ai_settings_version():
+    """Redis 里的配置版本号 (没有 Redis 时返回 None，只靠 TTL + 本进程作废)"""
+    if not redis_client: return None
+    try:
+        return redis_client.get(AI_SETTINGS_VERSION_KEY)
+    except Exception as e:
+        print(f"AI Settings Version Error: {e}")
+        return None
+
+
+def load_ai_settings():
+    """
+    读取 AI 配置和当前启用的模型 (带缓存)
+    返回: (配置字典 {key: value}, 启用模型 {'text': 模型行, 'vision': 模型行})
+    查库失败时沿用上一次的数据，不让 AI 接口跟着报错
+    """
+    version = _ai_settings_version()
+    now = time.time()
+    with _ai_settings_lock:
+        if now < _ai_settings['expires'] and version == _ai_settings['version']:
+            return _ai_settings['config'], _ai_settings['models']
+        gen = _ai_settings['gen']
+
     try:
         # 使用 admin 权限查，防止 RLS 意外拦截
         client = admin_supabase if admin_supabase else get_db()
-        res = client.table('app_config').select('value').eq('key', key_name).single().execute()
-        if res.data:
-            return res.data['value']
-    except:
-        pass
-    return ""
+        rows = client.table('app_config').select('key, value').execute().data or []
+        config = {r['key']: r['value'] for r in rows}
+
+        models = {}
+        model_rows = client.table('ai_models').select('*') \
+            .or_('is_active_text.eq.true,is_active_vision.eq.true').execute().data or []
+        for m in model_rows:
+            if m.get('is_active_text'): models['text'] = m
+            if m.get('is_active_vision'): models['vision'] = m
+    except Exception as e:
+        print(f"AI Settings Load Error: {e}")
+        with _ai_settings_lock:
+            _ai_settings['expires'] = now + AI_SETTINGS_RETRY
+            return _ai_settings['config'], _ai_settings['models']
+
+    with _ai_settings_lock:
+        # 查库期间管理员刚好改了配置：这次的结果可能是旧的，不写回缓存
+        if gen == _ai_settings['gen']:
+            _ai_settings.update(expires=now + AI_SETTINGS_TTL, version=version, config=config, models=models)
+    return config, models
+
+
+def invalidate_ai_settings():
+    """管理员改了配置/模型后调用：本进程立即作废，其它进程通过版本号感知"""
+    with _ai_settings_lock:
+        _ai_settings['expires'] = 0
+        _ai_settings['gen'] += 1
+    if redis_client:
+        try:
+            redis_client.incr(AI_SETTINGS_VERSION_KEY)
+        except Exception as e:
+            print(f"AI Settings Invalidate Error: {e}")
+
+
+def get_sys_config(key_name):
+    """获取系统配置 (走缓存)"""
+    config, _ = load_ai_settings()
+    return config.get(key_name) or ""
 
 
 @app.route('/admin/update_config', methods=['POST'])
@@ -3611,6 +4893,7 @@ def admin_update_config():
         for k, v in configs.items():
             # Upsert: 有则更新，无则插入
             admin_supabase.table('app_config').upsert({'key': k, 'value': v}).execute()
+        invalidate_ai_settings()
         flash("AI 配置已保存", "success")
     except Exception as e:
         flash(f"保存失败: {e}", "danger")
@@ -3618,6 +4901,396 @@ def admin_update_config():
     return redirect(url_for('admin_dashboard'))
 
 
+# ================= 识图图片规整 =================
+# 手机照片动辄几 MB，原样转给模型既慢又费 token：先在服务端解码、缩到模型够用的分辨率、
+# 统一转成 JPEG 并卡住大小。没装 Pillow 时只做大小检查，原图照发。
+VISION_MAX_UPLOAD = 8 * 1024 * 1024  # 前端传上来的 data URL 最长多少 (base64 之后)
+VISION_MAX_SIDE = 1024  # 长边像素，视觉模型再大也看不出更多细节
+VISION_MAX_BYTES = 400 * 1024  # 转发给模型的 JPEG 上限
+VISION_QUALITIES = (82, 70, 60, 50)
+
+
+def normalize_vision_image(data_url):
+    """
+    规整前端传来的图片 data URL，返回可直接转发的 data URL
+    图片太大/不是图片时抛 ValueError (消息可直接给用户看)
+    """
+    if not isinstance(data_url, str) or not data_url.startswith('data:image/') or ',' not in data_url:
+        raise ValueError('图片格式不对，请重新选择')
+    if len(data_url) > VISION_MAX_UPLOAD:
+        raise ValueError('图片太大了，请换一张或截图后再发')
+
+    b64 = data_url.split(',', 1)[1]
+    try:
+        raw = base64.b64decode(b64, validate=False)
+    except (binascii.Error, ValueError):
+        raise ValueError('图片数据损坏，请重新选择')
+
+    if Image is None:
+        if len(raw) > VISION_MAX_BYTES * 4:
+            raise ValueError('图片太大了，请换一张或截图后再发')
+        return data_url
+
+    try:
+        img = Image.open(io.BytesIO(raw))
+        img.draft('RGB', (VISION_MAX_SIDE, VISION_MAX_SIDE))  # JPEG 解码时直接按比例缩小，省内存
+        img = ImageOps.exif_transpose(img)  # 手机照片按 EXIF 方向摆正
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            bg = Image.new('RGB', img.size, (255, 255, 255))
+            bg.paste(img, mask=img.split()[-1])
+            img = bg
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+    except Exception as e:
+        print(f"Vision Image Error: {e}")
+        raise ValueError('图片无法识别，请换一张试试')
+
+    # 先缩到长边上限，再逐档降质量；还超就继续缩小
+    side = VISION_MAX_SIDE
+    while True:
+        img.thumbnail((side, side), Image.LANCZOS)
+        for q in VISION_QUALITIES:
+            buf = io.BytesIO()
+            img.save(buf, format='JPEG', quality=q, optimize=True)
+            if buf.tell() <= VISION_MAX_BYTES:
+                return 'data:image/jpeg;base64,' + base64.b64encode(buf.getvalue()).decode('ascii')
+        if side <= 256:
+            raise ValueError('图片太复杂了，请裁剪后再发')
+        side = int(side * 0.75)
+
+
+# ================= AI 问答缓存 =================
+# "猫拉稀了怎么办"、"狗吃了巧克力" 这类单轮提问高度重复，命中缓存就直接把上次的回答吐出去，省一次付费调用
+# 只缓存不带图、不带上下文的单轮文字问题；按 模型 + 规整后的问题 存，先精确匹配，再按字二元组做模糊匹配
+# Redis: 哈希存问答，有序集合按最近命中时间做 LRU 淘汰；本地无 Redis 时退回进程内 LRU
+AI_ANSWER_TTL = 7 * 86400  # 回答保留 7 天，防止模型/话术更新后一直用旧的
+AI_ANSWER_MAX = 500  # 每个模型最多缓存多少条
+AI_ANSWER_MAX_QUESTION = 80  # 太长的问题基本是个性化描述，不缓存
+AI_ANSWER_MIN_FUZZY = 4  # 太短的问题只做精确匹配
+AI_ANSWER_SIMILARITY = 0.8  # 模糊匹配的 Jaccard 阈值
+AI_ANSWER_STATS_KEY = 'ai:answer:stats'
+
+# 这些字不同，答案就可能完全不同 (猫/狗、幼宠/老年、数字剂量)，模糊匹配时必须一致
+_QUESTION_GUARD_RE = re.compile(r'[猫狗兔鼠鸟龟鱼幼老\d]')
+_QUESTION_STRIP_RE = re.compile(r'[\W_]+')
+
+_local_ai_answers = OrderedDict()  # (模型, 问题哈希) -> {'q', 'a', 't'}
+_local_ai_answer_stats = Counter()
+_local_ai_answer_lock = threading.Lock()
+
+
+def normalize_question(text):
+    """全角转半角、转小写、去掉空白和标点"""
+    return _QUESTION_STRIP_RE.sub('', unicodedata.normalize('NFKC', text or '').lower())
+
+
+@lru_cache(maxsize=4096)
+def _question_grams(norm):
+    return frozenset(norm[i:i + 2] for i in range(len(norm) - 1))
+
+
+def _similar_question(norm, candidates):
+    """在 {哈希: 规整问题} 里找最像的一条，返回哈希或 None"""
+    if len(norm) < AI_ANSWER_MIN_FUZZY: return None
+    grams = _question_grams(norm)
+    guard = set(_QUESTION_GUARD_RE.findall(norm))
+    best, best_score = None, AI_ANSWER_SIMILARITY
+    for field, q in candidates.items():
+        if len(q) < AI_ANSWER_MIN_FUZZY or set(_QUESTION_GUARD_RE.findall(q)) != guard: continue
+        other = _question_grams(q)
+        score = len(grams & other) / len(grams | other)
+        if score >= best_score:
+            best, best_score = field, score
+    return best
+
+
+def single_turn_question(history):
+    """只有一句用户提问时返回问题文本，否则返回 None (多轮对话依赖上下文，不走缓存)"""
+    if len(history) != 1 or not isinstance(history[0], dict): return None
+    msg = history[0]
+    content = msg.get('content')
+    if msg.get('role') != 'user' or not isinstance(content, str): return None
+    if not normalize_question(content) or len(content) > AI_ANSWER_MAX_QUESTION: return None
+    return content
+
+
+def _record_ai_answer_stat(kind):
+    if redis_client:
+        try:
+            redis_client.hincrby(AI_ANSWER_STATS_KEY, kind, 1)
+            return
+        except Exception as e:
+            print(f"AI Cache Stat Error: {e}")
+    with _local_ai_answer_lock:
+        _local_ai_answer_stats[kind] += 1
+
+
+def lookup_ai_answer(model_code, question):
+    """查缓存：命中返回回答文本，否则返回 None (同时记录命中率)"""
+    norm = normalize_question(question)
+    field = hashlib.sha1(norm.encode('utf-8')).hexdigest()
+    now = time.time()
+    answer = None
+    kind = 'miss'
+
+    if redis_client:
+        data_key, lru_key, q_key = (f"ai:answer:{model_code}", f"ai:answer:lru:{model_code}",
+                                    f"ai:answer:q:{model_code}")
+        try:
+            raw = redis_client.hget(data_key, field)
+            kind = 'exact'
+            if raw is None:
+                field = _similar_question(norm, {
+                    k.decode() if isinstance(k, bytes) else k: v.decode() if isinstance(v, bytes) else v
+                    for k, v in redis_client.hgetall(q_key).items()
+                })
+                raw = redis_client.hget(data_key, field) if field else None
+                kind = 'fuzzy'
+            if raw is not None:
+                item = json.loads(raw)
+                if now - item['t'] < AI_ANSWER_TTL:
+                    answer = item['a']
+                    redis_client.zadd(lru_key, {field: now})
+                else:
+                    pipe = redis_client.pipeline()
+                    pipe.hdel(data_key, field)
+                    pipe.hdel(q_key, field)
+                    pipe.zrem(lru_key, field)
+                    pipe.execute()
+        except Exception as e:
+            print(f"AI Cache Lookup Error: {e}")
+    else:
+        with _local_ai_answer_lock:
+            item = _local_ai_answers.get((model_code, field))
+            kind = 'exact'
+            if item is None:
+                field = _similar_question(norm, {f: v['q'] for (m, f), v in _local_ai_answers.items()
+                                                 if m == model_code})
+                item = _local_ai_answers.get((model_code, field)) if field else None
+                kind = 'fuzzy'
+            if item is not None:
+                if now - item['t'] < AI_ANSWER_TTL:
+                    answer = item['a']
+                    _local_ai_answers.move_to_end((model_code, field))
+                else:
+                    del _local_ai_answers[(model_code, field)]
+
+    _record_ai_answer_stat(kind if answer is not None else 'miss')
+    return answer
+
+
+def store_ai_answer(model_code, question, answer):
+    """写缓存，超出条数时淘汰最久没被用到的"""
+    if not answer or not answer.strip(): return
+    norm = normalize_question(question)
+    field = hashlib.sha1(norm.encode('utf-8')).hexdigest()
+    now = time.time()
+    item = {'q': norm, 'a': answer, 't': now}
+
+    if redis_client:
+        data_key, lru_key, q_key = (f"ai:answer:{model_code}", f"ai:answer:lru:{model_code}",
+                                    f"ai:answer:q:{model_code}")
+        try:
+            pipe = redis_client.pipeline()
+            pipe.hset(data_key, field, json.dumps(item, ensure_ascii=False))
+            pipe.hset(q_key, field, norm)
+            pipe.zadd(lru_key, {field: now})
+            for k in (data_key, lru_key, q_key):
+                pipe.expire(k, AI_ANSWER_TTL)
+            pipe.zrange(lru_key, 0, -AI_ANSWER_MAX - 1)  # 超出上限的最旧几条
+            stale = pipe.execute()[-1]
+            if stale:
+                pipe = redis_client.pipeline()
+                pipe.hdel(data_key, *stale)
+                pipe.hdel(q_key, *stale)
+                pipe.zrem(lru_key, *stale)
+                pipe.execute()
+        except Exception as e:
+            print(f"AI Cache Store Error: {e}")
+        return
+
+    with _local_ai_answer_lock:
+        _local_ai_answers[(model_code, field)] = item
+        _local_ai_answers.move_to_end((model_code, field))
+        while sum(1 for m, _ in _local_ai_answers if m == model_code) > AI_ANSWER_MAX:
+            oldest = next(k for k in _local_ai_answers if k[0] == model_code)
+            del _local_ai_answers[oldest]
+
+
+def get_ai_answer_stats():
+    """后台展示用：精确/模糊命中、未命中次数和命中率"""
+    stats = Counter()
+    if redis_client:
+        try:
+            for k, v in redis_client.hgetall(AI_ANSWER_STATS_KEY).items():
+                stats[k.decode() if isinstance(k, bytes) else k] = int(v)
+        except Exception as e:
+            print(f"AI Cache Stats Error: {e}")
+    else:
+        with _local_ai_answer_lock:
+            stats.update(_local_ai_answer_stats)
+    hits = stats['exact'] + stats['fuzzy']
+    total = hits + stats['miss']
+    return {
+        'exact': stats['exact'],
+        'fuzzy': stats['fuzzy'],
+        'miss': stats['miss'],
+        'total': total,
+        'hit_rate': round(hits * 100 / total, 1) if total else 0
+    }
+
+
+def stream_cached_answer(answer, size=24):
+    """命中缓存时也按流式分段吐出，前端逻辑不用变"""
+    for i in range(0, len(answer), size):
+        yield answer[i:i + size]
+
+
+# ================= AI 对话预算 & 用量统计 =================
+# 前端每次都把整段聊天记录发上来，聊久了既慢又费 token，最后还会超出模型上下文
+# 这里按模型的预算只保留系统设定 + 最近几轮；更早的对话丢掉，只留一句最初的主诉做备注
+# 每次问诊的 token 用量写进 ai_usage_logs (见 sql/003_ai_usage.sql)，后台可以看到花在哪
+AI_HISTORY_BUDGET = 3000  # 默认上下文预算 (不含回复)，ai_models.history_budget 可按模型覆盖
+AI_REPLY_TOKENS = 1000  # 回复上限 (max_tokens)
+AI_MESSAGE_MAX_TOKENS = 800  # 单条消息上限，超出的部分截掉
+AI_MESSAGE_OVERHEAD = 4  # 每条消息的格式开销
+AI_IMAGE_TOKENS = 800  # 识图时每张图按固定值估算 (规整后的图大约这个量级)，不按 base64 长度算
+
+_CJK_RE = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    """粗估 token 数：中日韩字符按 1 个算，其余按 4 个字符 1 个算 (宁多勿少)"""
+    if not text: return 0
+    if not isinstance(text, str): text = json.dumps(text, ensure_ascii=False)
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_content_tokens(content):
+    """一条消息的 content：纯文本，或识图时的 [{type: text}, {type: image_url}] 列表"""
+    if not isinstance(content, list): return estimate_tokens(content)
+    total = 0
+    for part in content:
+        if isinstance(part, dict) and part.get('type') == 'image_url':
+            total += AI_IMAGE_TOKENS
+        elif isinstance(part, dict):
+            total += estimate_tokens(part.get('text'))
+        else:
+            total += estimate_tokens(part)
+    return total
+
+
+def estimate_messages_tokens(messages):
+    return sum(AI_MESSAGE_OVERHEAD + estimate_content_tokens(m.get('content')) for m in messages)
+
+
+def truncate_to_tokens(text, budget):
+    """把文本截到大约 budget 个 token 以内"""
+    est = estimate_tokens(text)
+    while est > budget and text:
+        text = text[:max(int(len(text) * budget / est) - 1, 0)]
+        est = estimate_tokens(text) + 1
+    return text + '…' if est > 0 and text else text
+
+
+def trim_history(history, system_content, budget):
+    """
+    按预算裁剪聊天记录
+    返回: (发给模型的 messages, 丢掉的条数)
+    只接受 user/assistant 的纯文本消息 (不让前端伪造 system 设定)
+    """
+    clean = [{'role': m['role'], 'content': m['content']} for m in history
+             if isinstance(m, dict) and m.get('role') in ('user', 'assistant')
+             and isinstance(m.get('content'), str) and m['content'].strip()]
+
+    system = {"role": "system", "content": system_content}
+    remaining = budget - estimate_messages_tokens([system])
+    kept = []
+    for m in reversed(clean):
+        content = m['content']
+        if estimate_tokens(content) > AI_MESSAGE_MAX_TOKENS:
+            content = truncate_to_tokens(content, AI_MESSAGE_MAX_TOKENS)
+        cost = AI_MESSAGE_OVERHEAD + estimate_tokens(content)
+        if kept and cost > remaining: break  # 最新一句无论如何都要带上
+        kept.append({'role': m['role'], 'content': content})
+        remaining -= cost
+    kept.reverse()
+    # 开头是 AI 的回复时去掉 (部分模型要求 system 之后先是 user)
+    while len(kept) > 1 and kept[0]['role'] == 'assistant':
+        remaining += AI_MESSAGE_OVERHEAD + estimate_tokens(kept.pop(0)['content'])
+
+    dropped = len(clean) - len(kept)
+    messages = [system]
+    if dropped:
+        # 最早那句通常是主诉 (什么宠物、什么症状)，压成一句备注留着
+        first = next((m['content'] for m in clean[:dropped] if m['role'] == 'user'), None)
+        note = f"（更早的 {dropped} 条对话已省略"
+        if first: note += f"，用户最初的描述：{truncate_to_tokens(first, 120)}"
+        note += "）"
+        if AI_MESSAGE_OVERHEAD + estimate_tokens(note) <= remaining:
+            messages.append({"role": "system", "content": note})
+    return messages + kept, dropped
+
+
+def record_ai_usage(model, mode, messages, reply, usage=None, cached=False, dropped=0):
+    """
+    记一笔 AI 用量 (后台线程写库，不拖慢回复)
+    上游没返回 usage 时按估算值记，estimated=True
+    """
+    if not admin_supabase: return
+    estimated = not usage
+    if estimated:
+        usage = {
+            'prompt_tokens': 0 if cached else estimate_messages_tokens(messages),
+            'completion_tokens': 0 if cached else estimate_tokens(reply)
+        }
+    row = {
+        'user_id': session.get('user'),
+        'model_code': model.get('model_code'),
+        'mode': mode,
+        'prompt_tokens': int(usage.get('prompt_tokens') or 0),
+        'completion_tokens': int(usage.get('completion_tokens') or 0),
+        'estimated': estimated,
+        'cached': cached,
+        'dropped_turns': dropped
+    }
+
+    def _do_insert():
+        try:
+            admin_supabase.table('ai_usage_logs').insert(row).execute()
+        except Exception as e:
+            print(f"AI Usage Log Error: {e}")
+
+    threading.Thread(target=_do_insert, daemon=True).start()
+
+
+def summarize_ai_usage(rows):
+    """
+    后台展示用：按今天 / 近 7 天 / 模型汇总 token 用量
+    rows 是 ai_usage_summary 按 (北京时间日期, 模型) 聚合好的结果
+    """
+    today = datetime.now(timezone(timedelta(hours=8))).date().isoformat()
+    summary = {'today': Counter(), 'week': Counter(), 'models': {}}
+    for r in rows:
+        prompt = int(r.get('prompt_tokens') or 0)
+        completion = int(r.get('completion_tokens') or 0)
+        buckets = [summary['week']]
+        if str(r.get('day')) == today:
+            buckets.append(summary['today'])
+        model_stat = summary['models'].setdefault(r.get('model_code') or '未知', Counter())
+        buckets.append(model_stat)
+        for b in buckets:
+            b['requests'] += int(r.get('requests') or 0)
+            b['tokens'] += prompt + completion
+            b['prompt'] += prompt
+            b['completion'] += completion
+            b['cached'] += int(r.get('cached') or 0)
+            b['trimmed'] += int(r.get('trimmed') or 0)
+    return summary
+
+
 @app.route('/api/ask_vet', methods=['POST'])
 @login_required
 def ask_vet():
@@ -3627,30 +5300,35 @@ def ask_vet():
     2. 针对图片使用专用 Prompt
     3. 支持流式开关
     """
+    if not check_rate_limit('ask_vet', session['user']):
+        return jsonify({'error': '提问太频繁啦，AI 医生需要休息一下，请稍后再问'})
+
     data = request.json
     history = data.get('history', [])
     image_data = data.get('image')  # Base64
 
-    client = get_db()
-
-    # 1. 读取流式开关 (默认开启)
-    try:
-        config_res = client.table('app_config').select('value').eq('key', 'ai_stream').single().execute()
-        is_stream = config_res.data['value'] == 'true' if config_res.data else True
-    except:
-        is_stream = True
+    # 1. 读取流式开关 (默认开启) 和启用的模型 [优化] 走进程内缓存，不再每次查两趟库
+    ai_config, active_models = load_ai_settings()
+    is_stream = ai_config.get('ai_stream', 'true') == 'true'
 
     # 2. 选择模型 & 设定 Prompt
     current_model = None
     messages = []
+    cache_question = None
+    dropped = 0
 
     if image_data:
         # === 📸 图片模式 (Vision) ===
+        # [优化] 先把图片规整成小 JPEG，再交给模型
+        try:
+            image_data = normalize_vision_image(image_data)
+        except ValueError as e:
+            return jsonify({'error': str(e)})
+
         # 查找启用的视觉模型 (如 GPT-4o)
-        model_res = client.table('ai_models').select('*').eq('is_active_vision', True).single().execute()
-        if not model_res.data:
+        current_model = active_models.get('vision')
+        if not current_model:
             return jsonify({'error': '未配置识图模型 (请联系管理员添加支持 Vision 的模型)'})
-        current_model = model_res.data
 
         # [识图专用 Prompt]
         system_content = """
@@ -3675,14 +5353,24 @@ def ask_vet():
         }
         # 识图模式下，为了效果好，通常不带太长的历史记录，只带系统设定和当前图
         messages = [{"role": "system", "content": system_content}, user_msg]
+        mode = 'vision'
 
     else:
         # === 💬 文字模式 (Text) ===
         # 查找启用的文字模型 (如 DeepSeek)
-        model_res = client.table('ai_models').select('*').eq('is_active_text', True).single().execute()
-        if not model_res.data:
+        current_model = active_models.get('text')
+        if not current_model:
             return jsonify({'error': '未配置聊天模型'})
-        current_model = model_res.data
+
+        # [新增] 单轮常见问题先查缓存，命中就不调模型了
+        cache_question = single_turn_question(history)
+        if cache_question:
+            cached = lookup_ai_answer(current_model['model_code'], cache_question)
+            if cached:
+                record_ai_usage(current_model, 'text', [], cached, cached=True)
+                if is_stream:
+                    return Response(stream_cached_answer(cached), content_type='text/plain')
+                return jsonify({'reply': cached})
 
         # [文字问诊 Prompt] (之前的分诊护士风格)
         system_content = """
@@ -3698,73 +5386,185 @@ def ask_vet():
     用户：拉稀了
     你：别急。如果是**幼宠**或**没打疫苗**，怕是细小，得去医院测一下。如果是**成年宠**且精神好，可能是吃坏了，建议先禁食12小时，喂点益生菌观察看看。如果出现呕吐或便血，也要马上去医院哦。
 """
-        messages = [{"role": "system", "content": system_content}] + history
+        # [优化] 按模型预算裁剪聊天记录，不再整段照发
+        budget = current_model.get('history_budget') or AI_HISTORY_BUDGET
+        messages, dropped = trim_history(history, system_content, budget)
+        mode = 'text'
 
-    # 3. 发起请求
+    # 3. 发起请求 [优化] 走 llm_gateway：连接池复用、超时、按模型限流，浏览器断开时关闭上游
     try:
-        url = current_model['api_url'].rstrip('/') + "/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {current_model['api_key']}"
-        }
-        payload = {
-            "model": current_model['model_code'],
-            "messages": messages,
-            "temperature": 0.6,
-            "stream": is_stream,
-            "max_tokens": 1000
-        }
-
         # A. 流式处理
         if is_stream:
-            resp = requests.post(url, json=payload, headers=headers, stream=True)
-
-            def generate():
-                for line in resp.iter_lines():
-                    if line:
-                        decoded = line.decode('utf-8')
-                        if decoded.startswith("data: "):
-                            if "[DONE]" in decoded: break
-                            try:
-                                json_str = decoded[6:]
-                                chunk = json.loads(json_str)
-                                content = chunk['choices'][0]['delta'].get('content', '')
-                                if content: yield content
-                            except:
-                                pass
-
-            return Response(stream_with_context(generate()), content_type='text/plain')
+            model = current_model
+
+            def on_complete(text, usage):
+                # 生成器跑在响应阶段，session 仍可用 (stream_with_context 保留了请求上下文)
+                record_ai_usage(model, mode, messages, text, usage, dropped=dropped)
+                if cache_question:
+                    store_ai_answer(model['model_code'], cache_question, text)
+
+            stream = llm_gateway.stream_chat(current_model, messages,
+                                             error_text="\n\n⚠️ 回复中断了，请稍后再问一次",
+                                             on_complete=on_complete,
+                                             temperature=0.6, max_tokens=AI_REPLY_TOKENS)
+            return Response(stream_with_context(stream), content_type='text/plain')
 
         # B. 非流式处理
         else:
-            resp = requests.post(url, json=payload, headers=headers, timeout=30)
-            data = resp.json()
-            if 'choices' in data:
-                return jsonify({'reply': data['choices'][0]['message']['content']})
-            return jsonify({'error': f"API Error: {data}"})
-
+            reply, usage = llm_gateway.chat(current_model, messages, temperature=0.6, max_tokens=AI_REPLY_TOKENS)
+            record_ai_usage(current_model, mode, messages, reply, usage, dropped=dropped)
+            if cache_question:
+                store_ai_answer(current_model['model_code'], cache_question, reply)
+            return jsonify({'reply': reply})
+
+    except llm_gateway.LLMBusy:
+        return jsonify({'error': '问诊的人有点多，AI 医生忙不过来，请稍后再问'})
+    except requests.Timeout:
+        return jsonify({'error': 'AI 服务响应超时，请稍后再试'})
     except Exception as e:
         print(f"AI Error: {e}")
         return jsonify({'error': str(e)})
-@app.route('/api/food_guide')
-@login_required
-def get_food_guide():
+
+
+# ================= 食物红黑榜 (缓存 + 搜索) =================
+# 红黑榜只有管理员增删时才会变：排好序的列表缓存在进程里，管理员改动时换版本号
+# 接口带 ETag，浏览器再次打开时只需一个 304；搜索在服务端做，支持名字前缀和拼音/首字母
+FOOD_GUIDE_TTL = 600  # 秒，兜底刷新
+FOOD_GUIDE_VERSION_KEY = 'food_guide:version'
+FOOD_SEARCH_LIMIT = 30
+FOOD_SORT_MAP = {'danger': 0, 'warn': 1, 'safe': 2}  # danger(禁止) 排最前，warn(慎食) 中间，safe(安全) 最后
+
+_food_guide = {'expires': 0, 'version': None, 'gen': 0, 'data': [], 'body': '[]', 'etag': None, 'index': []}
+_food_guide_lock = threading.Lock()
+
+
+def _food_pinyin(name):
+    """返回 (全拼, 首字母)，没装 pypinyin 时都是空串"""
+    if lazy_pinyin is None or not name: return '', ''
+    full = lazy_pinyin(name, errors='ignore')
+    return ''.join(full).lower(), ''.join(p[0] for p in full if p).lower()
+
+
+def _food_guide_version():
+    if not redis_client: return None
     try:
-        # 获取所有数据
-        res = get_db().table('pet_food_guide').select('*').execute()
-        data = res.data or []
+        return redis_client.get(FOOD_GUIDE_VERSION_KEY)
+    except Exception as e:
+        print(f"Food Version Error: {e}")
+        return None
 
-        # [修改] 按安全等级排序
-        # danger(禁止) 排最前，warn(慎食) 中间，safe(安全) 最后
-        sort_map = {'danger': 0, 'warn': 1, 'safe': 2}
 
-        # Python 排序逻辑：先按等级排，等级一样的按 ID 排
-        data.sort(key=lambda x: (sort_map.get(x['status'], 3), x['id']))
+def load_food_guide():
+    """
+    读取排好序的红黑榜 (带缓存)
+    返回缓存条目: data 列表、序列化好的 body、etag、搜索索引
+    """
+    version = _food_guide_version()
+    now = time.time()
+    with _food_guide_lock:
+        if now < _food_guide['expires'] and version == _food_guide['version']:
+            return dict(_food_guide)
+        gen = _food_guide['gen']
 
-        return jsonify(data)
+    try:
+        client = admin_supabase if admin_supabase else get_db()
+        data = client.table('pet_food_guide').select('*').execute().data or []
     except Exception as e:
         print(f"Food Error: {e}")
-        return jsonify([])
+        with _food_guide_lock:
+            _food_guide['expires'] = now + 5  # 查库失败时沿用旧数据，隔几秒再试
+            return dict(_food_guide)
+
+    # 先按等级排，等级一样的按 ID 排
+    data.sort(key=lambda x: (FOOD_SORT_MAP.get(x['status'], 3), x['id']))
+    body = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    index = []
+    for item in data:
+        full, initials = _food_pinyin(item.get('name') or '')
+        index.append((item, (item.get('name') or '').lower(), full, initials))
+
+    entry = {
+        'expires': now + FOOD_GUIDE_TTL, 'version': version, 'gen': gen, 'data': data, 'body': body,
+        'etag': hashlib.sha1(body.encode('utf-8')).hexdigest(), 'index': index
+    }
+    with _food_guide_lock:
+        if gen == _food_guide['gen']:
+            _food_guide.update(entry)
+    return entry
+
+
+def invalidate_food_guide():
+    """管理员增删食物后调用"""
+    with _food_guide_lock:
+        _food_guide['expires'] = 0
+        _food_guide['gen'] += 1
+    if redis_client:
+        try:
+            redis_client.incr(FOOD_GUIDE_VERSION_KEY)
+        except Exception as e:
+            print(f"Food Invalidate Error: {e}")
+
+
+def search_food_guide(query, status=None):
+    """
+    服务端搜索红黑榜，返回全部匹配项 (由调用方决定取前多少条)，按匹配程度排序：
+    名字完全一致 > 名字前缀 > 全拼前缀 > 首字母前缀 > 名字包含 > 原因包含
+    """
+    q = (query or '').strip().lower()
+    q_compact = q.replace(' ', '')
+    results = []
+    for item, name, full, initials in load_food_guide()['index']:
+        if status and status != 'all' and item.get('status') != status: continue
+        if not q:
+            rank = 5
+        elif name == q:
+            rank = 0
+        elif name.startswith(q):
+            rank = 1
+        elif full and full.startswith(q_compact):
+            rank = 2
+        elif initials and initials.startswith(q_compact):
+            rank = 3
+        elif q in name:
+            rank = 4
+        elif q in (item.get('reason') or '').lower():
+            rank = 5
+        else:
+            continue
+        results.append((rank, item))
+    results.sort(key=lambda x: x[0])  # 稳定排序，同档内保持红黑榜原顺序
+    return [item for _, item in results]
+
+
+@app.route('/api/food_guide')
+@login_required
+def get_food_guide():
+    # [优化] 走缓存，浏览器带 If-None-Match 时直接 304
+    entry = load_food_guide()
+    resp = Response(entry['body'], mimetype='application/json')
+    if entry['etag']:
+        resp.set_etag(entry['etag'])
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True  # 可以存，但每次先用 ETag 问一下
+    return resp.make_conditional(request)
+
+
+@app.route('/api/food_guide/search')
+@login_required
+def search_food():
+    """
+    红黑榜搜索: ?q=葡萄 / ?q=pt / ?q=putao&status=danger
+    最多返回 limit 条 (1~100)，总匹配数放在 X-Total-Count 头里，前端据此提示还有更多结果
+    """
+    try:
+        limit = max(1, min(int(request.args.get('limit', FOOD_SEARCH_LIMIT)), 100))
+    except (TypeError, ValueError):
+        limit = FOOD_SEARCH_LIMIT
+    matches = search_food_guide(request.args.get('q', ''), request.args.get('status'))
+    resp = jsonify(matches[:limit])
+    resp.headers['X-Total-Count'] = str(len(matches))
+    return resp
+
 
 @app.route('/admin/add_food', methods=['POST'])
 @admin_required
@@ -3777,6 +5577,7 @@ def admin_add_food():
             'status': request.form.get('status'),
             'reason': request.form.get('reason')
         }).execute()
+        invalidate_food_guide()
         flash("添加成功", "success")
     except Exception as e: flash(f"失败: {e}", "danger")
     return redirect(url_for('admin_dashboard'))
@@ -3787,9 +5588,13 @@ def admin_delete_food(fid):
     """后台删除食物"""
     try:
         admin_supabase.table('pet_food_guide').delete().eq('id', fid).execute()
+        invalidate_food_guide()
         flash("删除成功", "success")
     except: pass
     return redirect(url_for('admin_dashboard'))
+# 所有任务都注册完了再起内嵌 worker 线程 (只在有 Redis 时；python worker.py 会把它设为 0)
+jobs.start_workers(JOB_EMBEDDED_WORKERS)
+
 if __name__ == '__main__':
-    # 开发环境启动
+    # 开发环境启动 (线上用 gunicorn -c gunicorn.conf.py app:app，gevent worker 承载长连接)
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,102 @@
+"""
+首页宠物卡片组装基准：旧的 宠物 × 日志 嵌套扫描 vs summarize_pets 分桶
+
+用法: python bench_home_join.py
+默认跑 10×1000 / 25×2500 / 50×5000 / 100×10000 四档，观察耗时是否随数据量线性增长
+(不连数据库，Supabase 配置缺失时用占位值导入 app)
+"""
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+os.environ.setdefault('SUPABASE_URL', 'http://127.0.0.1:54321')
+os.environ.setdefault('SUPABASE_KEY', 'bench')
+
+import app  # noqa: E402
+
+SCALES = [(10, 1000), (25, 2500), (50, 5000), (100, 10000)]
+ROUNDS = 3
+
+
+def legacy_summarize(pets, logs, my_families, user_map, pet_owners_map, current_user_id):
+    """旧版 home() 5A 段落原样搬过来做对照"""
+    for pet in pets:
+        pet['today_feed'] = False
+        pet['today_walk'] = False
+        pet['feed_info'] = ""
+        pet['walk_info'] = ""
+        pet['latest_photo'] = None
+        pet['photo_uploader'] = ""
+        pet['photo_count'] = 0
+
+        pet['owner_ids'] = pet_owners_map.get(pet['id'], [])
+        pet['is_owner'] = (current_user_id in pet['owner_ids']) or False
+
+        fam_obj = next((f for f in my_families if f['id'] == pet['family_id']), None)
+        pet['family_name'] = fam_obj['name'] if fam_obj else ""
+
+        for log in logs:
+            if log['pet_id'] == pet['id']:
+                who = user_map.get(log['user_id'], {}).get('name', '家人')
+                time_s = app.format_time_friendly(log['created_at'])
+                if log['action'] == 'feed':
+                    pet['today_feed'] = True
+                    if not pet['feed_info']: pet['feed_info'] = f"{who} ({time_s})"
+                elif log['action'] == 'walk':
+                    pet['today_walk'] = True
+                    if not pet['walk_info']: pet['walk_info'] = f"{who} ({time_s})"
+                elif log['action'] == 'photo':
+                    pet['photo_count'] += 1
+                    if not pet['latest_photo'] and log.get('image_path'):
+                        pet['latest_photo'] = f"{app.url}/storage/v1/object/public/family_photos/{log['image_path']}"
+                        pet['photo_uploader'] = who
+    return pets
+
+
+def make_data(n_pets, n_logs, seed=7):
+    rnd = random.Random(seed)
+    families = [{'id': i, 'name': f"家庭{i}"} for i in range(1, 9)]
+    users = [f"user-{i}" for i in range(40)]
+    user_map = {u: {'name': u, 'avatar': None, 'status': 'online'} for u in users}
+    pets = [{'id': i, 'name': f"宠物{i}", 'family_id': rnd.choice(families)['id']} for i in range(1, n_pets + 1)]
+    owners = {p['id']: rnd.sample(users, 2) for p in pets}
+
+    start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    logs = []
+    for i in range(n_logs):
+        action = rnd.choice(['feed', 'walk', 'photo'])
+        logs.append({
+            'id': i,
+            'pet_id': rnd.randint(1, n_pets),
+            'user_id': rnd.choice(users),
+            'action': action,
+            'image_path': f"pet_{i}.jpg" if action == 'photo' else None,
+            'created_at': (start + timedelta(seconds=rnd.randint(0, 86399))).isoformat(),
+        })
+    logs.sort(key=lambda x: x['created_at'], reverse=True)  # 与数据库查询一致：倒序
+    return pets, logs, families, user_map, owners
+
+
+def run(fn, n_pets, n_logs):
+    pets, logs, families, user_map, owners = make_data(n_pets, n_logs)
+    best, result = None, None
+    for _ in range(ROUNDS):
+        batch = [dict(p) for p in pets]
+        t = time.perf_counter()
+        result = fn(batch, logs, families, user_map, owners)
+        cost = time.perf_counter() - t
+        best = cost if best is None else min(best, cost)
+    return best, result
+
+
+if __name__ == '__main__':
+    print(f"📊 宠物卡片组装 (每档取 {ROUNDS} 轮最快)")
+    print(f"{'宠物×日志':>12} {'旧 (ms)':>10} {'新 (ms)':>10} {'新 µs/条':>10} {'加速':>7}")
+    for n_pets, n_logs in SCALES:
+        old_t, old_res = run(lambda *a: legacy_summarize(*a, 'user-0'), n_pets, n_logs)
+        new_t, new_res = run(lambda *a: app.summarize_pets(*a, 'user-0'), n_pets, n_logs)
+        assert old_res == new_res, "新旧结果不一致"
+        per_item = new_t / (n_pets + n_logs) * 1e6
+        print(f"{n_pets:>5}×{n_logs:<6} {old_t * 1000:>10.2f} {new_t * 1000:>10.2f} {per_item:>10.2f} "
+              f"{old_t / new_t:>6.1f}x")
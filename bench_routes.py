@@ -0,0 +1,193 @@
+"""
+关键路由压测：首页 / 家庭角色卡 / 亲密引力场 / 后台首页
+
+用法: python bench_routes.py [--scale 1] [--dataset synth_1x.json] [--clients 8] [--requests 200] [--routes home,family_stats]
+                            [--json out.json] [--baseline out.json]
+
+- 不连真实 Supabase：在子进程里起 fake_supabase (内存版 PostgREST)，灌入 synth_data.py 生成的模拟数据
+  (按 --scale/--seed 现场生成，或者 --dataset 读事先生成好的 JSON；内存替身建议不超过 10×)
+- 每个路由单独一轮：--clients 个线程并发，用 Flask test_client 跑满 --requests 次
+- 查库次数/耗时取自响应头 Server-Timing (见 app.py 的数据库调用追踪)
+- --json 把结果存下来，下次用 --baseline 对比，p95 变慢超过 20% 会标出来
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+
+import fake_supabase
+import synth_data
+
+ROUTES = {
+    # 名称: (方法, 路径, 是否需要 JSON body 里的 family_id, 是否管理员)
+    'home': ('GET', '/', False, False),
+    'family_stats': ('POST', '/api/family_stats', True, False),
+    'family_graph': ('POST', '/api/family_graph', True, False),
+    'admin_dashboard': ('GET', '/admin', False, True),
+}
+WARMUP = 3
+REGRESSION_RATIO = 1.2
+
+_TIMING_RE = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+
+# ================= 压测 =================
+
+def _serve_fake(tables, port_queue):
+    fake = fake_supabase.FakeSupabase(tables)
+    port_queue.put(fake.start())
+    threading.Event().wait()
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values: return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[idx]
+
+
+def run_route(app_module, name, token_for, actors, clients, total):
+    method, path, needs_family, is_admin = ROUTES[name]
+    user_id = actors['admin'] if is_admin else actors['user']
+    body = {'family_id': actors['family_id']} if needs_family else None
+    samples = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def make_client():
+        c = app_module.app.test_client()
+        c.set_cookie('lab_pass', 'granted')
+        with c.session_transaction() as ss:
+            ss['user'] = user_id
+            ss['access_token'] = token_for(user_id)
+            ss['refresh_token'] = f"refresh-{user_id}"
+            ss['display_name'] = '压测'
+            if is_admin: ss['role'] = 'admin'
+        return c
+
+    def one(c):
+        t = time.perf_counter()
+        resp = c.open(path, method=method, json=body)
+        cost = (time.perf_counter() - t) * 1000
+        resp.get_data()
+        m = _TIMING_RE.search(resp.headers.get('Server-Timing', ''))
+        return cost, resp.status_code, int(m.group(2)) if m else 0, float(m.group(1)) if m else 0.0
+
+    def worker():
+        c = make_client()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None: return
+            cost, status, queries, db_ms = one(c)
+            with lock:
+                samples.append((cost, queries, db_ms))
+                if status != 200: errors.append(status)
+
+    warm = make_client()
+    for _ in range(WARMUP): one(warm)
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    start = time.perf_counter()
+    for th in threads: th.start()
+    for th in threads: th.join()
+    wall = time.perf_counter() - start
+
+    lat = sorted(s[0] for s in samples)
+    n = len(samples) or 1
+    return {
+        'route': name, 'requests': len(samples), 'errors': len(errors),
+        'rps': round(len(samples) / wall, 1) if wall else 0,
+        'p50': round(_percentile(lat, 0.50), 1), 'p95': round(_percentile(lat, 0.95), 1),
+        'p99': round(_percentile(lat, 0.99), 1), 'max': round(lat[-1], 1) if lat else 0,
+        'queries': round(sum(s[1] for s in samples) / n, 1), 'db_ms': round(sum(s[2] for s in samples) / n, 1),
+    }
+
+
+def print_report(results, baseline=None):
+    base = {r['route']: r for r in (baseline or [])}
+    print(f"{'路由':<16} {'请求':>6} {'失败':>5} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} "
+          f"{'查库/次':>8} {'库ms/次':>8}")
+    for r in results:
+        line = (f"{r['route']:<16} {r['requests']:>6} {r['errors']:>5} {r['rps']:>8} {r['p50']:>8} {r['p95']:>8} "
+                f"{r['p99']:>8} {r['max']:>8} {r['queries']:>8} {r['db_ms']:>8}")
+        old = base.get(r['route'])
+        if old and old['p95']:
+            ratio = r['p95'] / old['p95']
+            flag = ' ⚠️ 变慢' if ratio > REGRESSION_RATIO else ''
+            line += f"   p95 {ratio:.2f}x 查库 {old['queries']}→{r['queries']}{flag}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='关键路由压测 (本地 Supabase 替身)')
+    parser.add_argument('--scale', type=float, default=1, help='模拟数据规模 (见 synth_data.py)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--dataset', help='synth_data.py --format json 生成的文件，给了就不现场生成')
+    parser.add_argument('--clients', type=int, default=8, help='并发客户端数')
+    parser.add_argument('--requests', type=int, default=200, help='每个路由的请求总数')
+    parser.add_argument('--routes', default=','.join(ROUTES), help='逗号分隔，可选: ' + ','.join(ROUTES))
+    parser.add_argument('--json', help='把结果写到这个文件')
+    parser.add_argument('--baseline', help='和之前 --json 存下的结果对比')
+    parser.add_argument('--verbose', action='store_true', help='显示 app 自己的日志输出')
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    if args.dataset:
+        tables, actors = synth_data.load_dataset(args.dataset)
+    else:
+        tables, actors = synth_data.generate(args.scale, args.seed)
+    rows = sum(len(v) for v in tables.values())
+    print(f"🧪 模拟数据: {len(tables['families'])} 个家庭 / {rows} 行 ({(time.perf_counter() - t):.1f}s)")
+
+    # 替身放在子进程里，避免和被测的 Flask 抢同一把 GIL
+    port_queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_serve_fake, args=(tables, port_queue), daemon=True)
+    proc.start()
+    base_url = port_queue.get(timeout=30)
+
+    os.environ.update({
+        'SUPABASE_URL': base_url, 'SUPABASE_KEY': fake_supabase.ANON_KEY,
+        'SUPABASE_SERVICE_KEY': fake_supabase.SERVICE_KEY,
+        'QWEATHER_KEY': '', 'SLOW_REQUEST_MS': '600000', 'SLOW_REQUEST_DB_CALLS': '1000000',
+    })
+    for k in ('FLASK_ENV', 'VERCEL'): os.environ.pop(k, None)
+    import app as app_module
+    app_module.app.config['WTF_CSRF_ENABLED'] = False  # 压测直接发 JSON，不走页面拿 token
+
+    names = [r.strip() for r in args.routes.split(',') if r.strip()]
+    for name in names:
+        if name not in ROUTES: sys.exit(f"未知路由: {name}")
+
+    results = []
+    # app 里有不少调试 print (比如后台首页会打印整个文件列表)，默认吞掉免得刷屏
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with quiet:
+            for name in names:
+                results.append(run_route(app_module, name, fake_supabase.make_jwt, actors,
+                                         args.clients, args.requests))
+    finally:
+        proc.terminate()
+
+    print(f"⏱️  {args.clients} 并发，每个路由 {args.requests} 次 (毫秒)")
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    print_report(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"💾 结果已保存: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
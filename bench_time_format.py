@@ -0,0 +1,117 @@
+"""
+时间格式化微基准：旧的逐行解析 vs time_utils (缓存 + 批量)
+
+用法: python bench_time_format.py [行数，默认 10000]
+模拟首页/详情页对同一批数据反复渲染：第 1 轮是冷缓存，之后几轮是热缓存
+"""
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import time_utils
+
+ROUNDS = 5
+
+
+# ================= 旧实现 (原样搬过来做对照) =================
+
+def legacy_format_time_friendly(iso_str):
+    if not iso_str: return ""
+    try:
+        if iso_str.endswith('Z'):
+            dt = datetime.fromisoformat(iso_str.replace('Z', '+00:00'))
+        else:
+            dt = datetime.fromisoformat(iso_str)
+
+        now = datetime.now(timezone.utc)
+        diff = now - dt
+        local_dt = dt.astimezone(timezone(timedelta(hours=8)))
+
+        if diff.days > 0:
+            return local_dt.strftime('%m-%d %H:%M')
+        elif diff.seconds < 3600:
+            mins = diff.seconds // 60
+            if mins == 0:
+                return "刚刚"
+            return f"{mins}分钟前"
+        else:
+            return f"{diff.seconds // 3600}小时前"
+    except:
+        return iso_str[:10]
+
+
+def legacy_display_time(iso_str):
+    try:
+        dt_utc = datetime.fromisoformat(iso_str.replace('Z', '+00:00'))
+        dt_bj = dt_utc.astimezone(timezone(timedelta(hours=8)))
+        return dt_bj.strftime('%Y-%m-%d %H:%M'), dt_bj.strftime('%Y-%m-%d')
+    except:
+        return "时间未知", "Unknown"
+
+
+# ================= 测试数据 =================
+
+def make_rows(n, seed=42):
+    """生成 Supabase 风格的 created_at (毫秒位数不固定，偶尔以 Z 结尾)"""
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    rows = []
+    for i in range(n):
+        dt = now - timedelta(seconds=rnd.randint(0, 90 * 86400))
+        s = dt.strftime('%Y-%m-%dT%H:%M:%S')
+        digits = rnd.choice([6, 6, 6, 5, 4])
+        s += '.' + str(dt.microsecond).zfill(6)[:digits]
+        s += 'Z' if rnd.random() < 0.2 else '+00:00'
+        rows.append({'id': i, 'created_at': s})
+    return rows
+
+
+def bench(label, fn, rows):
+    timings = []
+    for _ in range(ROUNDS):
+        batch = [dict(r) for r in rows]
+        t = time.perf_counter()
+        fn(batch)
+        timings.append(time.perf_counter() - t)
+    cold, warm = timings[0], min(timings[1:])
+    print(f"{label:<28} 冷: {cold * 1000:8.2f} ms   热: {warm * 1000:8.2f} ms   "
+          f"({warm / len(rows) * 1e6:.2f} µs/行)")
+    return warm
+
+
+def legacy_friendly(batch):
+    for r in batch:
+        r['time_str'] = legacy_format_time_friendly(r['created_at'])
+
+
+def legacy_photo(batch):
+    for r in batch:
+        r['display_time'], r['display_date'] = legacy_display_time(r['created_at'])
+
+
+def new_friendly(batch):
+    time_utils.format_rows(batch)
+
+
+def new_photo(batch):
+    time_utils.format_rows(batch, target='display_time', fmt='%Y-%m-%d %H:%M', default="时间未知")
+    time_utils.format_rows(batch, target='display_date', fmt='%Y-%m-%d', default="Unknown")
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rows = make_rows(n)
+    print(f"📊 {n} 行，每组 {ROUNDS} 轮 (Python {sys.version.split()[0]})")
+
+    # 先确认两边结果一致 (3.11+ 旧实现能解析不定长毫秒，3.9 会走 except 分支)
+    for r in rows[:200]:
+        assert time_utils.format_bj(r['created_at'], '%Y-%m-%d %H:%M', "时间未知") in (
+            legacy_display_time(r['created_at'])[0], "时间未知")
+
+    old = bench("旧: format_time_friendly", legacy_friendly, rows)
+    new = bench("新: format_rows (友好格式)", new_friendly, rows)
+    print(f"   -> 加速 {old / new:.1f}x")
+    old = bench("旧: 照片墙时间", legacy_photo, rows)
+    new = bench("新: format_rows (北京时间)", new_photo, rows)
+    print(f"   -> 加速 {old / new:.1f}x")
@@ -0,0 +1,507 @@
+"""
+本地 Supabase 替身 (只用于压测/基准，不要在线上用)
+
+一个进程内的 WSGI 服务，数据全放内存，接口形状和 Supabase 一致，app.py 不用改任何代码：
+- /rest/v1/<表>      PostgREST 常用子集：select 列裁剪、eq/neq/gt/gte/lt/lte/in/is/like/ilike、not.xxx、or=(...)、
+                     order、limit/offset、count=exact、single()、insert/upsert/update/delete、return=representation
+- /rest/v1/rpc/<函数> toggle_moment_like、redeem_coupon、ai_usage_summary (和 sql/ 里的同名函数语义一致)
+- /auth/v1/...       user / token / admin/users，够 get_db() 续会话和后台用户列表用
+- /storage/v1/...    object/list 按表里出现过的图片路径造文件列表，上传/删除直接返回成功
+
+用法:
+    fake = FakeSupabase(tables)       # tables: {表名: [行, ...]}
+    base_url = fake.start()           # 后台线程监听 127.0.0.1 随机端口
+    token = fake.make_token(user_id)  # 给 session['access_token'] 用
+    ...
+    fake.stop()
+也可以单独起一个进程: python fake_supabase.py [端口]
+"""
+import base64
+import csv
+import json
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+from werkzeug.wrappers import Request, Response
+
+from time_utils import parse_iso
+
+# time_utils 的缓存有上限，10× 模拟数据的时间戳就装不下了；替身里数据是固定的一批，不设上限
+_parse_ts = lru_cache(maxsize=None)(parse_iso.__wrapped__)
+
+ANON_KEY = 'fake-anon-key'
+SERVICE_KEY = 'fake-service-key'
+
+# 数据库默认值 (只列出 app.py 依赖的几项)
+TABLE_DEFAULTS = {
+    'moments': {'like_count': 0},
+    'family_coupons': {'status': 'active', 'quantity': 1, 'remaining': 1},
+    'profiles': {'role': 'user', 'status': 'online'},
+}
+
+_ISO_RE = re.compile(r'^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}')
+_OPS = ('eq', 'neq', 'gt', 'gte', 'lt', 'lte', 'in', 'is', 'like', 'ilike')
+
+
+class _QuietHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 长连接，和真实 Supabase 一样复用 TCP
+
+    def log_request(self, *args, **kwargs):
+        pass  # 压测时每秒上千行访问日志没有意义
+
+
+class PostgrestError(Exception):
+    def __init__(self, status, code, message, details=None):
+        super().__init__(message)
+        self.status = status
+        self.body = {'code': code, 'message': message, 'details': details, 'hint': None}
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+
+
+def make_jwt(sub, role='authenticated', ttl=86400 * 30):
+    """造一个结构合法的 JWT (签名是假的，客户端只解码不校验)"""
+    header = _b64({'alg': 'HS256', 'typ': 'JWT'})
+    payload = _b64({'sub': sub, 'role': role, 'aud': 'authenticated', 'exp': int(time.time()) + ttl})
+    return f"{header}.{payload}.fake"
+
+
+def _jwt_sub(auth_header):
+    try:
+        payload = auth_header.split(' ', 1)[1].split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get('sub')
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+
+def _now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+# ================= 过滤条件解析 =================
+
+def _split_top(text, sep=','):
+    """按顶层逗号切分 (括号和双引号里的逗号不算)"""
+    parts, buf, depth, quoted = [], [], 0, False
+    for ch in text:
+        if ch == '"': quoted = not quoted
+        elif not quoted and ch == '(': depth += 1
+        elif not quoted and ch == ')': depth -= 1
+        if ch == sep and depth == 0 and not quoted:
+            parts.append(''.join(buf))
+            buf = []
+        else:
+            buf.append(ch)
+    if buf: parts.append(''.join(buf))
+    return parts
+
+
+def _parse_filter(column, expr):
+    """'not.eq.5' -> (column, 'eq', '5', negate=True)"""
+    negate = False
+    if expr.startswith('not.'):
+        negate, expr = True, expr[4:]
+    op, _, value = expr.partition('.')
+    if op not in _OPS:
+        raise PostgrestError(400, 'PGRST100', f'unsupported operator "{op}"')
+    if op == 'in':
+        inner = value.strip()[1:-1]
+        value = next(csv.reader([inner], escapechar='\\')) if inner else []
+    return (column, op, value, negate)
+
+
+def _parse_logic(text):
+    """or=(a.eq.1,b.is.null) -> [(column, op, value, negate), ...]"""
+    conds = []
+    for item in _split_top(text.strip()[1:-1]):
+        column, _, expr = item.partition('.')
+        conds.append(_parse_filter(column, expr))
+    return conds
+
+
+def _coerce(raw, cell):
+    """把 URL 里的字符串值转成和单元格同类型，方便比较"""
+    if isinstance(cell, bool): return raw.lower() in ('true', 't', '1')
+    if isinstance(cell, int):
+        try:
+            return int(raw)
+        except ValueError:
+            return float(raw)
+    if isinstance(cell, float): return float(raw)
+    return raw
+
+
+def _compare_key(raw, cell):
+    """时间戳按时间比较，其它按类型比较"""
+    if isinstance(cell, str) and _ISO_RE.match(cell) and _ISO_RE.match(raw):
+        a, b = _parse_ts(raw), _parse_ts(cell)
+        if a and b: return a, b
+    return _coerce(raw, cell), cell
+
+
+def _like(pattern, value, ignore_case):
+    regex = '^' + re.escape(pattern).replace('%', '.*').replace('\\*', '.*').replace('_', '.') + '$'
+    return re.match(regex, value, re.I if ignore_case else 0) is not None
+
+
+def _match_one(row, cond):
+    column, op, value, negate = cond
+    cell = row.get(column)
+    if op == 'is':
+        want = {'null': None, 'true': True, 'false': False}.get(value.lower(), value)
+        ok = cell is want if want is None or isinstance(want, bool) else cell == want
+    elif cell is None:
+        return False  # SQL 语义：和 NULL 比较恒为假 (取反也一样)
+    elif op == 'in':
+        ok = any(_compare_key(v, cell)[0] == _compare_key(v, cell)[1] for v in value)
+    elif op in ('like', 'ilike'):
+        ok = _like(value, str(cell), op == 'ilike')
+    else:
+        try:
+            a, b = _compare_key(value, cell)
+            ok = {'eq': b == a, 'neq': b != a, 'gt': b > a, 'gte': b >= a, 'lt': b < a, 'lte': b <= a}[op]
+        except (TypeError, ValueError):
+            ok = False
+    return not ok if negate else ok
+
+
+def _sort_rows(rows, order):
+    for item in reversed(_split_top(order)):
+        bits = item.split('.')
+        column = bits[0]
+        desc = 'desc' in bits[1:]
+        nulls_first = 'nullsfirst' in bits[1:] or ('nullslast' not in bits[1:] and desc)
+        present = [r for r in rows if r.get(column) is not None]
+        missing = [r for r in rows if r.get(column) is None]
+        present.sort(key=lambda r: r[column], reverse=desc)
+        rows = missing + present if nulls_first else present + missing
+    return rows
+
+
+def _project(rows, select):
+    if not select or select.strip() == '*': return [dict(r) for r in rows]
+    columns = []
+    for item in _split_top(select):
+        item = item.strip()
+        if not item or '(' in item: continue  # 关联表嵌套查询不支持，直接忽略
+        alias, _, name = item.rpartition(':')
+        columns.append((alias or name, name.split('::')[0]))
+    if any(name == '*' for _, name in columns): return [dict(r) for r in rows]
+    return [{alias: r.get(name) for alias, name in columns} for r in rows]
+
+
+# ================= 内存数据库 =================
+
+class FakeSupabase:
+    """内存里的 PostgREST + GoTrue + Storage 替身"""
+
+    def __init__(self, tables=None):
+        self.tables = {}
+        self._serial = {}
+        self._index = {}  # (表, 列) -> {值: [行]}，写表时整表失效
+        self.lock = threading.RLock()
+        self.request_count = 0
+        self._server = None
+        self._thread = None
+        if tables: self.load(tables)
+
+    # ---------- 数据 ----------
+    def load(self, tables):
+        with self.lock:
+            for name, rows in tables.items():
+                self.tables[name] = [dict(r) for r in rows]
+                ids = [r['id'] for r in rows if isinstance(r.get('id'), int)]
+                self._serial[name] = max(ids) if ids else 0
+            self._index.clear()
+
+    def _rows(self, table):
+        return self.tables.setdefault(table, [])
+
+    def _touch(self, table):
+        for key in [k for k in self._index if k[0] == table]:
+            del self._index[key]
+
+    def _candidates(self, table, filters):
+        """有 eq/in 条件时走哈希索引缩小范围，否则全表"""
+        for column, op, value, negate in filters:
+            if negate or op not in ('eq', 'in'): continue
+            idx = self._index.get((table, column))
+            if idx is None:
+                idx = {}
+                for r in self._rows(table):
+                    cell = r.get(column)
+                    if cell is None: continue
+                    idx.setdefault(str(cell).lower() if isinstance(cell, bool) else str(cell), []).append(r)
+                self._index[(table, column)] = idx
+            values = value if op == 'in' else [value]
+            seen, out = set(), []
+            for v in values:
+                for r in idx.get(v, ()):
+                    if id(r) not in seen:
+                        seen.add(id(r))
+                        out.append(r)
+            return out
+        return self._rows(table)
+
+    def query(self, table, filters, logic=()):
+        rows = self._candidates(table, filters)
+        rows = [r for r in rows if all(_match_one(r, c) for c in filters)]
+        for kind, conds in logic:
+            if kind == 'or':
+                rows = [r for r in rows if any(_match_one(r, c) for c in conds)]
+            elif kind == 'not.or':
+                rows = [r for r in rows if not any(_match_one(r, c) for c in conds)]
+            elif kind == 'and':
+                rows = [r for r in rows if all(_match_one(r, c) for c in conds)]
+        return rows
+
+    def insert(self, table, record):
+        row = dict(TABLE_DEFAULTS.get(table, {}))
+        row.update(record)
+        if 'id' not in row:
+            self._serial[table] = self._serial.get(table, 0) + 1
+            row['id'] = self._serial[table]
+        row.setdefault('created_at', _now_iso())
+        self._rows(table).append(row)
+        self._touch(table)
+        return row
+
+    def make_token(self, user_id, role='authenticated'):
+        return make_jwt(user_id, role)
+
+    # ---------- RPC (和 sql/ 里的函数同语义) ----------
+    def rpc(self, name, args, uid):
+        if name == 'toggle_moment_like':
+            mid = int(args['p_moment_id'])
+            likes = self._rows('moment_likes')
+            mine = [l for l in likes if l['moment_id'] == mid and l['user_id'] == uid]
+            moment = next((m for m in self._rows('moments') if m['id'] == mid), None)
+            if mine:
+                self.tables['moment_likes'] = [l for l in likes if l not in mine]
+                liked = False
+            else:
+                self.insert('moment_likes', {'moment_id': mid, 'user_id': uid})
+                liked = True
+            self._touch('moment_likes')
+            if moment: moment['like_count'] = max((moment.get('like_count') or 0) + (1 if liked else -1), 0)
+            profiles = {p['id']: p for p in self._rows('profiles')}
+            likers = [{'id': l['user_id'], 'display_name': profiles.get(l['user_id'], {}).get('display_name'),
+                       'avatar_url': profiles.get(l['user_id'], {}).get('avatar_url')}
+                      for l in self._rows('moment_likes') if l['moment_id'] == mid]
+            return {'is_liked': liked, 'like_count': moment.get('like_count') if moment else 0, 'likers': likers}
+        if name == 'redeem_coupon':
+            cid = int(args['p_coupon_id'])
+            for c in self._rows('family_coupons'):
+                if c['id'] == cid and c.get('status') == 'active' and (c.get('remaining') or 0) > 0:
+                    c['remaining'] -= 1
+                    if c['remaining'] <= 0: c['status'] = 'used'
+                    c['used_at'] = _now_iso()
+                    self._touch('family_coupons')
+                    return [dict(c)]
+            return []
+        if name == 'ai_usage_summary':
+            since = _parse_ts(args['p_since'])
+            groups = {}
+            for r in self._rows('ai_usage_logs'):
+                dt = _parse_ts(r.get('created_at'))
+                if not dt or dt < since: continue
+                day = dt.astimezone(timezone(timedelta(hours=8))).date().isoformat()
+                g = groups.setdefault((day, r.get('model_code')), {
+                    'day': day, 'model_code': r.get('model_code'), 'requests': 0, 'prompt_tokens': 0,
+                    'completion_tokens': 0, 'cached': 0, 'trimmed': 0})
+                g['requests'] += 1
+                g['prompt_tokens'] += r.get('prompt_tokens') or 0
+                g['completion_tokens'] += r.get('completion_tokens') or 0
+                g['cached'] += 1 if r.get('cached') else 0
+                g['trimmed'] += 1 if (r.get('dropped_turns') or 0) > 0 else 0
+            return list(groups.values())
+        raise PostgrestError(404, 'PGRST202', f'Could not find the function public.{name}')
+
+    # ---------- HTTP ----------
+    def _rest(self, req, path):
+        uid = _jwt_sub(req.headers.get('Authorization', ''))
+        if path.startswith('rpc/'):
+            body = req.get_json(silent=True) or {}
+            # 和 sql/ 里的函数一致：service_role 没有 auth.uid()，才采用参数里的 p_user_id
+            if uid is None and req.headers.get('Authorization', '') == f"Bearer {SERVICE_KEY}":
+                uid = body.get('p_user_id')
+            with self.lock:
+                return 200, self.rpc(path[4:], body, uid), {}
+
+        table = path.strip('/')
+        params = req.args
+        filters, logic = [], []
+        for key in params:
+            if key in ('select', 'order', 'limit', 'offset', 'on_conflict', 'columns'): continue
+            for expr in params.getlist(key):
+                if key in ('or', 'and', 'not.or'):
+                    logic.append((key, _parse_logic(expr)))
+                else:
+                    filters.append(_parse_filter(key, expr))
+        prefer = req.headers.get('Prefer', '')
+        want_rows = 'return=minimal' not in prefer
+        method = req.method
+
+        with self.lock:
+            if method in ('GET', 'HEAD'):
+                rows = self.query(table, filters, logic)
+                total = len(rows)
+                if params.get('order'): rows = _sort_rows(rows, params['order'])
+                offset = int(params.get('offset') or 0)
+                limit = params.get('limit')
+                rows = rows[offset:offset + int(limit)] if limit is not None else rows[offset:]
+                headers = {}
+                if 'count=' in prefer:
+                    headers['Content-Range'] = f"{offset}-{offset + len(rows) - 1}/{total}" if rows else f"*/{total}"
+                return 200, _project(rows, params.get('select')), headers
+
+            if method == 'POST':
+                body = req.get_json(silent=True)
+                records = body if isinstance(body, list) else [body or {}]
+                out = []
+                if 'resolution=' in prefer:
+                    keys = [k.strip() for k in (params.get('on_conflict') or 'id').split(',')]
+                    for rec in records:
+                        hit = next((r for r in self._rows(table)
+                                    if all(r.get(k) == rec.get(k) for k in keys)), None)
+                        if hit is not None:
+                            if 'ignore-duplicates' not in prefer: hit.update(rec)
+                            out.append(hit)
+                        else:
+                            out.append(self.insert(table, rec))
+                    self._touch(table)
+                else:
+                    out = [self.insert(table, rec) for rec in records]
+                return 201, (_project(out, params.get('select')) if want_rows else None), {}
+
+            if method == 'PATCH':
+                body = req.get_json(silent=True) or {}
+                rows = self.query(table, filters, logic)
+                for r in rows: r.update(body)
+                self._touch(table)
+                return 200, (_project(rows, params.get('select')) if want_rows else None), {}
+
+            if method == 'DELETE':
+                rows = self.query(table, filters, logic)
+                gone = {id(r) for r in rows}
+                self.tables[table] = [r for r in self._rows(table) if id(r) not in gone]
+                self._touch(table)
+                return 200, (_project(rows, params.get('select')) if want_rows else None), {}
+
+        raise PostgrestError(405, 'PGRST000', f'method {method} not allowed')
+
+    def _user_json(self, uid):
+        profile = next((p for p in self._rows('profiles') if p.get('id') == uid), {})
+        return {
+            'id': uid, 'aud': 'authenticated', 'role': 'authenticated',
+            'email': profile.get('email') or f"{uid}@fake.local",
+            'app_metadata': {'provider': 'email'}, 'user_metadata': {},
+            'created_at': profile.get('created_at') or _now_iso(),
+        }
+
+    def _session_json(self, uid):
+        return {
+            'access_token': self.make_token(uid), 'refresh_token': f"refresh-{uid}",
+            'token_type': 'bearer', 'expires_in': 86400 * 30, 'expires_at': int(time.time()) + 86400 * 30,
+            'user': self._user_json(uid),
+        }
+
+    def _auth(self, req, path):
+        if path == 'user':
+            uid = _jwt_sub(req.headers.get('Authorization', ''))
+            if not uid: return 401, {'msg': 'invalid token'}, {}
+            return 200, self._user_json(uid), {}
+        if path == 'token':
+            body = req.get_json(silent=True) or {}
+            if req.args.get('grant_type') == 'refresh_token':
+                uid = (body.get('refresh_token') or '').replace('refresh-', '', 1)
+            else:
+                email = body.get('email') or ''
+                uid = next((p['id'] for p in self._rows('profiles') if p.get('email') == email), None)
+            if not uid: return 400, {'error': 'invalid_grant', 'error_description': 'Invalid login credentials'}, {}
+            return 200, self._session_json(uid), {}
+        if path == 'logout':
+            return 204, None, {}
+        if path == 'admin/users':
+            with self.lock:
+                users = [self._user_json(p['id']) for p in self._rows('profiles')]
+            return 200, {'users': users, 'aud': 'authenticated'}, {}
+        return 404, {'msg': f'not found: {path}'}, {}
+
+    def _storage(self, req, path):
+        if path.startswith('object/list/'):
+            body = req.get_json(silent=True) or {}
+            with self.lock:
+                names = []
+                for table, column in (('logs', 'image_path'), ('moments', 'image_path'),
+                                      ('profiles', 'avatar_url'), ('family_inventory', 'image_path')):
+                    names += [r[column] for r in self._rows(table) if r.get(column)]
+            names = sorted(set(names))
+            offset, limit = int(body.get('offset') or 0), int(body.get('limit') or 100)
+            files = [{'name': n, 'id': str(uuid.uuid5(uuid.NAMESPACE_URL, n)),
+                      'created_at': '2025-01-01T00:00:00+00:00', 'updated_at': '2025-01-01T00:00:00+00:00',
+                      'metadata': {'size': 150 * 1024 + len(n) * 97, 'mimetype': 'image/jpeg'}}
+                     for n in names[offset:offset + limit]]
+            return 200, files, {}
+        return 200, {'Key': path}, {}  # 上传 / 删除一律当成功
+
+    def wsgi_app(self, environ, start_response):
+        req = Request(environ)
+        self.request_count += 1
+        path = req.path
+        try:
+            if path.startswith('/rest/v1/'):
+                status, body, headers = self._rest(req, path[len('/rest/v1/'):])
+            elif path.startswith('/auth/v1/'):
+                status, body, headers = self._auth(req, path[len('/auth/v1/'):])
+            elif path.startswith('/storage/v1/'):
+                status, body, headers = self._storage(req, path[len('/storage/v1/'):])
+            else:
+                status, body, headers = 404, {'message': 'not found'}, {}
+
+            accept = req.headers.get('Accept', '')
+            if 'vnd.pgrst.object' in accept and isinstance(body, list):
+                if len(body) != 1:
+                    raise PostgrestError(406, 'PGRST116', 'JSON object requested, multiple (or no) rows returned',
+                                         f'The result contains {len(body)} rows')
+                body = body[0]
+        except PostgrestError as e:
+            status, body, headers = e.status, e.body, {}
+        except Exception as e:
+            status, body, headers = 500, {'code': 'XX000', 'message': str(e), 'details': None, 'hint': None}, {}
+
+        data = '' if body is None or req.method == 'HEAD' else json.dumps(body, ensure_ascii=False, default=str)
+        resp = Response(data, status=status, mimetype='application/json', headers=headers)
+        return resp(environ, start_response)
+
+    def start(self, host='127.0.0.1', port=0):
+        """后台线程起服务，返回 base url (填到 SUPABASE_URL)"""
+        self._server = make_server(host, port, self.wsgi_app, threaded=True, request_handler=_QuietHandler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return f"http://{host}:{self._server.server_port}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server = None
+
+
+if __name__ == '__main__':
+    import sys
+
+    fake = FakeSupabase()
+    base = fake.start(port=int(sys.argv[1]) if len(sys.argv) > 1 else 54321)
+    print(f"🧪 Fake Supabase 已启动: {base}  (SUPABASE_KEY={ANON_KEY} SUPABASE_SERVICE_KEY={SERVICE_KEY})")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
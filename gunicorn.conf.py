@@ -0,0 +1,32 @@
+"""
+Gunicorn 配置 (阿里云 / Docker 部署)
+
+用法: gunicorn -c gunicorn.conf.py app:app
+
+AI 问诊 (/api/ask_vet) 和家庭提醒 (/api/reminders/stream) 都是长连接，
+一条回复要挂 20~60 秒。同步 worker 一个连接占一个进程，几个人同时问诊整个站就卡住；
+这里默认用 gevent 协程 worker：等上游的连接几乎不占资源，普通页面请求不用排在它们后面。
+gunicorn 会在加载 app 之前完成 monkey patch，requests / redis / threading 都会变成协程友好的版本，
+所以不要开 preload_app。
+"""
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+
+# gevent: 每个进程可同时挂 worker_connections 个连接；设成 sync 可退回原来的同步模式排查问题
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.getenv('GUNICORN_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# 协程 worker 下 timeout 只看进程心跳，长连接不会被误杀；同步模式下要大于 AI 回复的总时长上限
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 200))
+graceful_timeout = 30
+keepalive = 5
+
+# 单个进程处理一定数量请求后重启，防止内存慢慢涨
+max_requests = 2000
+max_requests_jitter = 200
+
+accesslog = '-'
+errorlog = '-'
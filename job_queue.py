@@ -0,0 +1,297 @@
+"""
+后台任务队列 (Redis)
+
+请求里只把任务丢进队列就返回，和风天气 / WxPusher / Supabase Storage 慢了或挂了都不会拖慢页面
+- 命名队列: 每个队列一个 LIST，worker 按给定顺序取 (排在前面的队列优先)
+- 延时任务: ZSET 按执行时间排，到点搬进队列；失败重试也走这里 (指数退避)
+- 周期任务: 每个周期抢一次 SET NX 锁，多个 worker 同时在跑也只触发一次
+- 重试次数用完的任务进死信列表 jobs:dead，留着排查或手动重新排队 (python worker.py --dead)
+- 正在跑的任务记在 jobs:running (ZSET 任务 id -> 超时时刻)，worker 崩了的话超时后自动重新排队
+没有 Redis 时 (本地开发) 退回进程内：每个任务起一个后台线程执行，失败同样按次数重试
+"""
+import json
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+
+JOB_MAX_RETRIES = int(os.getenv('JOB_MAX_RETRIES', 3))
+JOB_RETRY_BASE = float(os.getenv('JOB_RETRY_BASE', 10))  # 第 n 次重试前等 base * 2^(n-1) 秒
+JOB_TIMEOUT = int(os.getenv('JOB_TIMEOUT', 300))  # 超过这么久没跑完，视为 worker 已经没了
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', 0.5))  # 队列空时多久再看一次
+DEAD_LETTER_MAX = 1000
+
+# 按队列顺序取一个任务，同时登记到 running (取出和登记是原子的，worker 在中间崩了也不会丢任务)
+_CLAIM_LUA = """
+for i = 2, #KEYS do
+    local id = redis.call('RPOP', KEYS[i])
+    if id then
+        redis.call('ZADD', KEYS[1], ARGV[1], id)
+        return id
+    end
+end
+return false
+"""
+
+# 到点的延时任务搬进各自的队列；成员格式 "队列名|任务 id"
+_PROMOTE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, member in ipairs(due) do
+    redis.call('ZREM', KEYS[1], member)
+    local sep = string.find(member, '|', 1, true)
+    redis.call('LPUSH', ARGV[3] .. string.sub(member, 1, sep - 1), string.sub(member, sep + 1))
+end
+return #due
+"""
+
+
+def _s(v):
+    return v.decode() if isinstance(v, bytes) else v
+
+
+class JobQueue:
+    def __init__(self, redis_client=None, prefix='jobs:'):
+        self.redis = redis_client
+        self.prefix = prefix
+        self.tasks = {}  # 任务名 -> (函数, 默认选项)
+        self.periodic = {}  # 任务名 -> (间隔秒, args, kwargs)
+        self._claim = redis_client.register_script(_CLAIM_LUA) if redis_client else None
+        self._promote = redis_client.register_script(_PROMOTE_LUA) if redis_client else None
+        self._local_dead = deque(maxlen=100)
+        self._local_once = {}  # 无 Redis 时的去重: key -> 过期时刻
+        self._local_lock = threading.Lock()
+        self._last_tick = 0
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    def _key(self, *parts):
+        return self.prefix + ':'.join(parts)
+
+    # ---------- 注册 ----------
+
+    def task(self, name=None, queue='default', max_retries=JOB_MAX_RETRIES, timeout=JOB_TIMEOUT):
+        """装饰器: 注册一个任务，默认任务名就是函数名"""
+        def decorator(func):
+            self.tasks[name or func.__name__] = (func, {'queue': queue, 'max_retries': max_retries,
+                                                        'timeout': timeout})
+            return func
+        return decorator
+
+    def every(self, seconds, name, *args, **kwargs):
+        """注册周期任务 (由 worker 触发，没有 Redis 时不跑)"""
+        self.periodic[name] = (seconds, args, kwargs)
+
+    def queues(self):
+        """已注册任务用到的全部队列 (按注册顺序)"""
+        return list(dict.fromkeys(opts['queue'] for _, opts in self.tasks.values()))
+
+    # ---------- 入队 ----------
+
+    def enqueue(self, name, *args, **kwargs):
+        """立即执行，返回任务 id"""
+        return self._push(name, args, kwargs)
+
+    def enqueue_in(self, seconds, name, *args, **kwargs):
+        """seconds 秒后执行"""
+        return self._push(name, args, kwargs, delay=seconds)
+
+    def enqueue_once(self, key, ttl, name, *args, **kwargs):
+        """ttl 秒内同一个 key 只排一次 (比如同一个家庭的天气刷新)，被去重时返回 None"""
+        if self.redis:
+            try:
+                if not self.redis.set(self._key('once', key), 1, nx=True, ex=int(ttl)): return None
+            except Exception as e:
+                print(f"Job Dedupe Error: {e}")
+        else:
+            now = time.time()
+            with self._local_lock:
+                if self._local_once.get(key, 0) > now: return None
+                self._local_once = {k: v for k, v in self._local_once.items() if v > now}
+                self._local_once[key] = now + ttl
+        return self._push(name, args, kwargs)
+
+    def _push(self, name, args, kwargs, delay=0):
+        if name not in self.tasks: raise KeyError(f"未注册的任务: {name}")
+        opts = self.tasks[name][1]
+        job = {'id': uuid.uuid4().hex, 'name': name, 'queue': opts['queue'], 'args': list(args),
+               'kwargs': kwargs, 'attempts': 0, 'max_retries': opts['max_retries'],
+               'timeout': opts['timeout'], 'created_at': time.time()}
+        if self.redis:
+            try:
+                pipe = self.redis.pipeline()
+                pipe.hset(self._key('data'), job['id'], json.dumps(job, ensure_ascii=False))
+                if delay > 0:
+                    pipe.zadd(self._key('delayed'), {f"{job['queue']}|{job['id']}": time.time() + delay})
+                else:
+                    pipe.lpush(self._key('queue', job['queue']), job['id'])
+                pipe.execute()
+                return job['id']
+            except Exception as e:
+                # Redis 挂了不能把活丢了：退回在本进程里跑
+                print(f"Job Enqueue Error ({name}), 改为本地执行: {e}")
+        self._run_local(job, delay)
+        return job['id']
+
+    # ---------- 执行 ----------
+
+    def _execute(self, job):
+        """跑一次任务，成功返回 True；失败时 attempts + 1 并记下错误"""
+        entry = self.tasks.get(job['name'])
+        started = time.perf_counter()
+        try:
+            if not entry: raise KeyError(f"未注册的任务: {job['name']}")
+            entry[0](*job['args'], **job['kwargs'])
+            return True
+        except Exception as e:
+            job['attempts'] += 1
+            job['last_error'] = f"{type(e).__name__}: {e}"
+            print(f"⚠️ 任务失败 {job['name']} (第 {job['attempts']} 次): {job['last_error']}")
+            if job['attempts'] > job['max_retries']: traceback.print_exc()
+            return False
+        finally:
+            cost = (time.perf_counter() - started) * 1000
+            if cost > 5000: print(f"🐢 任务 {job['name']} 耗时 {cost:.0f}ms")
+
+    @staticmethod
+    def _backoff(attempts):
+        return JOB_RETRY_BASE * 2 ** (attempts - 1) * random.uniform(0.8, 1.2)
+
+    def _run_local(self, job, delay=0):
+        def runner():
+            if delay > 0: time.sleep(delay)
+            while not self._execute(job):
+                if job['attempts'] > job['max_retries']:
+                    job['failed_at'] = time.time()
+                    self._local_dead.append(job)
+                    return
+                time.sleep(self._backoff(job['attempts']))
+
+        threading.Thread(target=runner, daemon=True).start()
+
+    def _retry_or_bury(self, job):
+        pipe = self.redis.pipeline()
+        if job['attempts'] <= job['max_retries']:
+            pipe.hset(self._key('data'), job['id'], json.dumps(job, ensure_ascii=False))
+            pipe.zadd(self._key('delayed'), {f"{job['queue']}|{job['id']}": time.time() + self._backoff(job['attempts'])})
+            pipe.hincrby(self._key('stats'), f"{job['name']}:retry", 1)
+        else:
+            job['failed_at'] = time.time()
+            pipe.hdel(self._key('data'), job['id'])
+            pipe.lpush(self._key('dead'), json.dumps(job, ensure_ascii=False))
+            pipe.ltrim(self._key('dead'), 0, DEAD_LETTER_MAX - 1)
+            pipe.hincrby(self._key('stats'), f"{job['name']}:dead", 1)
+            print(f"☠️ 任务 {job['name']} 重试 {job['max_retries']} 次仍失败，已进死信: {job.get('last_error')}")
+        pipe.execute()
+
+    def _process(self, job_id):
+        running = self._key('running')
+        raw = self.redis.hget(self._key('data'), job_id)
+        if not raw:
+            self.redis.zrem(running, job_id)
+            return
+        job = json.loads(raw)
+        if job['timeout'] != JOB_TIMEOUT:
+            self.redis.zadd(running, {job_id: time.time() + job['timeout']}, xx=True)
+        ok = self._execute(job)
+        # 跑太久已经被当成超时重新排队了：以那边为准，这里不再处理
+        if not self.redis.zrem(running, job_id): return
+        if ok:
+            pipe = self.redis.pipeline()
+            pipe.hdel(self._key('data'), job_id)
+            pipe.hincrby(self._key('stats'), f"{job['name']}:ok", 1)
+            pipe.execute()
+        else:
+            self._retry_or_bury(job)
+
+    def tick(self):
+        """搬到点的延时任务、回收超时任务、触发周期任务 (每个 worker 每秒最多做一次)"""
+        now = time.time()
+        if now - self._last_tick < 1: return
+        self._last_tick = now
+
+        self._promote(keys=[self._key('delayed')], args=[now, 100, self._key('queue', '')])
+
+        for job_id in self.redis.zrangebyscore(self._key('running'), '-inf', now, start=0, num=50):
+            if not self.redis.zrem(self._key('running'), job_id): continue  # 别的 worker 已经回收了
+            raw = self.redis.hget(self._key('data'), job_id)
+            if not raw: continue
+            job = json.loads(raw)
+            job['attempts'] += 1
+            job['last_error'] = 'timeout (worker 超时或已退出)'
+            self._retry_or_bury(job)
+
+        for name, (interval, args, kwargs) in self.periodic.items():
+            if self.redis.set(self._key('periodic', name), self.worker_id, nx=True, ex=int(interval)):
+                self._push(name, args, kwargs)
+
+    def work(self, queues=None, stop=None):
+        """worker 主循环 (阻塞)，stop 是 threading.Event，置位后跑完手上的任务就退出"""
+        if not self.redis: raise RuntimeError('任务 worker 需要 Redis')
+        stop = stop or threading.Event()
+        keys = [self._key('running')] + [self._key('queue', q) for q in (queues or self.queues())]
+        while not stop.is_set():
+            try:
+                self.tick()
+                job_id = self._claim(keys=keys, args=[time.time() + JOB_TIMEOUT])
+                if not job_id:
+                    stop.wait(JOB_POLL_SECONDS)
+                    continue
+                self._process(_s(job_id))
+            except Exception as e:
+                print(f"Job Worker Error: {e}")
+                stop.wait(5)
+
+    def start_workers(self, threads=1, queues=None):
+        """在当前进程里起后台 worker 线程，返回用来停止它们的 Event"""
+        stop = threading.Event()
+        if not self.redis or threads <= 0: return stop
+        for i in range(threads):
+            threading.Thread(target=self.work, args=(queues, stop), name=f"job-worker-{i}", daemon=True).start()
+        return stop
+
+    # ---------- 查看 / 维护 ----------
+
+    def stats(self):
+        if not self.redis:
+            return {'mode': 'local', 'dead': len(self._local_dead)}
+        try:
+            pipe = self.redis.pipeline()
+            queues = self.queues()
+            for q in queues: pipe.llen(self._key('queue', q))
+            pipe.zcard(self._key('delayed'))
+            pipe.zcard(self._key('running'))
+            pipe.llen(self._key('dead'))
+            pipe.hgetall(self._key('stats'))
+            res = pipe.execute()
+            n = len(queues)
+            return {'mode': 'redis', 'queues': dict(zip(queues, res[:n])), 'delayed': res[n],
+                    'running': res[n + 1], 'dead': res[n + 2],
+                    'counts': {_s(k): int(v) for k, v in res[n + 3].items()}}
+        except Exception as e:
+            print(f"Job Stats Error: {e}")
+            return {'mode': 'redis', 'error': str(e)}
+
+    def dead_letters(self, limit=20):
+        if not self.redis: return list(self._local_dead)[-limit:][::-1]
+        return [json.loads(raw) for raw in self.redis.lrange(self._key('dead'), 0, limit - 1)]
+
+    def requeue_dead(self, limit=None):
+        """把死信重新排队 (重试次数清零)，返回排了多少个"""
+        done = 0
+        while limit is None or done < limit:
+            if self.redis:
+                raw = self.redis.rpop(self._key('dead'))
+                if not raw: break
+                job = json.loads(raw)
+            else:
+                if not self._local_dead: break
+                job = self._local_dead.popleft()
+            if job['name'] in self.tasks:
+                self._push(job['name'], job['args'], job['kwargs'])
+                done += 1
+            else:
+                print(f"跳过未注册的任务: {job['name']}")
+        return done
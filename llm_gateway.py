@@ -0,0 +1,201 @@
+"""
+大模型网关客户端 (OpenAI 兼容的 /chat/completions)
+
+- 每个模型一个 requests.Session，连接池复用 TCP/TLS，不再每次提问都重新握手
+- 连接/读取分别设超时，流式回复另有总时长上限，上游卡住不会一直占着 worker
+- 每个模型限制同时在跑的请求数，满了直接告诉用户稍后再试
+- 流式回复按行增量解析 SSE，浏览器断开时关闭上游连接并归还名额
+"""
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.getenv('LLM_READ_TIMEOUT', 60))  # 流式时是两段数据之间的最长等待
+STREAM_MAX_SECONDS = float(os.getenv('LLM_STREAM_MAX_SECONDS', 180))  # 一次回复的总时长上限
+MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 8))  # 每个模型同时在跑的请求数
+ACQUIRE_TIMEOUT = float(os.getenv('LLM_ACQUIRE_TIMEOUT', 3))  # 排队等名额的最长时间
+POOL_SIZE = MAX_CONCURRENCY
+# 流式读取粒度：chunked 响应按上游分块立即返回，非 chunked 时凑够这么多字节就解析，太大会让首字变慢
+STREAM_READ_BYTES = 64
+
+_sessions = {}
+_slots = {}
+_lock = threading.Lock()
+
+
+class LLMError(Exception):
+    """上游返回错误 (非 200 或返回内容看不懂)"""
+
+
+class LLMBusy(LLMError):
+    """该模型并发已满"""
+
+
+def _model_key(model):
+    # 管理员换了地址/密钥就是另一套连接
+    return (model.get('id'), model['api_url'].rstrip('/'), model.get('api_key'))
+
+
+def _get_session(model):
+    key = _model_key(model)
+    with _lock:
+        sess = _sessions.get(key)
+        if sess is None:
+            sess = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0)
+            sess.mount('https://', adapter)
+            sess.mount('http://', adapter)
+            sess.headers.update({
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {model.get('api_key')}"
+            })
+            _sessions[key] = sess
+        return sess
+
+
+def _get_slot(model):
+    key = _model_key(model)
+    with _lock:
+        slot = _slots.get(key)
+        if slot is None:
+            slot = threading.BoundedSemaphore(MAX_CONCURRENCY)
+            _slots[key] = slot
+        return slot
+
+
+def _post(model, payload, stream):
+    """占名额 + 发请求；失败时名额已归还"""
+    slot = _get_slot(model)
+    if not slot.acquire(timeout=ACQUIRE_TIMEOUT):
+        raise LLMBusy(f"模型 {model.get('model_code')} 并发已满")
+    try:
+        url = model['api_url'].rstrip('/') + "/chat/completions"
+        resp = _get_session(model).post(url, json=payload, stream=stream,
+                                        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        if resp.status_code != 200:
+            body = resp.text[:300]
+            resp.close()
+            raise LLMError(f"HTTP {resp.status_code}: {body}")
+        return slot, resp
+    except Exception:
+        slot.release()
+        raise
+
+
+def chat(model, messages, **params):
+    """非流式：返回 (完整回复文本, usage 字典或 None)"""
+    payload = dict(params, model=model['model_code'], messages=messages, stream=False)
+    slot, resp = _post(model, payload, stream=False)
+    try:
+        data = resp.json()
+    except ValueError:
+        raise LLMError(f"返回内容不是 JSON: {resp.text[:300]}")
+    finally:
+        resp.close()
+        slot.release()
+    try:
+        return data['choices'][0]['message']['content'], data.get('usage')
+    except (KeyError, IndexError, TypeError):
+        raise LLMError(f"API Error: {data}")
+
+
+def iter_sse_data(lines, deadline=None):
+    """
+    增量解析 SSE：逐行读入，遇到空行时把累积的 data 字段作为一个事件吐出
+    忽略注释行 (: keep-alive) 和 event/id 等字段
+    deadline: time.monotonic() 的截止时刻，每读一行 (包括被忽略的 keep-alive) 都检查，超时抛 LLMError
+    """
+    buf = []
+    for raw in lines:
+        if deadline is not None and time.monotonic() > deadline:
+            raise LLMError(f"回复超过 {STREAM_MAX_SECONDS:.0f} 秒，已中断")
+        line = raw.decode('utf-8', 'replace') if isinstance(raw, bytes) else raw
+        line = line.rstrip('\r')
+        if not line:
+            if buf:
+                yield '\n'.join(buf)
+                buf = []
+            continue
+        if line.startswith(':'): continue
+        field, _, value = line.partition(':')
+        if field == 'data':
+            buf.append(value[1:] if value.startswith(' ') else value)
+    if buf:
+        yield '\n'.join(buf)
+
+
+class LLMStream:
+    """
+    流式回复：迭代得到文本片段
+    close() 会断开上游并归还名额 (Flask 在浏览器断开或响应结束时调用)
+    中途出错/超时时，若设置了 error_text 就把它作为最后一段吐给用户
+    on_complete: 完整正常结束时回调 on_complete(全文, usage) (出错或被中途断开时不调用)
+    usage: 上游在最后一个分块里带了用量 (prompt_tokens/completion_tokens) 时记在这里
+    """
+
+    def __init__(self, slot, resp, error_text=None, on_complete=None):
+        self._slot = slot
+        self._resp = resp
+        self._closed = False
+        self.error_text = error_text
+        self.on_complete = on_complete
+        self.error = None
+        self.usage = None
+
+    def __iter__(self):
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        parts = []
+        try:
+            lines = self._resp.iter_lines(chunk_size=STREAM_READ_BYTES)
+            for data in iter_sse_data(lines, deadline):
+                # 先查总时长：只发 keep-alive / 用量分块 / 坏数据的上游也不能一直占着名额
+                if time.monotonic() > deadline:
+                    raise LLMError(f"回复超过 {STREAM_MAX_SECONDS:.0f} 秒，已中断")
+                if data.strip() == '[DONE]': break
+                try:
+                    chunk = json.loads(data)
+                    if chunk.get('usage'): self.usage = chunk['usage']
+                    if not chunk.get('choices'): continue  # 只带用量的收尾分块
+                    content = (chunk['choices'][0].get('delta') or {}).get('content')
+                except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                    continue
+                if content:
+                    parts.append(content)
+                    yield content
+            if self.on_complete:
+                try:
+                    self.on_complete(''.join(parts), self.usage)
+                except Exception as e:
+                    print(f"LLM Stream Callback Error: {e}")
+        except (requests.RequestException, LLMError) as e:
+            self.error = e
+            print(f"LLM Stream Error: {e}")
+            if self.error_text: yield self.error_text
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed: return
+        self._closed = True
+        try:
+            self._resp.close()
+        finally:
+            self._slot.release()
+
+    def __del__(self):
+        # 兜底：响应还没开始迭代就被丢弃时也要归还名额
+        self.close()
+
+
+def stream_chat(model, messages, error_text=None, on_complete=None, **params):
+    """流式：先建立上游连接 (出错在这里直接抛)，再返回可迭代的 LLMStream"""
+    payload = dict(params, model=model['model_code'], messages=messages, stream=True)
+    # 让上游在最后一个分块里带上用量，否则流式回复只能按估算值记账
+    payload.setdefault('stream_options', {'include_usage': True})
+    slot, resp = _post(model, payload, stream=True)
+    return LLMStream(slot, resp, error_text=error_text, on_complete=on_complete)
@@ -0,0 +1,88 @@
+-- =====================================================================
+-- 点赞原子切换 + 点赞数冗余字段
+-- 在 Supabase SQL Editor 里执行一次即可 (可重复执行)
+-- =====================================================================
+
+-- 1. 动态表增加点赞数，并用现有数据回填
+alter table public.moments add column if not exists like_count integer not null default 0;
+
+update public.moments m
+set like_count = (select count(*) from public.moment_likes l where l.moment_id = m.id);
+
+-- 2. 同一个人对同一条动态只能有一个赞 (先清理历史重复数据)
+delete from public.moment_likes a
+using public.moment_likes b
+where a.moment_id = b.moment_id and a.user_id = b.user_id and a.ctid > b.ctid;
+
+create unique index if not exists moment_likes_moment_user_key
+    on public.moment_likes (moment_id, user_id);
+
+-- 3. 触发器维护 like_count
+--    security definer: 点赞人没有改别人动态的权限，由触发器代为更新计数
+create or replace function public.sync_moment_like_count()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+    if tg_op = 'INSERT' then
+        update moments set like_count = like_count + 1 where id = new.moment_id;
+    elsif tg_op = 'DELETE' then
+        update moments set like_count = greatest(like_count - 1, 0) where id = old.moment_id;
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists moment_likes_count on public.moment_likes;
+create trigger moment_likes_count
+    after insert or delete on public.moment_likes
+    for each row execute function public.sync_moment_like_count();
+
+-- 4. 原子切换点赞，一次调用返回 新状态 + 点赞数 + 点赞人
+--    security invoker: 删/插仍受 moment_likes 的 RLS 约束
+--    advisory lock 把同一人对同一动态的连点串行化，配合唯一索引杜绝重复插入
+--    p_user_id: 只有 service_role (后台上帝模式用管理员客户端代操作) 时才采用，普通用户一律以 auth.uid() 为准
+drop function if exists public.toggle_moment_like(bigint);
+
+create or replace function public.toggle_moment_like(p_moment_id bigint, p_user_id uuid default null)
+returns json
+language plpgsql
+security invoker
+set search_path = public
+as $$
+declare
+    v_uid uuid := coalesce(auth.uid(), case when auth.role() = 'service_role' then p_user_id end);
+    v_liked boolean;
+begin
+    if v_uid is null then
+        raise exception 'not authenticated';
+    end if;
+
+    perform pg_advisory_xact_lock(hashtextextended(v_uid::text || ':' || p_moment_id::text, 0));
+
+    delete from moment_likes where moment_id = p_moment_id and user_id = v_uid;
+    if found then
+        v_liked := false;
+    else
+        insert into moment_likes (moment_id, user_id) values (p_moment_id, v_uid)
+        on conflict (moment_id, user_id) do nothing;
+        v_liked := true;
+    end if;
+
+    return json_build_object(
+        'is_liked', v_liked,
+        'like_count', (select like_count from moments where id = p_moment_id),
+        'likers', coalesce((
+            select json_agg(json_build_object('id', p.id, 'display_name', p.display_name,
+                                              'avatar_url', p.avatar_url))
+            from moment_likes l
+            join profiles p on p.id = l.user_id
+            where l.moment_id = p_moment_id
+        ), '[]'::json)
+    );
+end;
+$$;
+
+grant execute on function public.toggle_moment_like(bigint, uuid) to authenticated, service_role;
@@ -0,0 +1,44 @@
+-- =====================================================================
+-- 兑换券按批次存储 + 原子核销
+-- 一次发 N 张只写一行 (quantity = remaining = N)，核销一次 remaining - 1
+-- 在 Supabase SQL Editor 里执行一次即可 (可重复执行)
+-- =====================================================================
+
+-- 1. 批次字段，旧数据每行就是 1 张
+--    remaining: 还没用掉的张数 (作废的批次保留作废时剩余的张数，亲密度扣分要用)
+alter table public.family_coupons add column if not exists quantity integer not null default 1;
+alter table public.family_coupons add column if not exists remaining integer not null default 1;
+
+update public.family_coupons set remaining = 0 where status = 'used' and quantity = 1 and remaining = 1;
+
+do $$
+begin
+    if not exists (select 1 from pg_constraint where conname = 'family_coupons_remaining_check') then
+        alter table public.family_coupons
+            add constraint family_coupons_remaining_check check (remaining >= 0 and remaining <= quantity);
+    end if;
+end;
+$$;
+
+-- 2. 原子核销：一条 UPDATE ... WHERE status = 'active' RETURNING
+--    用完最后一张时状态变为 used
+--    security invoker: 谁能核销仍由 family_coupons 的 RLS 决定 (和原来直接 update 一样)
+drop function if exists public.redeem_coupon(bigint, uuid);
+
+create or replace function public.redeem_coupon(p_coupon_id bigint)
+returns setof public.family_coupons
+language sql
+security invoker
+set search_path = public
+as $$
+    update family_coupons
+    set remaining = remaining - 1,
+        status = case when remaining - 1 <= 0 then 'used' else status end,
+        used_at = now()
+    where id = p_coupon_id
+      and status = 'active'
+      and remaining > 0
+    returning *;
+$$;
+
+grant execute on function public.redeem_coupon(bigint) to authenticated, service_role;
@@ -0,0 +1,60 @@
+-- =====================================================================
+-- AI 问诊用量记录 + 按模型的上下文预算
+-- 在 Supabase SQL Editor 里执行一次即可 (可重复执行)
+-- =====================================================================
+
+-- 1. 每次问诊一行：token 用量来自模型返回的 usage，没有时按估算值记 (estimated = true)
+--    cached: 命中了常见问题缓存，没有调用模型
+--    dropped_turns: 因为超出预算被裁掉的历史消息条数
+create table if not exists public.ai_usage_logs (
+    id bigserial primary key,
+    user_id uuid references auth.users (id) on delete set null,
+    model_code text,
+    mode text not null default 'text',  -- text / vision
+    prompt_tokens integer not null default 0,
+    completion_tokens integer not null default 0,
+    estimated boolean not null default false,
+    cached boolean not null default false,
+    dropped_turns integer not null default 0,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists ai_usage_logs_created_at_idx on public.ai_usage_logs (created_at desc);
+
+-- 只由后端 service key 读写，普通用户不可见
+alter table public.ai_usage_logs enable row level security;
+
+-- 2. 模型的历史消息预算 (token)，为空时用后端默认值
+alter table public.ai_models add column if not exists history_budget integer;
+
+-- 3. 后台用量汇总：按 (北京时间日期, 模型) 在库里聚合
+--    直接查明细会被 PostgREST 的 max-rows (默认 1000) 截断，用量一多汇总就偏小
+create or replace function public.ai_usage_summary(p_since timestamptz)
+returns table (
+    day date,
+    model_code text,
+    requests bigint,
+    prompt_tokens bigint,
+    completion_tokens bigint,
+    cached bigint,
+    trimmed bigint
+)
+language sql
+stable
+security invoker
+set search_path = public
+as $$
+    select (l.created_at at time zone 'Asia/Shanghai')::date,
+           l.model_code,
+           count(*),
+           coalesce(sum(l.prompt_tokens), 0),
+           coalesce(sum(l.completion_tokens), 0),
+           count(*) filter (where l.cached),
+           count(*) filter (where l.dropped_turns > 0)
+    from ai_usage_logs l
+    where l.created_at >= p_since
+    group by 1, 2;
+$$;
+
+revoke execute on function public.ai_usage_summary(timestamptz) from public, anon, authenticated;
+grant execute on function public.ai_usage_summary(timestamptz) to service_role;
@@ -1,8 +1,89 @@
+// ================= 全家牵挂 Service Worker =================
+// 版本号由 /sw.js 路由在返回时替换成 CURRENT_APP_VERSION，发新版时旧缓存会被整体清掉
+const APP_VERSION = '__APP_VERSION__';
+const STATIC_CACHE = `static-v${APP_VERSION}`;   // /static/ 下的图标、天气图标、manifest
+const SHELL_CACHE = `shell-v${APP_VERSION}`;     // 离线页等壳资源
+const API_CACHE = `api-v${APP_VERSION}`;         // 红黑榜、排行榜这类可以先显示旧数据的接口
+
+const OFFLINE_URL = '/offline';
+const PRECACHE_URLS = [
+    OFFLINE_URL,
+    '/static/icon.png',
+    '/static/default_cover.png',
+    '/static/manifest.json',
+];
+
+// 先用缓存秒开，同时后台拉新数据，下次打开就是新的
+const SWR_PATHS = ['/api/food_guide', '/api/snake/leaderboard'];
+
 self.addEventListener('install', (e) => {
-    self.skipWaiting();
+    e.waitUntil(
+        caches.open(SHELL_CACHE)
+            .then(cache => cache.addAll(PRECACHE_URLS))
+            .then(() => self.skipWaiting())
+    );
 });
 
+self.addEventListener('activate', (e) => {
+    const keep = [STATIC_CACHE, SHELL_CACHE, API_CACHE];
+    e.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys.filter(k => !keep.includes(k)).map(k => caches.delete(k))))
+            .then(() => self.clients.claim())
+    );
+});
+
+// /static/：缓存优先，没有再走网络并存一份 (模板里的地址带内容指纹 ?v=，文件变了地址就变)
+function cacheFirst(request) {
+    return caches.open(STATIC_CACHE).then(cache =>
+        cache.match(request).then(hit => {
+            if (hit) return hit;
+            return fetch(request).then(resp => {
+                if (resp.ok) cache.put(request, resp.clone());
+                return resp;
+            });
+        })
+    );
+}
+
+// 接口：有缓存先返回缓存，同时后台刷新；没缓存就等网络
+function staleWhileRevalidate(request, event) {
+    return caches.open(API_CACHE).then(cache =>
+        cache.match(request).then(hit => {
+            const network = fetch(request).then(resp => {
+                // 被重定向到登录页之类的结果不要存
+                if (resp.ok && !resp.redirected) cache.put(request, resp.clone());
+                return resp;
+            });
+            if (hit) {
+                event.waitUntil(network.catch(() => null));
+                return hit;
+            }
+            return network;
+        })
+    );
+}
+
 self.addEventListener('fetch', (e) => {
-    // 直接透传，不缓存，保证你改代码后刷新就能看到
-    e.respondWith(fetch(e.request));
-});
\ No newline at end of file
+    const request = e.request;
+    if (request.method !== 'GET') return;
+
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) return;
+
+    // 页面：始终走网络 (内容因人而异，不缓存)，断网时给离线页
+    if (request.mode === 'navigate') {
+        e.respondWith(fetch(request).catch(() => caches.match(OFFLINE_URL)));
+        return;
+    }
+
+    if (url.pathname.startsWith('/static/')) {
+        e.respondWith(cacheFirst(request));
+        return;
+    }
+
+    if (SWR_PATHS.includes(url.pathname)) {
+        e.respondWith(staleWhileRevalidate(request, e));
+    }
+    // 其它请求 (提醒推送、AI 问诊、表单等) 不拦截，浏览器照常处理
+});
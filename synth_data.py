@@ -0,0 +1,428 @@
+"""
+模拟数据生成器 (压测 / 容量评估用)
+
+按线上数据的形状造数据：每个家庭 2~8 人 (少数人同时在两个家庭)、1~4 只宠物、建家以来每天的喂食/遛狗/拍照日志、
+动态和点赞、各种状态的兑换券 (批次 quantity/remaining 和 sql/002 一致)、拍一拍 👋 和系统通知、
+农历生日/公历纪念日/倒计时、许愿、收纳、采购、Wi-Fi、备忘录、足迹、每周荣誉。
+
+- 规模: --scale 1 约等于目前线上的量级 (BASE_FAMILIES 个家庭，估算值，按需调整)，10 / 100 就是 10 倍 / 100 倍家庭数
+- 确定性: 同样的 --seed 和 --anchor 输出逐字节一致；每个家庭用独立的随机源，所以 1× 的数据就是 10× 的前一部分
+- anchor: 数据里的"现在"，默认当前时间 (这样首页有今天的日志)；要跨天复现同一份数据就固定它
+
+用法:
+    python synth_data.py --scale 1 --out synth_1x.json                 # 给 fake_supabase / bench_routes.py 用
+    python synth_data.py --scale 10 --format sql --out synth_10x.sql   # 导入本地 Postgres
+    psql "$DB_CONNECTION_STRING" -f synth_10x.sql
+100× 的日志有几百万行，只适合导 SQL (边生成边写文件)；内存替身建议不超过 10×
+"""
+import argparse
+import json
+import random
+import string
+import sys
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+BASE_FAMILIES = 15  # 1× 的家庭数
+TABLE_ORDER = [  # 导入顺序 (被引用的表在前)
+    'profiles', 'families', 'family_members', 'pets', 'pet_owners', 'logs', 'moments', 'moment_likes',
+    'family_reminders', 'family_coupons', 'family_events', 'family_wishes', 'family_footprints',
+    'family_inventory', 'family_shopping_list', 'family_wifis', 'family_memos', 'family_weekly_honors',
+    'app_updates',
+]
+
+SURNAMES = '王李张刘陈杨黄赵吴周徐孙马朱胡郭何林罗高'
+MEMBER_NAMES = ['爸爸', '妈妈', '爷爷', '奶奶', '外公', '外婆', '哥哥', '姐姐', '弟弟', '妹妹', '小宝', '舅舅', '小姨']
+PET_NAMES = ['咪咪', '豆豆', '旺财', '球球', '可乐', '布丁', '年糕', '奶茶', '元宝', '花花', '来福', '团子']
+CITIES = [('101010100', '北京', 39.90, 116.40), ('101020100', '上海', 31.23, 121.47),
+          ('101280101', '广州', 23.13, 113.26), ('101280601', '深圳', 22.54, 114.06),
+          ('101210101', '杭州', 30.27, 120.15), ('101270101', '成都', 30.57, 104.07),
+          ('101200101', '武汉', 30.59, 114.31), ('101190101', '南京', 32.06, 118.80)]
+DISHES = ['红烧肉', '糖醋排骨', '酸菜鱼', '火锅', '饺子', '小龙虾', '烤鸭', '螺蛳粉', '蛋糕', '奶茶']
+COUPON_TITLES = ['洗碗券', '按摩券', '免做家务券', '零食券', '陪玩券', '遛狗代劳券']
+REMINDERS = ['记得给猫换水', '今晚早点回家', '明天降温多穿点', '快递到了记得拿', '猫粮快没了', '周末一起吃饭']
+EVENTS_LUNAR = ['奶奶生日', '爷爷生日', '外婆生日', '妈妈农历生日']
+EVENTS_SOLAR = ['结婚纪念日', '爸爸生日', '宝宝生日', '第一次见面', '搬家纪念日']
+EVENTS_ONCE = ['考研倒计时', '出国旅行', '宝宝开学', '装修完工']
+
+
+def _uid(rnd):
+    return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+
+def _ts(dt):
+    return dt.isoformat()
+
+
+def _at(rnd, day_start, anchor):
+    """当天里的随机时刻 (不超过 anchor)"""
+    return min(day_start + timedelta(seconds=rnd.randint(6 * 3600, 23 * 3600 + 59 * 60)), anchor)
+
+
+class _Ids:
+    """各表自增 id (生成顺序固定，所以 id 也是确定的)"""
+
+    def __init__(self):
+        self._n = defaultdict(int)
+
+    def next(self, table):
+        self._n[table] += 1
+        return self._n[table]
+
+
+def parse_anchor(text=None):
+    if not text: return datetime.now(timezone.utc).replace(microsecond=0)
+    dt = datetime.fromisoformat(text)
+    if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc)
+    if len(text) <= 10: dt = dt.replace(hour=12)  # 只给日期时取当天中午 (北京时间晚上)，当天已有数据
+    return dt
+
+
+def iter_dataset(scale=1, seed=42, anchor=None):
+    """
+    逐个家庭生成数据，yield (表名, 行)；同一张表里每行的字段固定
+    最先 yield 一行 ('__actors__', {...})：压测用的普通用户 / 管理员 / 家庭
+    """
+    anchor = anchor or parse_anchor()
+    ids = _Ids()
+    n_families = max(1, int(round(BASE_FAMILIES * scale)))
+    head = random.Random(f"{seed}:global")
+
+    admin_id = _uid(head)
+    yield '__actors__', {'admin': admin_id, 'user': None, 'family_id': None, 'families': n_families}
+    yield 'profiles', _profile(admin_id, '管理员', 'admin', anchor - timedelta(days=1200), None, None)
+
+    for i in range(10):
+        yield 'app_updates', {
+            'id': ids.next('app_updates'), 'version': f"4.{i // 3}.{i % 3}",
+            'content': f"第 {i + 1} 次更新\n修复若干问题", 'is_pushed': i == 9,  # 同一时间只有一条在推送
+            'created_at': _ts(anchor - timedelta(days=(10 - i) * 30)),
+        }
+
+    prev_members = []
+    for fid in range(1, n_families + 1):
+        rnd = random.Random(f"{seed}:family:{fid}")
+        rows = _family_rows(rnd, ids, fid, anchor, prev_members)
+        members = []
+        for table, row in rows:
+            if table == 'family_members': members.append(row['user_id'])
+            yield table, row
+        prev_members = members
+
+
+def _profile(pid, name, role, created, avatar, wx_uid, snake=None):
+    return {
+        'id': pid, 'display_name': name, 'role': role, 'status': 'online', 'email': f"{pid[:8]}@family.local",
+        'avatar_url': avatar, 'wx_uid': wx_uid, 'snake_high_score': snake,
+        'is_elder_mode': False, 'is_dark_mode': False, 'created_at': _ts(created),
+    }
+
+
+def _family_rows(rnd, ids, fid, anchor, prev_members):
+    """一个家庭的全部数据 (返回列表，家庭之间互不影响)"""
+    out = []
+    add = lambda table, row: out.append((table, row))
+    created = anchor - timedelta(days=rnd.randint(90, 1100), seconds=rnd.randint(0, 86399))
+    surname = rnd.choice(SURNAMES)
+
+    # ---------- 成员 ----------
+    size = rnd.choices(range(2, 9), weights=[2, 5, 5, 3, 2, 1, 1])[0]
+    members = []
+    names = rnd.sample(MEMBER_NAMES, min(size, len(MEMBER_NAMES)))
+    shared = prev_members and rnd.random() < 0.2  # 少数人同时在两个家庭 (如老人在两个子女家)
+    if shared: members.append(prev_members[-1])
+    while len(members) < size:
+        pid = _uid(rnd)
+        members.append(pid)
+        add('profiles', _profile(
+            pid, f"{surname}{names[len(members) % len(names)]}", 'user',
+            created - timedelta(days=rnd.randint(0, 30)),
+            f"avatar_{pid[:8]}.jpg" if rnd.random() < 0.6 else None,
+            f"UID_{pid[:12]}" if rnd.random() < 0.4 else None,
+            rnd.randint(10, 900) if rnd.random() < 0.3 else None,
+        ))
+
+    home, away = rnd.sample(CITIES, 2)
+    reunion = anchor + timedelta(days=rnd.randint(3, 120)) if rnd.random() < 0.4 else None
+    add('families', {
+        'id': fid, 'name': f"{surname}家的小窝", 'created_by': members[0], 'created_at': _ts(created),
+        'invite_code': ''.join(rnd.choice(string.ascii_uppercase + string.digits) for _ in range(6)),
+        'reunion_date': reunion.strftime('%Y-%m-%d') if reunion else None,
+        'reunion_name': '回家' if reunion else None,
+        'location_home_id': home[0], 'location_home_name': home[1], 'location_home_lat': home[2],
+        'location_home_lon': home[3], 'location_away_id': away[0], 'location_away_name': away[1],
+        'location_away_lat': away[2], 'location_away_lon': away[3],
+        'weather_data_home': None, 'weather_data_away': None,
+        'last_weather_update': _ts(anchor),  # 天气缓存视为新的，压测不去请求和风天气
+        'wx_topic_id': None,
+    })
+    for m in members:
+        add('family_members', {'id': ids.next('family_members'), 'family_id': fid, 'user_id': m,
+                               'created_at': _ts(created + timedelta(days=rnd.randint(0, 20)))})
+
+    days = (anchor - created).days
+    day0 = created.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    # ---------- 宠物 + 日志 ----------
+    for _ in range(rnd.choices([1, 2, 3, 4], weights=[4, 4, 2, 1])[0]):
+        pet_id = ids.next('pets')
+        kind = rnd.choice(['cat', 'cat', 'dog'])
+        pet_start = rnd.randint(0, max(days // 3, 1))
+        add('pets', {
+            'id': pet_id, 'name': rnd.choice(PET_NAMES), 'type': kind, 'family_id': fid,
+            'birthday': (created - timedelta(days=rnd.randint(60, 2000))).strftime('%Y-%m-%d'),
+            'weight': round(rnd.uniform(3, 30 if kind == 'dog' else 8), 1), 'gender': rnd.choice(['male', 'female']),
+            'vaccine_date': None, 'deworm_date': None, 'avatar_url': None,
+            'created_at': _ts(day0 + timedelta(days=pet_start, hours=10)),
+        })
+        owners = rnd.sample(members, rnd.randint(1, min(3, len(members))))
+        for o in owners:
+            add('pet_owners', {'id': ids.next('pet_owners'), 'pet_id': pet_id, 'user_id': o})
+        for d in range(pet_start, days + 1):
+            day_start = day0 + timedelta(days=d)
+            actions = ['feed'] * rnd.randint(1, 3)
+            if kind == 'dog': actions += ['walk'] * rnd.randint(0, 2)
+            if rnd.random() < 0.15: actions.append('photo')
+            times = sorted(_at(rnd, day_start, anchor) for _ in actions)  # id 顺序和时间顺序一致
+            for action, at in zip(rnd.sample(actions, len(actions)), times):
+                log_id = ids.next('logs')
+                who = rnd.choice(owners) if rnd.random() < 0.7 else rnd.choice(members)
+                add('logs', {'id': log_id, 'pet_id': pet_id, 'user_id': who, 'action': action,
+                             'image_path': f"pet_{log_id}.jpg" if action == 'photo' else None,
+                             'created_at': _ts(at)})
+
+    # ---------- 动态 + 点赞 ----------
+    activity = rnd.uniform(0.2, 1.5)  # 这个家庭每天大概发几条
+    for d in range(days + 1):
+        day_start = day0 + timedelta(days=d)
+        for _ in range(int(activity) + (1 if rnd.random() < activity % 1 else 0)):
+            mid = ids.next('moments')
+            author = rnd.choice(members)
+            likers = [m for m in members if m != author and rnd.random() < 0.35]
+            add('moments', {
+                'id': mid, 'user_id': author, 'content': f"今天的日常 #{mid}",
+                'target_family_id': fid if rnd.random() < 0.75 else None,
+                'image_path': f"moment_{mid}.jpg" if rnd.random() < 0.5 else None,
+                'like_count': len(likers), 'created_at': _ts(_at(rnd, day_start, anchor)),
+            })
+            for liker in likers:
+                add('moment_likes', {'id': ids.next('moment_likes'), 'moment_id': mid, 'user_id': liker,
+                                     'created_at': _ts(_at(rnd, day_start, anchor))})
+
+        # ---------- 提醒 (拍一拍 / 留言 / 系统通知) ----------
+        for _ in range(rnd.choices([0, 1, 2, 3], weights=[5, 3, 1, 1])[0]):
+            sender = rnd.choice(members)
+            kind = rnd.random()
+            target, sender_name = None, '系统'
+            sender_label = f"家人{members.index(sender) + 1}"
+            if kind < 0.5 and len(members) > 1:
+                target = rnd.choice([m for m in members if m != sender])
+                content = f"👋 {sender_label} 拍了拍 家人{members.index(target) + 1}"
+            elif kind < 0.8:
+                content, sender_name = rnd.choice(REMINDERS), sender_label
+            elif len(members) > 1:
+                target = rnd.choice([m for m in members if m != sender])
+                content = rnd.choice([f"🎟️ {sender_label} 给你发了 2 张【洗碗券】！",
+                                      f"🚫 {sender_label} 作废了给你的【按摩券】",
+                                      f"🎫 {sender_label} 使用了【零食券】，请兑现！"])
+            else:
+                content, sender_name = rnd.choice(REMINDERS), sender_label
+            add('family_reminders', {
+                'id': ids.next('family_reminders'), 'family_id': fid, 'content': content,
+                'sender_name': sender_name, 'created_by': sender, 'target_user_id': target,
+                'created_at': _ts(_at(rnd, day_start, anchor)),
+            })
+
+    # ---------- 兑换券 (各种状态) ----------
+    if len(members) > 1:
+        for _ in range(max(1, days // 30) * rnd.randint(1, 2)):
+            creator, target = rnd.sample(members, 2)
+            qty = rnd.choice([1, 1, 2, 3, 5])
+            status = rnd.choices(['active', 'used', 'void'], weights=[5, 4, 1])[0]
+            if status == 'used':
+                remaining = 0
+            elif status == 'void':
+                remaining = rnd.randint(1, qty)
+            else:
+                remaining = rnd.randint(1, qty)
+            at = day0 + timedelta(days=rnd.randint(0, days), hours=rnd.randint(8, 22))
+            add('family_coupons', {
+                'id': ids.next('family_coupons'), 'family_id': fid, 'creator_id': creator,
+                'target_user_id': target, 'title': rnd.choice(COUPON_TITLES), 'status': status,
+                'quantity': qty, 'remaining': remaining,
+                'used_at': _ts(min(at + timedelta(days=rnd.randint(1, 20)), anchor)) if remaining < qty else None,
+                'created_at': _ts(min(at, anchor)),
+            })
+
+    # ---------- 纪念日 (农历生日 / 公历纪念日 / 一次性倒计时) ----------
+    for _ in range(rnd.randint(1, 5)):
+        kind = rnd.random()
+        if kind < 0.4:
+            title, event_type, repeat = rnd.choice(EVENTS_LUNAR), 'lunar', True
+            date = f"{rnd.randint(1940, 2015)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}"  # 农历月日
+        elif kind < 0.8:
+            title, event_type, repeat = rnd.choice(EVENTS_SOLAR), 'solar', True
+            date = (anchor - timedelta(days=rnd.randint(200, 9000))).strftime('%Y-%m-%d')
+        else:
+            title, event_type, repeat = rnd.choice(EVENTS_ONCE), 'solar', False
+            date = (anchor + timedelta(days=rnd.randint(5, 300))).strftime('%Y-%m-%d')
+        add('family_events', {'id': ids.next('family_events'), 'family_id': fid, 'title': title,
+                              'event_date': date, 'event_type': event_type, 'is_repeat': repeat,
+                              'created_at': _ts(created)})
+
+    # ---------- 许愿 / 足迹 / 收纳 / 采购 / Wi-Fi / 备忘录 ----------
+    def when():
+        return _ts(min(day0 + timedelta(days=rnd.randint(0, days), hours=rnd.randint(8, 22)), anchor))
+
+    for _ in range(rnd.randint(3, 30)):
+        add('family_wishes', {'id': ids.next('family_wishes'), 'family_id': fid, 'content': rnd.choice(DISHES),
+                              'created_by': rnd.choice(members),
+                              'status': rnd.choices(['wanted', 'bought', 'eaten'], weights=[3, 1, 4])[0],
+                              'created_at': when()})
+    for city in rnd.sample(CITIES, rnd.randint(0, 5)):
+        add('family_footprints', {'id': ids.next('family_footprints'), 'family_id': fid, 'city_id': city[0],
+                                  'city_name': city[1], 'lat': city[2], 'lon': city[3],
+                                  'created_by': rnd.choice(members), 'created_at': when()})
+    for n in range(rnd.randint(0, 20)):
+        inv_id = ids.next('family_inventory')
+        add('family_inventory', {'id': inv_id, 'family_id': fid, 'item_name': f"物品{n + 1}",
+                                 'location': rnd.choice(['客厅柜子', '卧室抽屉', '阳台', '储物间']),
+                                 'image_path': f"inv_{inv_id}.jpg" if rnd.random() < 0.4 else None,
+                                 'created_by': rnd.choice(members), 'created_at': when()})
+    for n in range(rnd.randint(0, 15)):
+        add('family_shopping_list', {'id': ids.next('family_shopping_list'), 'family_id': fid,
+                                     'content': rnd.choice(['猫砂', '狗粮', '牛奶', '纸巾', '鸡蛋', '洗衣液']),
+                                     'is_bought': rnd.random() < 0.6, 'created_by': rnd.choice(members),
+                                     'created_at': when()})
+    for n in range(rnd.randint(0, 2)):
+        add('family_wifis', {'id': ids.next('family_wifis'), 'family_id': fid, 'ssid': f"{surname}-Home-{n + 1}",
+                             'password': ''.join(rnd.choice(string.ascii_letters) for _ in range(10)),
+                             'location': rnd.choice(['家里', '老家']), 'created_at': when()})
+    for n in range(rnd.randint(0, 5)):
+        add('family_memos', {'id': ids.next('family_memos'), 'family_id': fid, 'title': f"备忘 {n + 1}",
+                             'content': '门锁密码在抽屉里', 'created_at': when()})
+
+    # ---------- 每周荣誉 (上上周及以前都已结算，上周留给 /api/family_stats 懒加载) ----------
+    bj = timezone(timedelta(hours=8))
+    week = (created.astimezone(bj) + timedelta(days=7 - created.astimezone(bj).weekday()))
+    while week < anchor.astimezone(bj) - timedelta(days=14):
+        year, num, _ = week.isocalendar()
+        winner = rnd.choice(members)
+        add('family_weekly_honors', {
+            'id': ids.next('family_weekly_honors'), 'family_id': fid, 'week_str': f"{year}-W{num}",
+            'winner_id': winner, 'title': rnd.choice(['守护之星', '记录达人', '美食家', '关怀大使']),
+            'score_data': {'total': rnd.randint(5, 80)}, 'created_at': _ts(week + timedelta(days=7)),
+        })
+        week += timedelta(days=7)
+    return out
+
+
+def generate(scale=1, seed=42, anchor=None):
+    """一次性生成到内存: 返回 (tables, actors)，tables 可以直接交给 fake_supabase.FakeSupabase"""
+    tables = {name: [] for name in TABLE_ORDER}
+    actors = {}
+    for table, row in iter_dataset(scale, seed, anchor):
+        if table == '__actors__':
+            actors = row
+            continue
+        tables[table].append(row)
+    actors['user'], actors['family_id'] = pick_bench_user(tables)
+    return tables, actors
+
+
+def pick_bench_user(tables):
+    """压测账号：所在家庭最多、其次家人最多的那个人 (首页要拉的数据最多)，返回 (user_id, 其中人数最多的家庭)"""
+    fams = defaultdict(list)
+    size = defaultdict(int)
+    for m in tables['family_members']:
+        fams[m['user_id']].append(m['family_id'])
+        size[m['family_id']] += 1
+    user = max(fams, key=lambda u: (len(fams[u]), sum(size[f] for f in fams[u]), u))
+    return user, max(fams[user], key=lambda f: (size[f], -f))
+
+
+def load_dataset(path):
+    """读 --format json 生成的文件，返回 (tables, actors)"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    return data['tables'], data['meta']['actors']
+
+
+# ================= 输出 =================
+
+def _sql_value(v):
+    if v is None: return 'null'
+    if isinstance(v, bool): return 'true' if v else 'false'
+    if isinstance(v, (int, float)): return repr(v)
+    if isinstance(v, (dict, list)): return "'" + json.dumps(v, ensure_ascii=False).replace("'", "''") + "'::jsonb"
+    return "'" + str(v).replace("'", "''") + "'"
+
+
+def write_sql(out, scale, seed, anchor, batch=500):
+    """
+    边生成边写 INSERT；session_replication_role = replica 关掉外键和触发器：
+    profiles 引用的 auth.users 本地没有，like_count 已经算好不需要触发器再加一遍
+    """
+    out.write(f"-- 模拟数据 scale={scale} seed={seed} anchor={anchor.isoformat()}\n")
+    out.write("begin;\nset session_replication_role = replica;\n")
+    pending = defaultdict(list)
+    id_tables = set()
+
+    def flush(table):
+        rows = pending.pop(table, None)
+        if not rows: return
+        cols = list(rows[0].keys())
+        out.write(f"insert into public.{table} ({', '.join(cols)}) values\n")
+        out.write(',\n'.join('(' + ', '.join(_sql_value(r[c]) for c in cols) + ')' for r in rows))
+        out.write("\non conflict do nothing;\n")
+
+    for table, row in iter_dataset(scale, seed, anchor):
+        if table == '__actors__': continue
+        if isinstance(row.get('id'), int): id_tables.add(table)
+        pending[table].append(row)
+        if len(pending[table]) >= batch: flush(table)
+    for table in TABLE_ORDER: flush(table)
+
+    out.write("set session_replication_role = origin;\n")
+    for table in TABLE_ORDER:
+        if table in id_tables:
+            out.write(f"select setval(pg_get_serial_sequence('public.{table}', 'id'), "
+                      f"(select max(id) from public.{table}));\n")
+    out.write("commit;\n")
+
+
+def write_json(out, scale, seed, anchor):
+    tables, actors = generate(scale, seed, anchor)
+    meta = {'scale': scale, 'seed': seed, 'anchor': anchor.isoformat(), 'actors': actors,
+            'rows': {k: len(v) for k, v in tables.items()}}
+    json.dump({'meta': meta, 'tables': tables}, out, ensure_ascii=False, separators=(',', ':'))
+    return meta
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成模拟数据 (可复现)')
+    parser.add_argument('--scale', type=float, default=1, help='1 = 目前线上量级，10 / 100 = 10 倍 / 100 倍')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--anchor', help='数据里的"现在" (YYYY-MM-DD 或 ISO 时间)，默认当前时间')
+    parser.add_argument('--format', choices=['json', 'sql'], default='json')
+    parser.add_argument('--out', help='输出文件，默认打印到标准输出')
+    args = parser.parse_args()
+
+    anchor = parse_anchor(args.anchor)
+    out = open(args.out, 'w', encoding='utf-8') if args.out else sys.stdout
+    try:
+        if args.format == 'sql':
+            write_sql(out, args.scale, args.seed, anchor)
+        else:
+            meta = write_json(out, args.scale, args.seed, anchor)
+            if args.out:
+                total = sum(meta['rows'].values())
+                print(f"✅ {args.out}: {total} 行 " +
+                      ' '.join(f"{k}={v}" for k, v in meta['rows'].items() if v), file=sys.stderr)
+    finally:
+        if args.out: out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+时间工具模块 (Supabase ISO 时间串 -> 北京时间)
+
+Supabase 返回的 created_at 形如 "2025-12-16T02:30:15.63411+00:00"，
+毫秒位数不固定、偶尔以 Z 结尾，Python 3.9 的 fromisoformat 直接解析会报错。
+这里统一解析一次并缓存，同一行数据在首页/详情页/后台反复渲染时不再重复计算。
+"""
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+BJ_TZ = timezone(timedelta(hours=8))
+
+# 缓存条目数：首页/详情页同时在看的行数远小于这个值，足够让重复渲染全部命中
+CACHE_SIZE = 65536
+
+# 小数秒部分：补齐/截断到 6 位，兼容 Python 3.9
+_FRACTION_RE = re.compile(r'\.(\d+)')
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_iso(iso_str):
+    """
+    解析 ISO 时间串为带时区的 UTC datetime，解析失败返回 None
+    没带时区的按 UTC 处理 (数据库存的都是 UTC)
+    """
+    if not iso_str: return None
+    try:
+        # 快速路径：标准格式直接解析 (Python 3.11+ 基本都能走这里)
+        dt = datetime.fromisoformat(iso_str)
+    except (TypeError, ValueError):
+        try:
+            s = str(iso_str).strip().replace(' ', 'T', 1)
+            if s.endswith('Z'): s = s[:-1] + '+00:00'
+            s = _FRACTION_RE.sub(lambda m: '.' + m.group(1)[:6].ljust(6, '0'), s, count=1)
+            dt = datetime.fromisoformat(s)
+        except (TypeError, ValueError):
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def to_beijing(iso_str):
+    """ISO 时间串 -> 北京时间 datetime，失败返回 None"""
+    dt = parse_iso(iso_str)
+    return dt.astimezone(BJ_TZ) if dt else None
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def format_bj(iso_str, fmt='%Y-%m-%d %H:%M', default=''):
+    """ISO 时间串 -> 北京时间字符串，失败返回 default"""
+    dt = to_beijing(iso_str)
+    return dt.strftime(fmt) if dt else default
+
+
+def format_time_friendly(iso_str, now=None):
+    """
+    将 ISO 时间字符串格式化为友好的显示格式
+    例如：刚刚、5分钟前、10-24 12:00
+    now: 批量格式化时由调用方传入，避免每行都取一次当前时间
+    """
+    if not iso_str: return ""
+    dt = parse_iso(iso_str)
+    if dt is None: return str(iso_str)[:10]
+
+    diff = (now or datetime.now(timezone.utc)) - dt
+
+    # 如果大于24小时，显示日期
+    if diff.days > 0:
+        return format_bj(iso_str, '%m-%d %H:%M')
+    # 如果小于1小时
+    elif diff.seconds < 3600:
+        mins = diff.seconds // 60
+        if mins == 0:
+            return "刚刚"
+        return f"{mins}分钟前"
+    # 如果小于24小时
+    else:
+        return f"{diff.seconds // 3600}小时前"
+
+
+def format_rows(rows, field='created_at', target='time_str', fmt=None, default=''):
+    """
+    批量格式化一组数据行 (原地写入 target 字段，返回 rows 方便链式使用)
+    fmt 为空时用友好格式 (刚刚/5分钟前)，否则按 strftime 格式输出北京时间
+    """
+    if fmt is None:
+        now = datetime.now(timezone.utc)
+        for r in rows:
+            r[target] = format_time_friendly(r.get(field), now)
+    else:
+        for r in rows:
+            r[target] = format_bj(r.get(field), fmt, default)
+    return rows
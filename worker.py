@@ -0,0 +1,64 @@
+"""
+后台任务 worker (独立进程，见 job_queue.py)
+
+用法: python worker.py [--queues push,default] [--threads 2]
+      python worker.py --stats           # 各队列积压 / 成功失败次数
+      python worker.py --dead            # 查看最近的死信
+      python worker.py --requeue-dead    # 死信全部重新排队
+
+web 进程默认每个 gunicorn worker 带一个内嵌任务线程；单独跑这个进程时可以给 web 设 JOB_EMBEDDED_WORKERS=0
+需要 Redis (FLASK_ENV=production 或设置 REDIS_URL)
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+from datetime import datetime
+
+os.environ.setdefault('JOB_EMBEDDED_WORKERS', '0')  # 自己就是 worker，导入 app 时不用再起内嵌线程
+import app  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='后台任务 worker')
+    parser.add_argument('--queues', help='逗号分隔，排在前面的优先，默认: ' + ','.join(app.jobs.queues()))
+    parser.add_argument('--threads', type=int, default=2, help='并发处理的线程数')
+    parser.add_argument('--stats', action='store_true', help='打印队列状态后退出')
+    parser.add_argument('--dead', action='store_true', help='打印最近 20 条死信后退出')
+    parser.add_argument('--requeue-dead', action='store_true', help='把死信重新排队后退出')
+    args = parser.parse_args()
+
+    if not app.redis_client: sys.exit("❌ 没有 Redis：本地开发时任务直接在 web 进程的后台线程里跑，不需要 worker")
+
+    if args.stats:
+        print(json.dumps(app.jobs.stats(), ensure_ascii=False, indent=2))
+        return
+    if args.dead:
+        for job in app.jobs.dead_letters():
+            at = datetime.fromtimestamp(job.get('failed_at', job['created_at'])).strftime('%m-%d %H:%M:%S')
+            print(f"{at}  {job['name']}{tuple(job['args'])}  尝试 {job['attempts']} 次  {job.get('last_error')}")
+        return
+    if args.requeue_dead:
+        print(f"♻️ 已重新排队 {app.jobs.requeue_dead()} 个任务")
+        return
+
+    queues = [q.strip() for q in args.queues.split(',') if q.strip()] if args.queues else app.jobs.queues()
+    stop = threading.Event()
+    # 收到 SIGTERM / Ctrl+C 时跑完手上的任务再退出
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop.set())
+
+    print(f"👷 任务 worker 启动: 队列 {queues}，{args.threads} 个线程，周期任务 {list(app.jobs.periodic)}")
+    workers = [threading.Thread(target=app.jobs.work, args=(queues, stop), name=f"job-worker-{i}")
+               for i in range(args.threads)]
+    for t in workers: t.start()
+    while not stop.is_set():
+        stop.wait(1)
+    for t in workers: t.join()
+    print("👋 任务 worker 已退出")
+
+
+if __name__ == '__main__':
+    main()